@@ -0,0 +1,441 @@
+"""This is the benchmark suite for the credit-card microservice.
+Written by: Michelle Mann
+
+Measures ops/s and latency percentiles for each function in cc_service.py
+(with valid and early-failing cards from the generators in random_test.py),
+import and cold start time of cc_core.py / cc_service.py, memory per result
+for dicts vs cc_results.BatchResult, and requests/s and tail latency of a
+locally started server with N concurrent REQ clients. Results are written as
+JSON so runs can be compared:
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import zmq  # For ZeroMQ
+
+import cc_service
+from cc_results import BatchResult
+from random_test import generate_random_card, generate_invalid_header
+from random_test import generate_random_digits
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Metrics where bigger is better, everything else is a latency.
+THROUGHPUT_KEYS = ("ops_per_sec", "requests_per_sec")
+
+
+# ------------ All related to test inputs ----------- #
+
+def luhn_card(header: str, length: int):
+    """Returns a card # with the given header, length and a valid
+    checksum."""
+
+    card_no = header + generate_random_digits(length - len(header) - 1)
+    for check_digit in "0123456789":
+        if cc_service.validate_luhn(card_no + check_digit):
+            return card_no + check_digit
+
+
+def bad_header_card():
+    """Returns a 16 digit card # whose header doesn't match any card type."""
+
+    while True:
+        header = generate_invalid_header()
+        card_no = header + generate_random_digits(16 - len(header))
+        if cc_service.validate_card_type(card_no) == -1:
+            return card_no
+
+
+def make_inputs(count=1000, seed=361):
+    """Returns named lists of (cc_number, exp_date) inputs."""
+
+    random.seed(seed)
+    return {
+        # Passes every check.
+        "valid": [(luhn_card(*random.choice([("4", 16), ("51", 16),
+                                             ("2720", 16), ("34", 15),
+                                             ("37", 15)])), "12/40")
+                  for _ in range(count)],
+        # Mix of everything the random tests generate.
+        "random": [(generate_random_card()[0], "5/40")
+                   for _ in range(count)],
+        # Fails on the very first checks.
+        "bad_header": [(bad_header_card(), "12/40") for _ in range(count)],
+        "bad_checksum": [(cc[:-1] + str((int(cc[-1]) + 1) % 10), "12/40")
+                         for cc in (luhn_card("4", 16) for _ in range(count))],
+        "bad_date": [(luhn_card("4", 16),
+                      random.choice(["13/40", "05/2025", "8-25", "1/20"]))
+                     for _ in range(count)],
+    }
+
+
+def function_cases(inputs):
+    """Returns {name: (function, list of argument tuples)} to benchmark."""
+
+    cases = {}
+    for name in ("valid", "bad_header"):
+        raw = [cc for cc, _ in inputs[name]]
+        clean = [cc_service.format_cc(cc) for cc in raw]
+        types = [cc_service.validate_card_type(cc) for cc in clean]
+
+        cases[f"format_cc/{name}"] = (cc_service.format_cc,
+                                      [(cc,) for cc in raw])
+        cases[f"validate_card_type/{name}"] = (cc_service.validate_card_type,
+                                               [(cc,) for cc in clean])
+        cases[f"valid_card_length/{name}"] = (cc_service.valid_card_length,
+                                              list(zip(clean, types)))
+
+    cases["validate_luhn/valid"] = (
+        cc_service.validate_luhn,
+        [(cc_service.format_cc(cc),) for cc, _ in inputs["valid"]])
+    cases["validate_luhn/bad_checksum"] = (
+        cc_service.validate_luhn,
+        [(cc_service.format_cc(cc),) for cc, _ in inputs["bad_checksum"]])
+    cases["validate_expiration/valid"] = (
+        cc_service.validate_expiration, [(exp,) for _, exp in inputs["valid"]])
+    cases["validate_expiration/bad_date"] = (
+        cc_service.validate_expiration,
+        [(exp,) for _, exp in inputs["bad_date"]])
+
+    for name, cards in inputs.items():
+        cases[f"validate_card/{name}"] = (cc_service.validate_card, cards)
+
+    cases["handle_request/batch_100"] = (
+        cc_service.handle_request,
+        [([{"cc_number": cc, "exp_date": exp}
+           for cc, exp in inputs["random"][i:i + 100]],)
+         for i in range(0, len(inputs["random"]), 100)])
+    return cases
+
+
+# ------------ All related to timing ----------- #
+
+def percentiles(samples):
+    """Returns p50 / p95 / p99 / max of a list of latencies in seconds, as
+    microseconds."""
+
+    if len(samples) < 2:
+        samples = list(samples) * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50_us": cuts[49] * 1e6, "p95_us": cuts[94] * 1e6,
+            "p99_us": cuts[98] * 1e6, "max_us": max(samples) * 1e6}
+
+
+def bench_function(function, arguments, min_time=0.2):
+    """Calls function over the arguments until min_time has passed. Returns
+    ops/s (from untimed loops) and latency percentiles (from timed calls)."""
+
+    # Throughput: whole passes over the inputs with a single clock read.
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        for args in arguments:
+            function(*args)
+        calls += len(arguments)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+
+    # Latency: one pass timing every call.
+    clock = time.perf_counter
+    samples = []
+    for args in arguments:
+        call_started = clock()
+        function(*args)
+        samples.append(clock() - call_started)
+
+    return {"ops_per_sec": calls / elapsed, **percentiles(samples)}
+
+
+def bench_functions(count=1000, min_time=0.2, pattern=None):
+    """Benchmarks every function case, optionally only names containing
+    pattern."""
+
+    results = {}
+    for name, (function, arguments) in function_cases(
+            make_inputs(count)).items():
+        if pattern and pattern not in name:
+            continue
+        results[name] = bench_function(function, arguments, min_time)
+    return results
+
+
+def free_port():
+    """Returns a free TCP port on localhost."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(server_args=(), address=None):
+    """Starts cc_service.py in a subprocess (on a free port unless an address
+    is given) and waits until it answers. Returns (process, address)."""
+
+    address = address or f"tcp://127.0.0.1:{free_port()}"
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "cc_service.py"),
+         "--bind", address, *server_args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    warmup = zmq.Context.instance().socket(zmq.REQ)
+    warmup.setsockopt(zmq.LINGER, 0)
+    warmup.connect(address)
+    try:
+        warmup.send_json({"cc_number": "4111111111111111",
+                          "exp_date": "12/40"})
+        if not warmup.poll(10000):
+            server.kill()
+            raise RuntimeError("Server did not start")
+        warmup.recv()
+    finally:
+        warmup.close()
+    return server, address
+
+
+def stop_server(server, address):
+    """Sends the server its 'Q' message and waits for it to exit."""
+
+    sock = zmq.Context.instance().socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 1000)
+    sock.connect(address)
+    sock.send(b"Q")
+    sock.close()
+    try:
+        server.wait(5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def bench_server(clients=8, duration=3.0, server_args=(), batch=1):
+    """Starts cc_service.py in a subprocess and has `clients` REQ clients
+    send requests back to back for `duration` seconds. Returns requests/s,
+    cards/s and latency percentiles."""
+
+    inputs = make_inputs(1000)["random"]
+    context = zmq.Context.instance()
+    latencies = [[] for _ in range(clients)]
+    failures = [0] * clients
+
+    def client(n):
+        sock = context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(address)
+        messages = [json.dumps([{"cc_number": cc, "exp_date": exp}
+                                for cc, exp in inputs[i:i + batch]]
+                               if batch > 1 else
+                               {"cc_number": inputs[i][0],
+                                "exp_date": inputs[i][1]}).encode()
+                    for i in range(n, len(inputs), clients)]
+        end = time.perf_counter() + duration
+        i = 0
+        while time.perf_counter() < end:
+            sent = time.perf_counter()
+            sock.send(messages[i % len(messages)])
+            if not sock.poll(5000):
+                failures[n] += 1
+                break
+            sock.recv()
+            latencies[n].append(time.perf_counter() - sent)
+            i += 1
+        sock.close()
+
+    # Wait until the server answers before starting the clock.
+    server, address = spawn_server(server_args)
+    try:
+        threads = [threading.Thread(target=client, args=(n,))
+                   for n in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_server(server, address)
+
+    samples = [s for client_samples in latencies for s in client_samples]
+    return {"clients": clients, "batch": batch,
+            "requests_per_sec": len(samples) / elapsed,
+            "cards_per_sec": len(samples) * batch / elapsed,
+            "timeouts": sum(failures), **percentiles(samples)}
+
+
+# ------------ All related to startup time ----------- #
+
+# Run in a fresh interpreter, printing the seconds taken.
+IMPORT_SCRIPT = ("import time; started = time.perf_counter(); "
+                 "import {module}; print(time.perf_counter() - started)")
+COLD_START_SCRIPT = ("import time; started = time.perf_counter(); "
+                     "import {module}; "
+                     "{module}.validate_card('4111111111111111', '12/40'); "
+                     "print(time.perf_counter() - started)")
+
+
+def run_python(script: str):
+    """Runs a script in a new interpreter. Returns (seconds it printed, wall
+    seconds for the whole process)."""
+
+    # Lets the .pyc files be written, as they would be in a deployment.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], cwd=HERE,
+                            env=env, capture_output=True, text=True,
+                            check=True).stdout
+    return float(output), time.perf_counter() - started
+
+
+def bench_startup(modules=("cc_core", "cc_service"), repeat=10):
+    """Returns the import time and cold start time (import plus the first
+    validate_card call) of each module, each in a fresh interpreter."""
+
+    results = {}
+    for module in modules:
+        for name, script in (("import", IMPORT_SCRIPT),
+                             ("cold_start", COLD_START_SCRIPT)):
+            script = script.format(module=module)
+            run_python(script)  # Writes the .pyc files first.
+            samples = [run_python(script) for _ in range(repeat)]
+            results[f"{name}/{module}"] = {
+                "median_us": statistics.median(s for s, _ in samples) * 1e6,
+                "max_us": max(s for s, _ in samples) * 1e6,
+                "process_us": statistics.median(w for _, w in samples) * 1e6}
+    return results
+
+
+# ------------ All related to result memory ----------- #
+
+def traced_size(build):
+    """Returns (result of build(), bytes it allocated and kept)."""
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_result_memory(count=100000):
+    """Returns the bytes per result of keeping the results of count cards as
+    a list of validate_card dicts and as a BatchResult."""
+
+    inputs = make_inputs(count // 5 + 1)
+    cards = [card for name in ("valid", "bad_header", "bad_checksum",
+                               "bad_date", "random")
+             for card in inputs[name]][:count]
+
+    results = {}
+    for name, build in (
+            ("dicts", lambda: [cc_service.validate_card(cc, exp)
+                               for cc, exp in cards]),
+            ("batch_result", lambda: BatchResult.validate(cards))):
+        kept, size = traced_size(build)
+        results[name] = {"results": len(kept),
+                         "bytes_per_result": size / len(kept)}
+        del kept
+    return results
+
+
+# ------------ All related to comparing runs ----------- #
+
+def compare(baseline: dict, current: dict, threshold=0.10):
+    """Returns a list of (name, metric, old, new, change) for every metric
+    that got worse by more than threshold (10% by default)."""
+
+    regressions = []
+    for section in ("functions", "server", "startup", "memory"):
+        for name, metrics in current.get(section, {}).items():
+            old_metrics = baseline.get(section, {}).get(name, {})
+            for metric in ("ops_per_sec", "requests_per_sec", "p50_us",
+                           "p99_us", "median_us", "bytes_per_result"):
+                old, new = old_metrics.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = -change if metric in THROUGHPUT_KEYS else change
+                if worse > threshold:
+                    regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cc_service")
+    parser.add_argument("--skip-functions", action="store_true",
+                        help="don't benchmark the validator functions")
+    parser.add_argument("--skip-server", action="store_true",
+                        help="don't benchmark a running server")
+    parser.add_argument("--skip-startup", action="store_true",
+                        help="don't benchmark import / cold start time")
+    parser.add_argument("--skip-memory", action="store_true",
+                        help="don't measure memory per result")
+    parser.add_argument("--only", help="only function cases containing this")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds per function case")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8],
+                        help="# of concurrent clients per server run")
+    parser.add_argument("--duration", type=float, default=3.0,
+                        help="seconds per server run")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="cards per server request")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments for cc_service.py, e.g. "
+                             "\"--async\"")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="regression threshold for --compare")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(),
+               "machine": platform.machine(), "time": time.time()}
+
+    if not args.skip_functions:
+        results["functions"] = bench_functions(min_time=args.min_time,
+                                               pattern=args.only)
+    if not args.skip_startup:
+        results["startup"] = bench_startup()
+    if not args.skip_memory:
+        results["memory"] = bench_result_memory()
+    if not args.skip_server:
+        results["server"] = {
+            f"clients_{n}": bench_server(n, args.duration,
+                                         args.server_args.split(),
+                                         args.batch)
+            for n in args.clients}
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        for name, metric, old, new, change in regressions:
+            print(f"REGRESSION {name} {metric}: {old:.6g} -> {new:.6g} "
+                  f"({change:+.1%})", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
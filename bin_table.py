@@ -0,0 +1,110 @@
+"""This is the card header (BIN / IIN) table for the credit-card microservice.
+Written by: Michelle Mann
+
+Maps the first 1-6 digits of a card number to its card type and the card
+lengths allowed for that type. The networks are loaded from a JSON file, so
+new networks or ranges can be added without code changes:
+
+    {"Visa": {"prefixes": ["4"], "lengths": [16]},
+     "MC": {"prefixes": ["51-55", "2221-2720"], "lengths": [16]}}
+
+Prefixes are either a single prefix or an inclusive range of prefixes with
+the same # of digits. The longest matching prefix wins.
+
+card_ranges.json (Visa, MC and AmEx) is used by default. Set the
+CC_CARD_RANGES environment variable or call load_card_ranges() to use another
+file, such as card_ranges_extended.json. The table is loaded the first time
+TABLE is used, so importing this module costs next to nothing.
+"""
+
+import os
+
+
+# Card types in a fixed order, so bulk validation can store them as small
+# integer codes (0 means no card type). Networks loaded from a file that
+# aren't listed here are added to the end.
+CARD_TYPES = ["", "Visa", "MC", "AmEx", "Discover", "JCB", "UnionPay",
+              "Diners"]
+
+DEFAULT_CARD_RANGES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "card_ranges.json")
+
+
+def expand_prefixes(entry: str):
+    """Returns the list of prefixes for a table entry such as "34" or
+    "2221-2720"."""
+
+    low, _, high = entry.partition("-")
+    high = high or low
+    if not (low.isdigit() and high.isdigit()) or len(low) != len(high) or \
+            len(low) > 6 or int(low) > int(high):
+        raise ValueError(f"Invalid card prefix range: {entry}")
+
+    return [str(prefix).zfill(len(low))
+            for prefix in range(int(low), int(high) + 1)]
+
+
+class BinTable:
+    """Prefix index of card types, built once from a dict of networks."""
+
+    def __init__(self, networks: dict):
+        # prefix -> (card type, allowed lengths)
+        self.prefixes = {}
+
+        # card type -> allowed lengths
+        self.lengths = {}
+
+        for card_type, network in networks.items():
+            if card_type not in CARD_TYPES:
+                CARD_TYPES.append(card_type)
+
+            lengths = frozenset(network["lengths"])
+            self.lengths[card_type] = lengths
+
+            for entry in network["prefixes"]:
+                for prefix in expand_prefixes(entry):
+                    if prefix in self.prefixes:
+                        raise ValueError(f"Card prefix {prefix} is listed "
+                                         "more than once")
+                    self.prefixes[prefix] = (card_type, lengths)
+
+        # Prefix lengths to try, longest first.
+        self.prefix_lengths = sorted({len(p) for p in self.prefixes},
+                                     reverse=True)
+
+    @classmethod
+    def load(cls, path: str):
+        """Builds the table from a JSON file."""
+
+        # Imported here, so it's only loaded along with a table.
+        import json
+        with open(path) as file:
+            return cls(json.load(file))
+
+    def lookup(self, cc_number: str):
+        """Returns (card type, allowed lengths) for a card number, or None if
+        the header doesn't match any network."""
+
+        for length in self.prefix_lengths:
+            match = self.prefixes.get(cc_number[:length])
+            if match is not None:
+                return match
+        return None
+
+
+def load_card_ranges(path: str):
+    """Replaces the card type table with the networks in a JSON file."""
+
+    global TABLE
+    TABLE = BinTable.load(path)
+    return TABLE
+
+
+def __getattr__(name):
+    """Loads the table used by validate_card_type and valid_card_length
+    (TABLE) the first time it's asked for."""
+
+    if name == "TABLE":
+        return load_card_ranges(os.environ.get("CC_CARD_RANGES",
+                                               DEFAULT_CARD_RANGES))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
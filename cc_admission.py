@@ -0,0 +1,135 @@
+"""This is the admission control of the credit-card microservice.
+Written by: Michelle Mann
+
+Keeps one client from flooding the service for everyone else. Each client
+(ZeroMQ identity on the ROUTER socket) gets a token bucket, accepted requests
+wait in a bounded queue that is served round-robin between clients, and
+anything over the limits gets an immediate "Service overloaded" reply with a
+retry_after hint instead of timing out.
+"""
+
+import collections
+import time
+
+import cc_wire
+
+
+class TokenBucket:
+    """Allows rate cards per second on average, with bursts of up to burst
+    cards."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, cost: float, now: float):
+        """Takes cost tokens. Returns 0 if they were taken, otherwise the
+        seconds until there will be enough."""
+
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # Batches bigger than the burst go through on a full bucket and leave
+        # it in debt, rather than never going through.
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+def request_cost(message: bytes):
+    """Returns the # of cards in a raw request, without decoding it."""
+
+    if message[:1] == cc_wire.STRUCT_TAG and len(message) >= 5:
+        return max(1, cc_wire.COUNT.unpack_from(message, 1)[0])
+
+    # JSON and MessagePack requests spell out a key for every card.
+    return max(1, message.count(b"cc_number"))
+
+
+class AdmissionControl:
+    """Rate limits and queues requests per client.
+
+    rate        - cards per second allowed per client (None for no limit).
+    burst       - cards a client can send at once (default: 1 second's worth).
+    max_queue   - requests waiting to be processed before new ones are shed.
+    retry_after - seconds suggested to clients when the queue is full.
+    max_clients - token buckets kept; the least recently seen go first.
+    """
+
+    def __init__(self, rate=None, burst=None, max_queue=1000,
+                 retry_after=0.1, max_clients=10000,
+                 time_source=time.monotonic):
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.max_clients = max_clients
+        self.time_source = time_source
+
+        self.buckets = collections.OrderedDict()   # client -> TokenBucket
+        self.queues = collections.OrderedDict()    # client -> deque of items
+        self.queued = 0
+
+        self.rate_limited = 0
+        self.shed = 0
+
+    def admit(self, client: bytes, message: bytes):
+        """Applies the client's rate limit to a request. Returns 0 if it may
+        go ahead, otherwise the seconds the client should wait."""
+
+        if self.rate is None:
+            return 0.0
+
+        now = self.time_source()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst,
+                                                        now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+
+        wait = bucket.take(request_cost(message), now)
+        if wait:
+            self.rate_limited += 1
+        return wait
+
+    def offer(self, client: bytes, message: bytes, item):
+        """Queues item for a request if the client is within its rate and the
+        queue has room. Returns 0 if it was queued, otherwise the seconds the
+        client should wait."""
+
+        wait = self.admit(client, message)
+        if wait:
+            return wait
+
+        if self.queued >= self.max_queue:
+            self.shed += 1
+            return self.retry_after
+
+        self.queues.setdefault(client, collections.deque()).append(item)
+        self.queued += 1
+        return 0.0
+
+    def take(self):
+        """Returns the next queued item, taking turns between clients so a
+        client with many queued requests can't hold up the others."""
+
+        client, queue = next(iter(self.queues.items()))
+        item = queue.popleft()
+        self.queued -= 1
+
+        # Goes to the back of the line if it has more waiting.
+        del self.queues[client]
+        if queue:
+            self.queues[client] = queue
+        return item
+
+    def __len__(self):
+        return self.queued
@@ -0,0 +1,258 @@
+"""This is the asyncio version of the credit-card microservice.
+Written by: Michelle Mann
+
+Uses a zmq.asyncio ROUTER socket so that many requests can be in flight at
+once. Each request gets its own task, so a (simulated) slow request never
+holds up anybody else. Big batches are validated on worker threads (and in
+the cc_service.POOL processes, if there are any), so they don't stall the
+event loop for the small requests either. REQ clients work exactly the same
+as with start_server() in cc_service.py.
+"""
+
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+import zmq  # For ZeroMQ
+import zmq.asyncio
+
+import cc_core
+from cc_admission import request_cost
+from cc_logging import log
+from cc_dedup import PENDING, request_key
+from cc_service import OVERLOADED_ERROR, error_reply, respond
+
+
+# Worker threads for big batches.
+OFFLOAD_THREADS = 4
+
+
+class AsyncServer:
+    """Asyncio microservice with a cap on in-flight requests.
+
+    max_in_flight - requests processed at once. Once reached, the server stops
+                    reading from the socket until a request finishes.
+    hwm           - ZeroMQ high-water mark for queued incoming / outgoing
+                    messages, after which clients are pushed back on.
+    drain_timeout - seconds to wait for pending requests on shutdown.
+    metrics       - optional cc_metrics.Metrics to time each stage with.
+    admission     - optional cc_admission.AdmissionControl. Requests are then
+                    rate limited per client, and once max_in_flight is
+                    reached new requests get an overload reply instead of
+                    waiting.
+    dedup         - optional cc_dedup.RequestDedup. Copies of a request with
+                    a "request_id" then wait for the first copy's reply
+                    instead of being validated again.
+    offload_cards - requests with at least this many cards are validated on
+                    a worker thread instead of the event loop.
+    """
+
+    def __init__(self, bind="tcp://*:5557", latency=None, max_in_flight=1000,
+                 hwm=1000, drain_timeout=10.0, metrics=None, admission=None,
+                 dedup=None, offload_cards=100):
+        self.bind = bind
+        self.metrics = metrics
+        self.admission = admission
+        self.dedup = dedup
+        self.latency = latency
+        self.max_in_flight = max_in_flight
+        self.hwm = hwm
+        self.drain_timeout = drain_timeout
+        self.offload_cards = offload_cards
+        self.executor = None
+        self.tasks = set()
+        self.stopping = None
+        self.socket = None
+
+    def stop(self):
+        """Stops taking new requests. Pending requests are still answered."""
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def serve(self):
+        """Runs the server until stop() is called or a 'Q' message comes in,
+        then drains the requests that are still in flight."""
+
+        # Step #1: Set up the context and the router socket.
+        context = zmq.asyncio.Context()
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.RCVHWM, self.hwm)
+        self.socket.setsockopt(zmq.SNDHWM, self.hwm)
+        self.socket.bind(self.bind)
+        log.info("Async server is running on %s...", self.bind)
+
+        if self.metrics is not None:
+            self.metrics.instrument_stages(cc_core)
+
+        self.executor = ThreadPoolExecutor(OFFLOAD_THREADS)
+        self.stopping = asyncio.Event()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        stopped = asyncio.ensure_future(self.stopping.wait())
+
+        # Step #2: Listens for requests until told to stop.
+        while not self.stopping.is_set():
+
+            # Backpressure - don't read another request until there's room
+            # (with admission control, overloads are answered instead).
+            if self.admission is None:
+                await in_flight.acquire()
+
+            started = time.perf_counter()
+            receive = asyncio.ensure_future(self.socket.recv_multipart())
+            await asyncio.wait([receive, stopped],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if self.metrics is not None:
+                self.metrics.observe("socket_wait",
+                                     time.perf_counter() - started)
+            if not receive.done():
+                receive.cancel()
+                if self.admission is None:
+                    in_flight.release()
+                break
+
+            frames = receive.result()
+            address, message = frames[:-1], frames[-1]
+            received = time.monotonic()
+
+            # Client asked server to quit
+            if message == b"Q":
+                if self.admission is None:
+                    in_flight.release()
+                break
+
+            # Retries are answered from the first copy of the request, without
+            # counting against the client's rate.
+            key = None
+            if self.dedup is not None:
+                key = request_key(message)
+                if key is not None:
+                    reply = self.dedup.check(key, address, message)
+                    if reply is not None:
+                        if self.admission is None:
+                            in_flight.release()
+                        if reply is not PENDING:
+                            await self.socket.send_multipart(address +
+                                                             [reply])
+                        continue
+
+            if self.admission is not None:
+                wait = self.admission.admit(address[0], message)
+                if not wait and in_flight.locked():
+                    self.admission.shed += 1
+                    wait = self.admission.retry_after
+                if wait:
+                    await self.reject(address, message, wait)
+                    continue
+                await in_flight.acquire()
+
+            if key is not None:
+                self.dedup.start(key)
+            task = asyncio.create_task(self.respond(address, message,
+                                                    in_flight, key, received))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        stopped.cancel()
+
+        # Step #3: Finish the requests that are still in flight.
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=self.drain_timeout)
+
+        # Make a clean exit.
+        self.executor.shutdown(wait=False)
+        if self.metrics is not None:
+            self.metrics.restore_stages()
+        self.socket.close(linger=0)
+        context.term()
+
+    async def respond(self, address, message, in_flight, key=None,
+                      received=None):
+        """Validates one request and sends the reply back to its client (and
+        to any waiting copies of the request)."""
+
+        try:
+            if key is None:
+                reply = await self.process(message, received)
+                addresses = [address]
+            else:
+                reply, addresses = await self.process_dedup(address, message,
+                                                            key, received)
+
+            # Requests past their deadline are dropped.
+            if reply is None:
+                return
+
+            if self.latency is not None:
+                await asyncio.sleep(self.latency.next_delay())
+
+            for address in addresses:
+                await self.socket.send_multipart(address + [reply])
+
+        # Handle server errors.
+        except Exception as e:
+            log.exception("Unexpected error occurred: %s", e)
+
+        finally:
+            in_flight.release()
+
+    async def process(self, message, received=None):
+        """Returns the encoded reply for a request (see cc_service.respond).
+        Requests of offload_cards or more cards are validated on a worker
+        thread, so the event loop keeps answering the small ones."""
+
+        if request_cost(message) < self.offload_cards:
+            return respond(message, self.metrics, received)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, respond, message,
+                                          self.metrics, received)
+
+    async def process_dedup(self, address, message, key, received=None):
+        """Same as cc_service.respond_dedup, but validates with process. The
+        dedup tables are only used from the event loop, never a worker
+        thread."""
+
+        reply = None
+        try:
+            reply = await self.process(message, received)
+            while reply is None:
+                copy = self.dedup.retry(key)
+                if copy is None:
+                    break
+                # The copy's "timeout_ms" isn't checked, it came in later and
+                # its client is still waiting.
+                address, message = copy
+                reply = await self.process(message)
+        finally:
+            waiting = self.dedup.finish(key, reply)
+        return reply, [address] + waiting
+
+    async def reject(self, address, message, wait):
+        """Tells a client to retry after wait seconds."""
+
+        reply = error_reply(message, OVERLOADED_ERROR,
+                            retry_after=round(wait, 3))
+        if self.metrics is not None:
+            self.metrics.count_reply({"error": OVERLOADED_ERROR})
+        await self.socket.send_multipart(address + [reply])
+
+
+def start_async_server(bind="tcp://*:5557", latency=None, max_in_flight=1000,
+                       hwm=1000, metrics=None, admission=None, dedup=None,
+                       offload_cards=100):
+    """Runs the asyncio server until 'Q', SIGINT or SIGTERM is received."""
+
+    server = AsyncServer(bind, latency, max_in_flight, hwm, metrics=metrics,
+                         admission=admission, dedup=dedup,
+                         offload_cards=offload_cards)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, server.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass  # Not supported on this platform / thread.
+        await server.serve()
+
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+"""This is the broker mode of the credit-card microservice.
+Written by: Michelle Mann
+
+A ROUTER socket takes requests from clients on the usual port and hands them
+out to a pool of workers through a DEALER socket. Each worker is a REP socket
+running the same validation as the single server loop, so REQ clients don't
+need any changes.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zmq  # For ZeroMQ
+
+import cc_logging
+from cc_logging import log, setup_logging
+from cc_service import DEADLINE_ERROR, error_reply, safe_respond
+
+
+# Message published on the control socket to stop all workers.
+STOP_WORKERS = b"STOP"
+
+
+def run_worker(backend: str, control: str, context=None):
+    """Validates requests from the broker's backend until the broker publishes
+    STOP_WORKERS on the control socket."""
+
+    # Thread workers share the broker's context (needed for inproc://),
+    # process workers make their own.
+    own_context = context is None
+    context = context or zmq.Context()
+
+    # A forked worker process needs its own thread writing the log queue.
+    listener = None
+    if own_context and log.handlers:
+        listener = setup_logging(log.level, cc_logging.sample_rate)
+
+    # Step #1: Reply socket connected to the broker's DEALER.
+    socket = context.socket(zmq.REP)
+    socket.connect(backend)
+
+    # Step #2: Subscribe to the broker's control messages.
+    control_socket = context.socket(zmq.SUB)
+    control_socket.connect(control)
+    control_socket.setsockopt(zmq.SUBSCRIBE, b"")
+
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(control_socket, zmq.POLLIN)
+
+    # Step #3: Listens for requests until told to stop.
+    while True:
+        events = dict(poller.poll())
+
+        if control_socket in events:
+            if control_socket.recv() == STOP_WORKERS:
+                break
+
+        if socket in events:
+            message = socket.recv()
+            reply = safe_respond(message, received=time.monotonic())
+
+            # REP sockets have to answer, even past the deadline.
+            if reply is None:
+                reply = error_reply(message, DEADLINE_ERROR)
+            socket.send(reply)
+
+    # Make a clean exit.
+    socket.close(linger=0)
+    control_socket.close(linger=0)
+    if own_context:
+        context.term()
+    if listener is not None:
+        listener.stop()
+
+
+def start_broker(bind="tcp://*:5557", workers=None, mode="process"):
+    """Runs the broker with N workers (default: one per core) until a 'Q'
+    message is received, then stops the workers."""
+
+    workers = workers or os.cpu_count() or 1
+    context = zmq.Context()
+
+    # Step #1: Work out where the workers connect. Threads can use inproc://,
+    # processes need ipc:// sockets in a private temp directory.
+    if mode == "thread":
+        socket_dir = None
+        backend_addr = f"inproc://cc-workers-{id(context)}"
+        control_addr = f"inproc://cc-control-{id(context)}"
+    elif mode == "process":
+        socket_dir = tempfile.mkdtemp(prefix="cc_broker_")
+        backend_addr = f"ipc://{socket_dir}/workers"
+        control_addr = f"ipc://{socket_dir}/control"
+    else:
+        raise ValueError(f"Unknown worker mode: {mode}")
+
+    # Step #2: Front end for the clients, back end and control for workers.
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(bind)
+    backend = context.socket(zmq.DEALER)
+    backend.bind(backend_addr)
+    control = context.socket(zmq.PUB)
+    control.bind(control_addr)
+
+    # Step #3: Start the pool of workers.
+    pool = []
+    for _ in range(workers):
+        if mode == "thread":
+            worker = threading.Thread(
+                target=run_worker, args=(backend_addr, control_addr, context),
+                daemon=True)
+        else:
+            worker = multiprocessing.Process(
+                target=run_worker, args=(backend_addr, control_addr),
+                daemon=True)
+        worker.start()
+        pool.append(worker)
+
+    log.info("Broker is running on %s with %d %s workers...", bind, workers,
+             mode)
+
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+
+    # Step #4: Pass requests to the workers and replies back to the clients.
+    while True:
+        try:
+            events = dict(poller.poll())
+
+            if frontend in events:
+                frames = frontend.recv_multipart()
+
+                # Client asked server to quit
+                if frames[-1] == b"Q":
+                    break
+
+                backend.send_multipart(frames)
+
+            if backend in events:
+                frontend.send_multipart(backend.recv_multipart())
+
+        # Handle server errors.
+        except Exception as e:
+            log.exception("Unexpected error occurred: %s", e)
+
+    # Step #5: Stop the workers and make a clean exit.
+    # STOP is re-sent until every worker is gone, in case a worker had not
+    # finished subscribing when it was first published.
+    deadline = time.monotonic() + 5
+    alive = pool
+    while alive and time.monotonic() < deadline:
+        control.send(STOP_WORKERS)
+        alive[0].join(0.1)
+        alive = [worker for worker in alive if worker.is_alive()]
+
+    for worker in alive:
+        if mode == "process":
+            worker.terminate()
+
+    frontend.close(linger=0)
+    backend.close(linger=0)
+    control.close(linger=0)
+    context.term()
+
+    if socket_dir:
+        shutil.rmtree(socket_dir, ignore_errors=True)
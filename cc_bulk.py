@@ -0,0 +1,239 @@
+"""This is the bulk card # validator of the credit-card microservice.
+Written by: Michelle Mann
+
+Validates very large files of card numbers (i.e. vault migrations), one card
+# per line or in fixed-width records. The file is memory-mapped and every
+card # is read straight out of the mapping, byte by byte, into the Luhn sums
+and the header value used for the card type lookup. No str or bytes object
+is made per line. The results go into byte columns allocated once for the
+whole file (a cc_results.BatchResult), which are written out in one go.
+
+The checks are the same as format_cc / validate_card_type /
+valid_card_length / validate_luhn: every byte that isn't an ASCII digit is
+skipped as a separator. These files have no expiration dates, so a valid
+card here is one that passes everything up to the date check.
+
+Example calls:
+    python3 cc_bulk.py pans.txt -o results.bin
+    python3 cc_bulk.py pans.dat --width 20
+"""
+
+import argparse
+import json
+import mmap
+import sys
+import time
+
+import bin_table
+from cc_core import CARD_TYPES, ERRORS, HEADER_DIGITS
+from cc_results import BatchResult
+
+
+# Codes for the errors a card # on its own can have.
+BAD_FORMAT = ERRORS.index("Invalid card format")
+BAD_HEADER = ERRORS.index("Unknown card header")
+BAD_LENGTH = ERRORS.index("Incorrect length")
+BAD_CHECKSUM = ERRORS.index("Invalid checksum")
+
+# Byte value -> digit, or -1 for separators.
+DIGITS = tuple(byte - 48 if 48 <= byte <= 57 else -1 for byte in range(256))
+
+# (2 * d, minus 9 if over 9).
+LUHN_DOUBLE = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+# Error code -> valid flag, for bytes.translate.
+VALID_FLAGS = bytes([1]) + bytes(255)
+
+# Bytes per read when counting lines.
+COUNT_CHUNK = 1 << 20
+
+
+class BulkValidator:
+    """Validates card #s in a buffer (bytes, bytearray or mmap) with the card
+    types of a bin_table.BinTable (the loaded one by default)."""
+
+    def __init__(self, table=None):
+        table = table or bin_table.TABLE
+
+        # Prefixes keyed by their value and # of digits (value * 16 + # of
+        # digits), so the lookup doesn't need the header as a str.
+        self.prefixes = {}
+        for prefix, (card_type, lengths) in table.prefixes.items():
+            self.prefixes[int(prefix) * 16 + len(prefix)] = (
+                CARD_TYPES.index(card_type), lengths)
+        self.prefix_lengths = [length for length in table.prefix_lengths
+                               if length <= HEADER_DIGITS]
+
+    def validate_views(self, views, rows: int):
+        """Validates the card # in each of a sequence of rows memoryviews
+        (or other iterables of byte values) and returns a BatchResult."""
+
+        results = BatchResult(bytearray(rows), bytearray(rows),
+                              bytearray(rows))
+        card_types = results.card_types
+        errors = results.errors
+
+        # Local names are faster to look up inside the loop.
+        prefixes = self.prefixes
+        prefix_lengths = self.prefix_lengths
+        header_steps = [(10 ** (HEADER_DIGITS - length), length)
+                        for length in prefix_lengths]
+        digit_of = DIGITS
+        double = LUHN_DOUBLE
+
+        for row, view in enumerate(views):
+            length = 0
+            header = 0
+
+            # Which digits get doubled depends on the length, which isn't
+            # known until the end. luhn is the sum if the digit just read is
+            # the check digit, doubled the sum if it's the one before -- so
+            # each new digit swaps them (no branch on the position, which is
+            # about twice as fast here).
+            luhn = 0
+            doubled = 0
+
+            for byte in view:
+                digit = digit_of[byte]
+                if digit < 0:
+                    continue
+                if length < HEADER_DIGITS:
+                    header = header * 10 + digit
+                doubled, luhn = luhn + double[digit], doubled + digit
+                length += 1
+
+            if not length:
+                errors[row] = BAD_FORMAT
+                continue
+
+            # Longest matching prefix, the same as BinTable.lookup. Cards
+            # shorter than a prefix are looked up with all their digits.
+            match = None
+            if length >= HEADER_DIGITS:
+                for divisor, digits in header_steps:
+                    match = prefixes.get(header // divisor * 16 + digits)
+                    if match is not None:
+                        break
+            else:
+                for prefix_length in prefix_lengths:
+                    digits = min(prefix_length, length)
+                    match = prefixes.get(
+                        header // 10 ** (length - digits) * 16 + digits)
+                    if match is not None:
+                        break
+            if match is None:
+                errors[row] = BAD_HEADER
+                continue
+
+            card_types[row], lengths = match
+            if length not in lengths:
+                errors[row] = BAD_LENGTH
+            elif luhn % 10:
+                errors[row] = BAD_CHECKSUM
+
+        # Valid flags are 1 where the error code is 0.
+        results.valid[:] = errors.translate(VALID_FLAGS)
+        return results
+
+    def validate_lines(self, buffer):
+        """Validates one card # per line ("\\n", with or without "\\r").
+        Returns a BatchResult with a row per line."""
+        return self.validate_views(lines(buffer), count_lines(buffer))
+
+    def validate_fixed(self, buffer, width: int):
+        """Validates fixed-width records of width bytes each (including any
+        newline). Returns a BatchResult with a row per record."""
+
+        view = memoryview(buffer)
+        rows = -(-len(view) // width)
+        return self.validate_views((view[start:start + width] for start in
+                                    range(0, len(view), width)), rows)
+
+
+def lines(buffer):
+    """Yields a memoryview of each line of a buffer, without copying."""
+
+    view = memoryview(buffer)
+    size = len(view)
+    start = 0
+    while start < size:
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            end = size
+        yield view[start:end]
+        start = end + 1
+
+
+def count_lines(buffer):
+    """Returns the # of lines in a buffer (a last line without a newline
+    counts too)."""
+
+    size = len(buffer)
+    lines = sum(buffer[i:i + COUNT_CHUNK].count(b"\n")
+                for i in range(0, size, COUNT_CHUNK))
+    if size and buffer[size - 1:size] != b"\n":
+        lines += 1
+    return lines
+
+
+def validate_path(path: str, width=None, validator=None):
+    """Returns the BatchResult for a file of card #s, one per line or in
+    fixed-width records of width bytes."""
+
+    validator = validator or BulkValidator()
+    with open(path, "rb") as file:
+        # Empty files can't be mapped.
+        if not file.seek(0, 2):
+            return BatchResult()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if width:
+                return validator.validate_fixed(mapped, width)
+            return validator.validate_lines(mapped)
+
+
+def write_results(path: str, results):
+    """Writes the result columns one after the other (valid flags, then
+    CARD_TYPES codes, then ERRORS codes; one byte per row each), the same
+    layout cc_pool.py uses in shared memory."""
+
+    with open(path, "wb") as file:
+        file.write(results.valid)
+        file.write(results.card_types)
+        file.write(results.errors)
+
+
+def summary(results):
+    """Returns the # of rows, valid cards and cards per error."""
+
+    counts = [results.errors.count(code) for code in range(len(ERRORS))]
+    return {"rows": len(results), "valid": counts[0],
+            "errors": {ERRORS[code]: count
+                       for code, count in enumerate(counts)
+                       if code and count}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Validate a large file of card numbers")
+    parser.add_argument("input", help="file with one card number per line")
+    parser.add_argument("-o", "--output",
+                        help="write the result columns here")
+    parser.add_argument("--width", type=int,
+                        help="fixed-width records of this many bytes "
+                             "(including any newline)")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = validate_path(args.input, args.width)
+    elapsed = time.perf_counter() - started
+    if args.output:
+        write_results(args.output, results)
+
+    report = summary(results)
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_sec"] = round(len(results) / elapsed) if elapsed else 0
+    print(json.dumps(report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""This is the result cache of the credit-card microservice.
+Written by: Michelle Mann
+
+Repeated cards (retries, recurring billing, stored cards being re-checked)
+can be answered from a bounded LRU cache instead of validating them again.
+Entries are keyed on a keyed BLAKE2 hash of the cleaned card # and the
+expiration date, so raw card numbers are never kept in memory; the key is
+random per process.
+"""
+
+import collections
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import cc_core
+from cc_core import format_cc
+
+
+# Rough bytes per entry on top of its key and result (OrderedDict node and
+# the entry tuple).
+ENTRY_OVERHEAD = 160
+
+
+class ValidationCache:
+    """Bounded cache in front of validate_card.
+
+    max_bytes - rough memory cap, least recently used entries go first.
+    ttl       - seconds an entry is kept. Results that depend on today's date
+                also expire when the month changes.
+    clock     - the ExpiryClock used for month changes (cc_core.CLOCK by
+                default).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600.0, clock=None,
+                 time_source=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock or cc_core.CLOCK
+        self.time_source = time_source
+        self.secret = os.urandom(32)
+        # key -> (expires, size, result)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, clean_cc: str, exp_date: str):
+        """Returns the keyed hash for a cleaned card # and expiration date."""
+        return hashlib.blake2b(f"{clean_cc}|{exp_date}".encode(),
+                               key=self.secret, digest_size=16).digest()
+
+    def expires(self, result: dict):
+        """Returns when a new result should expire (time_source clock)."""
+
+        expires = self.time_source() + self.ttl
+
+        # Results that got as far as the expiration date check only hold
+        # until the month changes.
+        if result.get("valid") or result.get("error") in ("Card Expired",
+                                                          "Invalid date "
+                                                          "format"):
+            month_left = self.clock.refresh_at - self.clock.time_source()
+            expires = min(expires, self.time_source() + month_left)
+        return expires
+
+    def card_key(self, card_number, exp_date):
+        """Returns the key for a raw card # and expiration date, or None if
+        they can't be cached (anything but strings)."""
+
+        if not isinstance(card_number, str) or not isinstance(exp_date, str):
+            return None
+        clean_cc = format_cc(card_number)
+        return self.key(clean_cc if clean_cc != -1 else "", exp_date)
+
+    def get(self, key):
+        """Returns a copy of the cached result for a key, or None if it isn't
+        cached (or has expired)."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > self.time_source():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[2])
+
+                self.remove(key)
+                self.expirations += 1
+            self.misses += 1
+        return None
+
+    def put(self, key, result: dict):
+        """Caches the validate_card result for a key."""
+
+        size = sys.getsizeof(key) + sys.getsizeof(result) + ENTRY_OVERHEAD + \
+            sum(sys.getsizeof(value) for value in result.values())
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (self.expires(result), size, dict(result))
+            self.size += size
+
+            # Least recently used entries go first.
+            while self.size > self.max_bytes and self.entries:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def validate(self, card_number, exp_date):
+        """Returns validate_card(card_number, exp_date), from the cache if it
+        was seen recently."""
+
+        # Anything but strings goes straight through (and fails as usual).
+        key = self.card_key(card_number, exp_date)
+        if key is None:
+            return cc_core.validate_card(card_number, exp_date)
+
+        result = self.get(key)
+        if result is None:
+            result = cc_core.validate_card(card_number, exp_date)
+            self.put(key, result)
+        return result
+
+    def remove(self, key):
+        """Drops an entry (lock must be held)."""
+        self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """Drops every entry, e.g. after the card type table is changed."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "entries": len(self.entries), "bytes": self.size}
@@ -0,0 +1,358 @@
+"""This is the client library of the credit-card microservice.
+Written by: Michelle Mann
+
+CardClient is a blocking client. It keeps a pool of connected REQ sockets on
+one shared context, so a request doesn't pay for setting up a socket, and
+follows the lazy pirate pattern: if no reply comes back within the timeout,
+the stuck REQ socket is thrown away and the request is retried on a new one.
+validate_many() splits a big list of cards into batch requests and keeps
+several of them in flight on a DEALER socket. Every request gets a random
+"request_id" that stays the same on retries, so a server that is still
+working on (or just answered) the first copy doesn't validate it again.
+
+AsyncCardClient is the asyncio version, with any number of requests in flight
+on a single DEALER socket.
+
+Example calls:
+    with CardClient("tcp://localhost:5557") as client:
+        client.validate("4111111111111111", "12/40")
+        client.validate_many([("4111111111111111", "12/40"), ...])
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+import time
+import uuid
+
+import zmq  # For ZeroMQ
+import zmq.asyncio
+
+from cc_service import OVERLOADED_ERROR
+
+
+def card_request(cc_number: str, exp_date: str):
+    return {"cc_number": cc_number, "exp_date": exp_date}
+
+
+def batch_request(cards):
+    """Returns a batch request for a list of (cc_number, exp_date) pairs."""
+    return {"cards": [card_request(*card) for card in cards]}
+
+
+def with_request_id(message):
+    """Returns a dict request with a new "request_id", unless it already has
+    one. It is sent with every retry of the request."""
+
+    if isinstance(message, dict) and "request_id" not in message:
+        message = dict(message, request_id=uuid.uuid4().hex)
+    return message
+
+
+def encode(message, timeout: float):
+    """Returns a request as JSON bytes. Dict requests get a "timeout_ms", so
+    the server doesn't bother with them once this client has given up. It's
+    counted from when the server gets the request, so the two clocks don't
+    need to agree."""
+
+    if isinstance(message, dict):
+        message = dict(message, timeout_ms=round(timeout * 1000))
+    return json.dumps(message).encode()
+
+
+def batches(cards, batch_size: int):
+    """Splits a list of cards into lists of up to batch_size cards."""
+    cards = list(cards)
+    return [cards[i:i + batch_size] for i in range(0, len(cards), batch_size)]
+
+
+def retry_after(reply):
+    """Returns the seconds to wait if the reply says the server is
+    overloaded, otherwise None."""
+
+    if isinstance(reply, dict) and reply.get("error") == OVERLOADED_ERROR:
+        return reply.get("retry_after", 0.1)
+    return None
+
+
+def batch_results(reply, count: int):
+    """Returns the card results of a batch reply. Whole-batch errors (i.e.
+    "Service overloaded" after all retries) are repeated for every card."""
+
+    if isinstance(reply, dict) and isinstance(reply.get("cards"), list):
+        return reply["cards"]
+    return [reply] * count
+
+
+# ------------ All related to the blocking client ----------- #
+
+class CardClient:
+    """Blocking client with pooled sockets.
+
+    address       - the server's address.
+    timeout       - seconds to wait for each reply.
+    retries       - times a request is sent again after a timeout or an
+                    overload reply, before TimeoutError is raised.
+    pool_size     - idle REQ sockets kept open for reuse.
+    batch_size    - cards per request in validate_many().
+    max_in_flight - batch requests validate_many() keeps in flight.
+    """
+
+    def __init__(self, address="tcp://localhost:5557", timeout=2.5,
+                 retries=3, pool_size=8, batch_size=500, max_in_flight=8,
+                 context=None):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.context = context or zmq.Context.instance()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.tags = itertools.count()
+
+    def connect(self, socket_type):
+        socket = self.context.socket(socket_type)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.address)
+        return socket
+
+    def checkout(self):
+        """Returns an idle REQ socket from the pool, or a new one."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect(zmq.REQ)
+
+    def checkin(self, socket):
+        """Puts a REQ socket back in the pool (or closes it if it's full)."""
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(socket)
+                return
+        socket.close()
+
+    def request(self, message):
+        """Sends a request (anything JSON can encode) and returns the decoded
+        reply. Raises TimeoutError if the server never answers."""
+
+        message = with_request_id(message)
+        wait = None
+        for _ in range(self.retries + 1):
+            socket = self.checkout()
+            socket.send(encode(message, self.timeout))
+
+            if socket.poll(self.timeout * 1000, zmq.POLLIN):
+                reply = json.loads(socket.recv())
+                self.checkin(socket)
+
+                # Waits as long as an overloaded server asks before retrying.
+                wait = retry_after(reply)
+                if wait is None:
+                    return reply
+                time.sleep(wait)
+                continue
+
+            # Lazy pirate - a REQ socket can't send again until it gets its
+            # reply, so it's closed and the request goes out on a new one.
+            socket.close()
+            wait = None
+
+        if wait is not None:
+            return reply
+        raise TimeoutError(f"No reply from {self.address} after "
+                           f"{self.retries + 1} tries")
+
+    def validate(self, cc_number: str, exp_date: str):
+        """Returns the validation result dict for one card."""
+        reply = self.request(card_request(cc_number, exp_date))
+        reply.pop("request_id", None)
+        return reply
+
+    def validate_many(self, cards):
+        """Returns the result dicts for a list of (cc_number, exp_date) pairs,
+        in order. Cards are sent batch_size at a time, with max_in_flight
+        batches in flight at once on a DEALER socket."""
+
+        chunks = batches(cards, self.batch_size)
+        requests = [with_request_id(batch_request(chunk)) for chunk in chunks]
+        results = [None] * len(chunks)
+        tries = [0] * len(chunks)
+        waiting = {}            # tag -> (chunk #, time sent)
+        queued = list(range(len(chunks)))[::-1]
+        resend_at = {}          # chunk # -> time an overloaded batch is due
+
+        socket = self.connect(zmq.DEALER)
+        try:
+            while queued or waiting or resend_at:
+                now = time.monotonic()
+                for i, due in list(resend_at.items()):
+                    if due <= now:
+                        del resend_at[i]
+                        queued.append(i)
+
+                # Step #1: Keeps up to max_in_flight batches in flight.
+                while queued and len(waiting) < self.max_in_flight:
+                    i = queued.pop()
+                    tag = next(self.tags).to_bytes(8, "little")
+                    socket.send_multipart([tag, b"", encode(requests[i],
+                                                            self.timeout)])
+                    waiting[tag] = (i, time.monotonic())
+
+                # Step #2: Collects replies, matched up by their tag frame.
+                if socket.poll(50, zmq.POLLIN):
+                    frames = socket.recv_multipart()
+                    if frames[0] not in waiting:
+                        continue    # Late reply to a batch already resent.
+                    i, _ = waiting.pop(frames[0])
+                    reply = json.loads(frames[-1])
+
+                    wait = retry_after(reply)
+                    if wait is not None and tries[i] < self.retries:
+                        tries[i] += 1
+                        resend_at[i] = time.monotonic() + wait
+                    else:
+                        results[i] = batch_results(reply, len(chunks[i]))
+
+                # Step #3: Sends batches that timed out again.
+                now = time.monotonic()
+                for tag, (i, sent) in list(waiting.items()):
+                    if now - sent >= self.timeout:
+                        del waiting[tag]
+                        tries[i] += 1
+                        if tries[i] > self.retries:
+                            raise TimeoutError(
+                                f"No reply from {self.address} after "
+                                f"{self.retries + 1} tries")
+                        queued.append(i)
+        finally:
+            socket.close()
+
+        return [result for chunk in results for result in chunk]
+
+    def close(self):
+        """Closes the pooled sockets."""
+        with self.lock:
+            for socket in self.idle:
+                socket.close()
+            self.idle = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ------------ All related to the asyncio client ----------- #
+
+class AsyncCardClient:
+    """Asyncio client with many requests in flight on one DEALER socket.
+    Replies are matched to requests with a tag frame, so they can come back
+    in any order. Takes the same options as CardClient."""
+
+    def __init__(self, address="tcp://localhost:5557", timeout=2.5,
+                 retries=3, batch_size=500, max_in_flight=100, context=None):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.context = context or zmq.asyncio.Context.instance()
+        self.socket = None
+        self.reader = None
+        self.in_flight = None
+        self.pending = {}       # tag -> future for the reply
+        self.tags = itertools.count()
+
+    def start(self):
+        """Connects the socket and starts reading replies (done on the first
+        request)."""
+
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.reader = asyncio.create_task(self.read_replies())
+
+    async def read_replies(self):
+        """Hands each reply to the request waiting for its tag."""
+
+        while True:
+            frames = await self.socket.recv_multipart()
+            future = self.pending.get(frames[0])
+            if future is not None and not future.done():
+                future.set_result(frames[-1])
+
+    async def send(self, message):
+        """Sends one request and waits up to timeout for its reply."""
+
+        tag = next(self.tags).to_bytes(8, "little")
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = future
+        try:
+            await self.socket.send_multipart([tag, b"",
+                                              encode(message, self.timeout)])
+            return json.loads(await asyncio.wait_for(future, self.timeout))
+        finally:
+            del self.pending[tag]
+
+    async def request(self, message):
+        """Sends a request (anything JSON can encode) and returns the decoded
+        reply. Raises TimeoutError if the server never answers."""
+
+        if self.socket is None:
+            self.start()
+
+        message = with_request_id(message)
+        wait = None
+        async with self.in_flight:
+            for _ in range(self.retries + 1):
+                try:
+                    reply = await self.send(message)
+                except asyncio.TimeoutError:
+                    wait = None
+                    continue
+
+                wait = retry_after(reply)
+                if wait is None:
+                    return reply
+                await asyncio.sleep(wait)
+
+        if wait is not None:
+            return reply
+        raise TimeoutError(f"No reply from {self.address} after "
+                           f"{self.retries + 1} tries")
+
+    async def validate(self, cc_number: str, exp_date: str):
+        """Returns the validation result dict for one card."""
+        reply = await self.request(card_request(cc_number, exp_date))
+        reply.pop("request_id", None)
+        return reply
+
+    async def validate_many(self, cards):
+        """Returns the result dicts for a list of (cc_number, exp_date) pairs,
+        in order, sent as batches of batch_size cards all at once."""
+
+        chunks = batches(cards, self.batch_size)
+        replies = await asyncio.gather(*[
+            self.request(batch_request(chunk))
+            for chunk in chunks])
+        return [result for chunk, reply in zip(chunks, replies)
+                for result in batch_results(reply, len(chunk))]
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,372 @@
+"""This is the cluster mode of the credit-card microservice.
+Written by: Michelle Mann
+
+Spreads requests over any number of cc_service.py nodes, on this host or
+others. A ClusterBroker takes requests from clients on the usual ROUTER
+front end, and nodes connect to its back end (another ROUTER) with a DEALER
+socket, say how many requests they take at once, and then trade heartbeats
+with the broker. Each request goes to the node with the most room. A node
+that stops sending heartbeats is removed, and the requests it still had are
+sent to other nodes. A node that stops hearing from the broker reconnects,
+so either side can be restarted. REQ clients don't need any changes.
+
+Nodes validate on a worker thread, so they keep sending heartbeats during a
+long batch. A request that was sent to max_dispatches nodes that all died on
+it gets an "Unexpected error" reply instead of going to the next node.
+
+Example calls (capacity is added by starting more nodes):
+    python3 cc_service.py --bind tcp://*:5557 --cluster tcp://*:5558
+    python3 cc_service.py --join tcp://broker-host:5558
+    python3 cc_service.py --join tcp://broker-host:5558 --capacity 4
+"""
+
+import collections
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import zmq  # For ZeroMQ
+
+import cc_core
+from cc_dedup import PENDING, request_key
+from cc_logging import log
+from cc_service import OVERLOADED_ERROR, error_reply, safe_respond
+
+
+# Node -> broker: READY capacity, HEARTBEAT, REPLY tag reply.
+# Broker -> node: REQUEST tag message waited, HEARTBEAT, DISCONNECT. waited
+# is the milliseconds the request spent at the broker, which count against
+# its "timeout_ms".
+READY = b"READY"
+HEARTBEAT = b"HEARTBEAT"
+REQUEST = b"REQUEST"
+REPLY = b"REPLY"
+DISCONNECT = b"DISCONNECT"
+
+
+# ------------ All related to the nodes ----------- #
+
+def start_node(broker="tcp://localhost:5558", capacity=1, heartbeat=1.0,
+               liveness=3, metrics=None):
+    """Runs a validation node for the broker at the given back end address,
+    until the broker sends DISCONNECT. Up to capacity requests are sent to
+    it at once. If nothing comes from the broker for liveness heartbeats,
+    the node reconnects. If a cc_metrics.Metrics is given, every stage of
+    the request is timed."""
+
+    if metrics is not None:
+        metrics.instrument_stages(cc_core)
+
+    # Requests are validated (in order) on a worker thread, so heartbeats
+    # keep going out while a big batch is validated.
+    executor = ThreadPoolExecutor(1)
+    context = zmq.Context()
+    running = True
+
+    while running:
+        # Step #1: Connect and tell the broker how much work to send.
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(broker)
+        socket.send_multipart([READY, str(capacity).encode()])
+        log.info("Node joined the broker at %s...", broker)
+
+        broker_expires = time.monotonic() + heartbeat * liveness
+        next_heartbeat = time.monotonic() + heartbeat
+        working = collections.deque()   # (tag, future of the reply)
+
+        # Step #2: Answer requests and heartbeats until the broker goes
+        # quiet or says goodbye.
+        while True:
+            timeout = max(0, next_heartbeat - time.monotonic())
+            if working:
+                timeout = min(timeout, 0.005)   # Check on the worker often.
+            if socket.poll(timeout * 1000, zmq.POLLIN):
+                frames = socket.recv_multipart()
+                broker_expires = time.monotonic() + heartbeat * liveness
+
+                if frames[0] == REQUEST:
+                    received = time.monotonic()
+                    if len(frames) > 3:
+                        received -= int(frames[3]) / 1000
+                    working.append((frames[1], executor.submit(
+                        safe_respond, frames[2], metrics, received)))
+                elif frames[0] == DISCONNECT:
+                    running = False
+                    break
+
+            # An empty reply frees the slot without answering a request that
+            # is past its deadline.
+            while working and working[0][1].done():
+                tag, future = working.popleft()
+                socket.send_multipart([REPLY, tag, future.result() or b""])
+
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                socket.send_multipart([HEARTBEAT])
+                next_heartbeat = now + heartbeat
+            if now >= broker_expires:
+                log.warning("No heartbeat from the broker, reconnecting...")
+                break
+
+        socket.close()
+
+    # Make a clean exit.
+    executor.shutdown()
+    if metrics is not None:
+        metrics.restore_stages()
+    context.term()
+
+
+# ------------ All related to the broker ----------- #
+
+class Node:
+    """A node connected to the broker."""
+
+    def __init__(self, identity: bytes, capacity: int, expires: float):
+        self.identity = identity
+        self.capacity = max(1, capacity)
+        self.expires = expires
+        self.in_flight = set()      # tags of requests sent to the node
+
+    def load(self):
+        return len(self.in_flight) / self.capacity
+
+
+class ClusterBroker:
+    """Front end for a cluster of nodes.
+
+    bind      - address the clients connect to.
+    backend   - address the nodes connect to.
+    heartbeat - seconds between heartbeats.
+    liveness  - heartbeats a node can miss before it's removed.
+    max_queue - requests waiting for a free node before new ones get a
+                "Service overloaded" reply.
+    dedup     - optional cc_dedup.RequestDedup. Copies of a request with a
+                "request_id" then wait for the first copy's reply instead of
+                going to a node again.
+    max_dispatches - nodes a request is sent to before it's given up on (if
+                     they were all removed while it was in flight).
+    """
+
+    def __init__(self, bind="tcp://*:5557", backend="tcp://*:5558",
+                 heartbeat=1.0, liveness=3, max_queue=10000, dedup=None,
+                 max_dispatches=3):
+        self.bind = bind
+        self.backend = backend
+        self.heartbeat = heartbeat
+        self.liveness = liveness
+        self.max_queue = max_queue
+        self.dedup = dedup
+        self.max_dispatches = max_dispatches
+
+        self.nodes = {}                     # identity -> Node
+        self.requests = {}                  # tag -> (address, message, node)
+        self.queue = collections.deque()    # tags waiting for a node
+        self.keys = {}                      # tag -> cc_dedup key
+        # tag -> time.monotonic() the request came in
+        self.received = {}
+        self.dispatches = collections.Counter()     # tag -> nodes sent to
+        self.failed = []                    # tags given up on, to answer
+        self.tags = itertools.count()
+
+    def least_loaded(self):
+        """Returns the node with the most room, or None if they're all
+        full."""
+
+        free = [node for node in self.nodes.values()
+                if len(node.in_flight) < node.capacity]
+        return min(free, key=Node.load, default=None)
+
+    def dispatch(self, socket):
+        """Sends queued requests to nodes while any have room."""
+
+        while self.queue:
+            node = self.least_loaded()
+            if node is None:
+                return
+
+            tag = self.queue.popleft()
+            address, message, _ = self.requests[tag]
+            self.requests[tag] = (address, message, node)
+            node.in_flight.add(tag)
+            self.dispatches[tag] += 1
+            waited = (time.monotonic() - self.received[tag]) * 1000
+            socket.send_multipart([node.identity, REQUEST, tag, message,
+                                   str(int(waited)).encode()])
+
+    def remove(self, node):
+        """Removes a node, putting its unanswered requests back at the front
+        of the queue (in their original order). Requests that have already
+        been sent to max_dispatches nodes are given up on instead, in case
+        it was the request that took the nodes down."""
+
+        del self.nodes[node.identity]
+        for tag in sorted(node.in_flight, reverse=True):
+            if self.dispatches[tag] >= self.max_dispatches:
+                self.failed.append(tag)
+            else:
+                self.queue.appendleft(tag)
+        log.warning("Removed node %s with %d requests in flight",
+                    node.identity.hex(), len(node.in_flight))
+
+    def handle_node(self, frames, frontend):
+        """Handles one message from a node."""
+
+        identity, command = frames[0], frames[1]
+        node = self.nodes.get(identity)
+        expires = time.monotonic() + self.heartbeat * self.liveness
+
+        if command == READY:
+            if node is not None:
+                self.remove(node)
+            self.nodes[identity] = Node(identity, int(frames[2]), expires)
+            log.info("Node %s joined with capacity %s", identity.hex(),
+                     frames[2].decode())
+            return
+
+        # Nodes the broker doesn't know (i.e. from before a restart) stop
+        # getting heartbeats and so reconnect with READY.
+        if node is None:
+            return
+        node.expires = expires
+
+        if command == REPLY:
+            tag, reply = frames[2], frames[3]
+            node.in_flight.discard(tag)
+            request = self.requests.get(tag)
+
+            # Late replies from a node that was already given up on are
+            # dropped, the request has gone to another node.
+            if request is not None and request[2] is node:
+                self.answer(tag, reply, frontend)
+
+    def answer(self, tag, reply: bytes, frontend):
+        """Sends the reply to a request (b"" for none) back to its client,
+        and to any copies of it waiting."""
+
+        address, _, _ = self.requests.pop(tag)
+        del self.dispatches[tag]
+        del self.received[tag]
+        addresses = [address]
+        key = self.keys.pop(tag, None)
+        if key is not None:
+            # Past its deadline, a later copy of the request may still be
+            # wanted.
+            copy = None if reply else self.dedup.retry(key)
+            if copy is not None:
+                self.enqueue(*copy, key)
+                return
+            addresses += self.dedup.finish(key, reply or None)
+
+        if reply:
+            for address in addresses:
+                frontend.send_multipart(address + [reply])
+
+    def enqueue(self, address, message, key=None):
+        """Queues a request for the next free node."""
+
+        tag = next(self.tags).to_bytes(8, "big")
+        self.requests[tag] = (address, message, None)
+        self.received[tag] = time.monotonic()
+        self.queue.append(tag)
+        if key is not None:
+            self.keys[tag] = key
+
+    def receive(self, frontend):
+        """Handles one request from a client. Returns False on 'Q'."""
+
+        frames = frontend.recv_multipart()
+        address, message = frames[:-1], frames[-1]
+
+        # Client asked server to quit
+        if message == b"Q":
+            return False
+
+        # Retries are answered from the first copy of the request.
+        key = None
+        if self.dedup is not None:
+            key = request_key(message)
+            if key is not None:
+                reply = self.dedup.check(key, address, message)
+                if reply is not None:
+                    if reply is not PENDING:
+                        frontend.send_multipart(address + [reply])
+                    return True
+
+        if len(self.queue) >= self.max_queue:
+            frontend.send_multipart(address + [error_reply(
+                message, OVERLOADED_ERROR, retry_after=self.heartbeat)])
+            return True
+
+        if key is not None:
+            self.dedup.start(key)
+        self.enqueue(address, message, key)
+        return True
+
+    def serve(self):
+        """Runs the broker until a 'Q' message is received, then tells the
+        nodes to disconnect."""
+
+        # Step #1: Front end for the clients, back end for the nodes.
+        context = zmq.Context()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(self.bind)
+        backend = context.socket(zmq.ROUTER)
+        backend.bind(self.backend)
+        log.info("Cluster broker is running on %s, nodes join on %s...",
+                 self.bind, self.backend)
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        next_heartbeat = time.monotonic() + self.heartbeat
+
+        # Step #2: Queue requests, pass them to nodes and keep the node list
+        # up to date.
+        while True:
+            try:
+                timeout = max(0, next_heartbeat - time.monotonic())
+                events = dict(poller.poll(timeout * 1000))
+
+                if backend in events:
+                    self.handle_node(backend.recv_multipart(), frontend)
+
+                if frontend in events and not self.receive(frontend):
+                    break
+
+                # Step #3: Heartbeats out, silent nodes removed.
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    for node in list(self.nodes.values()):
+                        if now >= node.expires:
+                            self.remove(node)
+                        else:
+                            backend.send_multipart([node.identity,
+                                                    HEARTBEAT])
+                    next_heartbeat = now + self.heartbeat
+
+                # Requests given up on get an error instead of a node.
+                while self.failed:
+                    tag = self.failed.pop()
+                    self.answer(tag, error_reply(self.requests[tag][1],
+                                                 "Unexpected error"),
+                                frontend)
+
+                self.dispatch(backend)
+
+            # Handle server errors.
+            except Exception as e:
+                log.exception("Unexpected error occurred: %s", e)
+
+        # Step #4: Tell the nodes to stop and make a clean exit.
+        for identity in self.nodes:
+            backend.send_multipart([identity, DISCONNECT])
+        frontend.close(linger=0)
+        backend.close(linger=1000)
+        context.term()
+
+
+def start_cluster_broker(bind="tcp://*:5557", backend="tcp://*:5558",
+                         heartbeat=1.0, liveness=3, dedup=None):
+    """Runs a ClusterBroker until a 'Q' message is received."""
+    ClusterBroker(bind, backend, heartbeat, liveness, dedup=dedup).serve()
@@ -0,0 +1,329 @@
+"""This is the validation core of the credit-card microservice.
+Written by: Michelle Mann
+
+Everything needed to validate a card in-process (validate_card and its
+steps, the error codes and the expiry clock) with no networking and nothing
+outside the standard library, so it imports quickly and works where ZeroMQ
+isn't installed:
+
+    from cc_core import validate_card
+    validate_card("4111111111111111", "12/40")
+
+The card type table (bin_table.py) is loaded the first time it's used.
+cc_service.py re-exports all of this next to the server.
+"""
+
+import time
+
+import bin_table
+from bin_table import CARD_TYPES
+
+# Error sent back when a request is missing the "cc_number" / "exp_date" keys.
+HEADER_ERROR = "Incorrect message headers for service"
+OVERLOADED_ERROR = "Service overloaded"
+DEADLINE_ERROR = "Deadline exceeded"
+
+# validate_card errors, then request errors, in a fixed order so bulk
+# validation and binary replies can send them as small integer codes (0 means
+# no error). Card types are in CARD_TYPES.
+ERRORS = ("", "Invalid card format", "Unknown card header", "Incorrect length",
+          "Invalid checksum", "Invalid date format", "Card Expired",
+          "Invalid JSON format", HEADER_ERROR, "Invalid batch format",
+          "Unexpected error", "Invalid message format", OVERLOADED_ERROR,
+          DEADLINE_ERROR)
+
+# Codes of the validate_card errors.
+BAD_FORMAT = ERRORS.index("Invalid card format")
+BAD_HEADER = ERRORS.index("Unknown card header")
+BAD_LENGTH = ERRORS.index("Incorrect length")
+BAD_CHECKSUM = ERRORS.index("Invalid checksum")
+BAD_DATE = ERRORS.index("Invalid date format")
+EXPIRED = ERRORS.index("Card Expired")
+
+
+# ------------ All functions related to cc checker ----------- #
+def format_cc(cc_number: str):
+    """Returns useable cc_number as a string, but without whitespace, dashes or
+    alpha characters (if exist)"""
+
+    # Removes all non-digits (any unicode digit counts, as with a regex \d),
+    # returns -1 if incorrect.
+    clean_cc_number = "".join(filter(str.isdecimal, cc_number))
+    return clean_cc_number if clean_cc_number else -1
+
+
+def validate_card_type(cc_number: str):
+    """Returns type of credit card (if valid). If not, returns error.
+
+    Card types come from the header table in bin_table.py. By default MC,
+    Visa, or AmEx cards have the following headers / lengths:
+        Visa - 4 is first digit (16 digits)
+        MC - 51-55 or 2221 - 2720 (16 digits)
+        AmEx - 34 or 37 (15 digits)
+    """
+
+    match = bin_table.TABLE.lookup(cc_number)
+    return match[0] if match else -1
+
+
+def valid_card_length(cc_number: str, card_type: str):
+    """Returns card type if card is still valid after length check, otherwise
+    returns False"""
+
+    # Visa and MC cards have 16 digits, Amex has 15 (see bin_table.py)
+    valid_lengths = bin_table.TABLE.lengths.get(card_type, ())
+    return len(cc_number) in valid_lengths
+
+
+def validate_luhn(cc_number: str):
+    """Does checsum digit check to test validity of credit card numbers.
+     Returns True if valid card, returns False otherwise."""
+
+    # Creation of a list of digits from the string cc_number.
+    digits = [int(d) for d in str(cc_number)]
+
+    # Stores the last digit of the string - this is the listed Luhn's #
+    last_digit = digits.pop()
+
+    # Loops through the rest of the list backwards, skipping every other #.
+    for i in range(len(digits) - 1, -1, -2):
+
+        # Multiples that digit by 2.
+        digits[i] *= 2
+
+        # If the resulting doubling is greater than 9, subtract 9
+        if digits[i] > 9:
+            digits[i] -= 9
+
+    # We're now looking for the highest multiple of 10 that when subtracted by
+    # our total, the result is <= 9.
+    total = sum(digits)
+    check_digit = (10 - (total % 10)) % 10
+
+    # We return if this is equal to the last digit listed (or not)
+    return check_digit == last_digit
+
+
+# Digit characters and their values, and the Luhn doubling of each digit
+# (2 * d, minus 9 if over 9).
+DIGIT_VALUES = {str(d): d for d in range(10)}
+LUHN_DOUBLE = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+# Digits kept for the card type lookup (the longest header in bin_table.py).
+HEADER_DIGITS = 6
+
+
+def scan_card(cc_number: str):
+    """Single pass over a raw card # that skips separators, counts the digits,
+    keeps the first few for the card type lookup and adds up the Luhn sum.
+    Returns (# of digits, header, Luhn check passed), the same answers as
+    format_cc, validate_card_type and validate_luhn give on their own."""
+
+    if not isinstance(cc_number, str):
+        raise TypeError(f"expected a str card number, got "
+                        f"{type(cc_number).__name__}")
+
+    length = 0
+    header = ""
+
+    # Which digits get doubled depends on the length, which isn't known until
+    # the end -- so keep the sum for doubling the even and the odd positions.
+    even_doubled = 0
+    odd_doubled = 0
+
+    # Local names are faster to look up inside the loop.
+    value_of = DIGIT_VALUES.get
+    double = LUHN_DOUBLE
+
+    for char in cc_number:
+        digit = value_of(char)
+        if digit is None:
+            # Skips separators, but counts any other unicode digit the way
+            # format_cc's regex does.
+            if not char.isdecimal():
+                continue
+            digit = int(char)
+
+        if length < HEADER_DIGITS:
+            header += char
+
+        if length & 1:
+            even_doubled += digit
+            odd_doubled += double[digit]
+        else:
+            even_doubled += double[digit]
+            odd_doubled += digit
+        length += 1
+
+    # Counting back from the check digit, every other digit is doubled.
+    total = even_doubled if length % 2 == 0 else odd_doubled
+    return length, header, total % 10 == 0
+
+
+class ExpiryClock:
+    """Keeps the current year / month and the century cutoff for
+    validate_expiration. They're worked out once and only again when a new
+    month starts.
+
+    time_source     - returns the current time as a timestamp. Tests can pass
+                      a function returning a fixed time to freeze the clock.
+    accept_long_year - also accept MM/YYYY dates (rejected by default).
+    """
+
+    def __init__(self, time_source=time.time, accept_long_year=False):
+        self.time_source = time_source
+        self.accept_long_year = accept_long_year
+        self.refresh()
+
+    def refresh(self):
+        """Works out today's month and when the next month starts."""
+
+        today = time.localtime(self.time_source())
+        self.current_year = today.tm_year
+        self.current_month = today.tm_mon
+
+        # Determine century -- 2 digit years before the cutoff are 20YY.
+        self.cutoff_year = self.current_year % 100 + 20  # a little in future
+
+        # Months since year 0, so a date check is a single comparison.
+        self.current = self.current_year * 12 + self.current_month
+
+        # Midnight (local time) on the 1st of next month.
+        self.refresh_at = time.mktime(
+            (self.current_year + self.current_month // 12,
+             self.current_month % 12 + 1, 1, 0, 0, 0, 0, 0, -1))
+
+    def not_expired(self, exp_month: int, exp_year: int, long_year=False):
+        """Returns True if the card is still valid this month. exp_year is 2
+        digits unless long_year is True."""
+
+        if self.time_source() >= self.refresh_at:
+            self.refresh()
+
+        if not long_year:
+            exp_year += 2000 if exp_year < self.cutoff_year else 1900
+        return exp_year * 12 + exp_month >= self.current
+
+
+# The clock used by validate_expiration unless another one is passed in.
+CLOCK = ExpiryClock()
+
+
+def parse_exp_date(exp_date: str, accept_long_year=False):
+    """Single pass parse of a MM/YY date into (month, year, long_year).
+    Returns None if the date isn't in that format (or MM/YYYY, if accepted).
+    MM is 1 or 2 digits between 1 and 12."""
+
+    slash = exp_date.find("/")
+    if slash not in (1, 2):
+        return None
+
+    month = exp_date[:slash]
+    year = exp_date[slash + 1:]
+    if not (month.isascii() and month.isdecimal() and year.isdecimal()):
+        return None
+
+    long_year = len(year) == 4 and accept_long_year
+    if len(year) != 2 and not long_year:
+        return None
+
+    exp_month = int(month)
+    if not 1 <= exp_month <= 12:
+        return None
+    return exp_month, int(year), long_year
+
+
+def validate_expiration(exp_date: str, clock=None):
+    """Takes a user-input expiration date as a string and returns True for
+    valid or False for invalid. Valid dates are input as MM/YY. Returns -1 if
+    the date isn't in that format."""
+
+    clock = clock or CLOCK
+
+    # Parse month and year details from user-entered exp_date
+    parsed = parse_exp_date(exp_date, clock.accept_long_year)
+    if parsed is None:
+        return -1
+
+    # Compare properly formatted date to today, if it's not in the future,
+    # return False, otherwise, True.
+    return clock.not_expired(*parsed)
+
+# ------------ All functions related to cc checker ----------- #
+
+
+def card_codes(card_number, exp_date):
+    """Runs the cc_validation rules and returns (card type code, error code)
+    (see CARD_TYPES and ERRORS; error 0 means valid). validate_card builds
+    its result dict from these, and batches keep them as they are (see
+    cc_results.py)."""
+
+    # Single pass over the card # that does the work of format_cc and
+    # validate_luhn, and keeps the header for the card type lookup.
+    length, header, luhn_valid = scan_card(card_number)
+
+    # Attempts to format card, fails if there are no digits.
+    if not length:
+        return 0, BAD_FORMAT
+
+    # Attempts to determine card type, fails if the header is unknown.
+    card_type = validate_card_type(header)
+    if card_type == -1:
+        return 0, BAD_HEADER
+    code = CARD_TYPES.index(card_type)
+
+    # Attempts to validate card length based on card type.
+    if length not in bin_table.TABLE.lengths[card_type]:
+        return code, BAD_LENGTH
+
+    # Attempts to validate checksum value.
+    if not luhn_valid:
+        return code, BAD_CHECKSUM
+
+    # Attempts to validate expiration date.
+    valid_date = validate_expiration(exp_date)
+    if valid_date == -1:
+        return code, BAD_DATE
+    if not valid_date:
+        return code, EXPIRED
+
+    # Valid card.
+    return code, 0
+
+
+def validate_card(card_number, exp_date):
+    """Returns message responses cc_validation rules"""
+    return result_from_codes(*card_codes(card_number, exp_date))
+
+
+def result_from_codes(card_type: int, error: int):
+    """Returns the same dict validate_card would, built from a CARD_TYPES code
+    and an ERRORS code."""
+
+    if not error:
+        return {"valid": True, "card_type": CARD_TYPES[card_type],
+                "valid_exp": "Valid"}
+
+    results = {"valid": False}
+
+    # The card type is only known once the header check has passed.
+    if card_type:
+        results["card_type"] = CARD_TYPES[card_type]
+    results["error"] = ERRORS[error]
+    return results
+
+
+def result_codes(results: dict):
+    """Returns (card type code, error code) for a validate_card (or request
+    error) result dict, the reverse of result_from_codes."""
+
+    # Unexpected errors carry their exception message, so don't match as is.
+    error = results.get("error", "")
+    if error not in ERRORS:
+        error = "Unexpected error"
+
+    # Requests can echo back a "card_type" of their own, which isn't one.
+    card_type = results.get("card_type", "")
+    if card_type not in CARD_TYPES:
+        card_type = ""
+    return CARD_TYPES.index(card_type), ERRORS.index(error)
@@ -0,0 +1,164 @@
+"""This is the request de-duplication of the credit-card microservice.
+Written by: Michelle Mann
+
+Clients retry requests that time out, and they time out most when the server
+is already busy, so every retry adds load right when there's none to spare.
+A request can carry a "request_id" (str or int), kept the same on every retry
+of it. While a request is being processed, copies of it wait for its reply
+instead of being validated again, and for a while after it's answered copies
+get the stored reply right away.
+
+Only identical requests are matched: the raw request must be the same apart
+from its "deadline" / "timeout_ms", so a reused id never gets someone else's
+reply. Keys are a keyed hash of those bytes (the key is random per process),
+so requests aren't decoded or kept to be matched.
+
+Stored replies echo the request's card #s, like the replies sent, and copies
+waiting on an in-flight request are kept as they are, since they may still
+need to be processed. Both are held in memory only, replies for ttl seconds
+at most; a ttl of 0 turns de-duplication off.
+"""
+
+import collections
+import hashlib
+import os
+import re
+import sys
+import time
+
+import cc_wire
+
+
+# Returned by RequestDedup.check when a copy of the request is in progress.
+PENDING = object()
+
+# Hash key for request keys, random per process.
+SECRET = os.urandom(32)
+
+# A "request_id" key with a str or int value, in JSON and in MessagePack
+# (a fixstr key, then a str or int).
+JSON_REQUEST_ID = re.compile(rb'"request_id"\s*:\s*["0-9-]')
+MSGPACK_REQUEST_ID = re.compile(
+    rb"\xaarequest_id[\x00-\x7f\xa0-\xbf\xcc-\xd3\xd9-\xdb\xe0-\xff]")
+
+# The "deadline" and "timeout_ms" keys and their numbers, which can change on
+# every retry.
+JSON_DEADLINE = re.compile(
+    rb'"(?:deadline|timeout_ms)"\s*:\s*-?[0-9][0-9.eE+-]*')
+MSGPACK_DEADLINE = re.compile(
+    rb"(?:\xa8deadline|\xaatimeout_ms)(?:[\x00-\x7f\xe0-\xff]|[\xcc\xd0].|"
+    rb"[\xcd\xd1].{2}|[\xca\xce\xd2].{4}|[\xcb\xcf\xd3].{8})", re.DOTALL)
+
+# Rough bytes per stored reply on top of the reply itself (OrderedDict node,
+# key and entry tuple).
+ENTRY_OVERHEAD = 200
+
+
+def request_key(message: bytes):
+    """Returns the key of a raw request with a "request_id", or None for
+    requests without one."""
+
+    tag = message[:1]
+    if tag == cc_wire.MSGPACK_TAG:
+        request_id, deadline = MSGPACK_REQUEST_ID, MSGPACK_DEADLINE
+    elif tag == cc_wire.STRUCT_TAG:
+        return None
+    else:
+        request_id, deadline = JSON_REQUEST_ID, JSON_DEADLINE
+
+    # Cheap check first, so requests without an id cost next to nothing.
+    if b"request_id" not in message or not request_id.search(message):
+        return None
+
+    # Retries can have a new deadline, everything else must match.
+    return hashlib.blake2b(deadline.sub(b"", message), key=SECRET,
+                           digest_size=16).digest()
+
+
+class RequestDedup:
+    """Coalesces copies of in-flight requests and replays recent replies.
+
+    max_entries - replies kept for replaying; the oldest go first.
+    ttl         - seconds a reply is kept for replaying.
+    max_bytes   - rough memory cap of the kept replies; the oldest go first.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30.0, max_bytes=16 * 1024 * 1024,
+                 time_source=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.time_source = time_source
+
+        self.in_flight = {}                         # key -> [(address, msg)]
+        # key -> (expires, size, reply)
+        self.completed = collections.OrderedDict()
+        self.size = 0
+
+        self.coalesced = 0
+        self.replayed = 0
+
+    def check(self, key, address, message: bytes):
+        """Looks up a request before it's processed. Returns the stored reply
+        if it was answered recently, or PENDING if a copy is in progress (the
+        address is then given to finish). Returns None for a new request,
+        which the caller processes after calling start."""
+
+        waiting = self.in_flight.get(key)
+        if waiting is not None:
+            waiting.append((address, message))
+            self.coalesced += 1
+            return PENDING
+
+        self.expire()
+        entry = self.completed.get(key)
+        if entry is not None:
+            self.replayed += 1
+            return entry[2]
+        return None
+
+    def start(self, key):
+        """Marks a request as in progress."""
+        self.in_flight.setdefault(key, [])
+
+    def retry(self, key):
+        """Returns the newest waiting copy of a request as (address, message),
+        or None. Used when the request's deadline passed before it was
+        processed, since the copies (sent later) may still be wanted."""
+
+        waiting = self.in_flight.get(key)
+        return waiting.pop() if waiting else None
+
+    def finish(self, key, reply):
+        """Stores the reply of a finished request (None if it wasn't answered)
+        and returns the addresses of the copies waiting for it."""
+
+        waiting = self.in_flight.pop(key, [])
+        if reply is not None:
+            if key in self.completed:
+                self.remove(key)
+            size = sys.getsizeof(reply) + ENTRY_OVERHEAD
+            self.completed[key] = (self.time_source() + self.ttl, size, reply)
+            self.size += size
+
+            while self.completed and (len(self.completed) > self.max_entries
+                                      or self.size > self.max_bytes):
+                self.remove(next(iter(self.completed)))
+        return [address for address, _ in waiting]
+
+    def expire(self):
+        """Drops replies older than ttl (the oldest are first)."""
+
+        now = self.time_source()
+        while self.completed:
+            key, (expires, _, _) = next(iter(self.completed.items()))
+            if expires > now:
+                return
+            self.remove(key)
+
+    def remove(self, key):
+        """Drops a stored reply."""
+        self.size -= self.completed.pop(key)[1]
+
+    def __len__(self):
+        return len(self.completed)
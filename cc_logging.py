@@ -0,0 +1,93 @@
+"""This is the logging setup for the credit-card microservice.
+Written by: Michelle Mann
+
+Log records are put on a queue and written by a background thread, so the
+server never waits on stdout / stderr. Per-request logs are sampled (off by
+default) and card numbers are masked before they are logged.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+
+# Server events (startup, errors, ...).
+log = logging.getLogger("cc_service")
+
+# Sampled per-request logs.
+request_log = logging.getLogger("cc_service.requests")
+
+# Fraction of requests logged by log_request.
+sample_rate = 0.0
+
+
+def mask_card(cc_number):
+    """Returns a card # with every digit but the last 4 replaced by '*'. The
+    digits are the ones scan_card counts (separators of any kind are
+    dropped), so the card # can't leak however it was written."""
+
+    digits = [char for char in str(cc_number) if char.isdecimal()]
+    return "*" * (len(digits) - 4) + "".join(digits[-4:])
+
+
+def mask_request(request):
+    """Returns a copy of a decoded request or reply with its "cc_number"
+    values masked, including those of the cards in a batch."""
+
+    if isinstance(request, list):
+        return [mask_request(card) for card in request]
+    if not isinstance(request, dict):
+        return request
+
+    masked = dict(request)
+    if "cc_number" in masked:
+        masked["cc_number"] = mask_card(masked["cc_number"])
+    if isinstance(masked.get("cards"), list):
+        masked["cards"] = mask_request(masked["cards"])
+    return masked
+
+
+def sampled():
+    """Returns True if this request should be logged."""
+
+    return sample_rate > 0 and request_log.isEnabledFor(logging.INFO) and \
+        (sample_rate >= 1 or random.random() < sample_rate)
+
+
+def log_request(request: bytes, reply):
+    """Logs a raw request and its reply with the cc_number fields masked, if
+    this request is sampled. Requests that aren't JSON can't be masked, so
+    only their size is logged."""
+
+    if not sampled():
+        return
+
+    try:
+        request = mask_request(json.loads(request))
+    except ValueError:
+        request = f"<{len(request)} bytes, not JSON>"
+    request_log.info("Request: %s -> reply: %s", request, mask_request(reply))
+
+
+def setup_logging(level="INFO", sample=0.0):
+    """Sends the microservice's logs to stderr through a queue, and logs the
+    given fraction of requests. Returns the QueueListener; call stop() on it
+    before exiting to flush the queue."""
+
+    global sample_rate
+    sample_rate = sample
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+
+    log.setLevel(level)
+    log.handlers.clear()
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.propagate = False
+    listener.start()
+    return listener
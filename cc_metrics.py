@@ -0,0 +1,218 @@
+"""This is the metrics side of the credit-card microservice.
+Written by: Michelle Mann
+
+Keeps latency histograms for each stage of validate_card, JSON decode /
+encode and the time spent waiting on the socket, plus request and error
+counters and a throughput gauge. Everything can be served in Prometheus text
+format over HTTP, e.g. http://127.0.0.1:9557/metrics
+"""
+
+import bisect
+import collections
+import functools
+import http.server
+import threading
+import time
+
+
+# The steps of validate_card that get timed. scan_card does the work of
+# format_cc, valid_card_length's counting and validate_luhn in one pass.
+STAGES = ("scan_card", "validate_card_type", "validate_expiration")
+
+# Histogram bucket upper bounds in seconds: 1us doubling up to ~16s.
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))
+
+# Quantiles reported for every histogram.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float):
+        """Returns an estimate of the q-quantile, interpolated inside the
+        bucket it falls in."""
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else low
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Throughput:
+    """Requests per second over the last `window` seconds."""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.seconds = collections.deque()   # [second, count] pairs
+
+    def add(self, count=1, now=None):
+        second = int(now if now is not None else time.monotonic())
+        if self.seconds and self.seconds[-1][0] == second:
+            self.seconds[-1][1] += count
+        else:
+            self.seconds.append([second, count])
+
+    def rate(self, now=None):
+        now = now if now is not None else time.monotonic()
+        while self.seconds and self.seconds[0][0] <= now - self.window:
+            self.seconds.popleft()
+        return sum(count for _, count in self.seconds) / self.window
+
+
+class Metrics:
+    """All of the microservice's metrics."""
+
+    def __init__(self):
+        self.stages = collections.defaultdict(Histogram)
+        self.requests = 0
+        self.errors = collections.Counter()
+        self.throughput = Throughput()
+        self.patched = []
+
+        # Optional cc_cache.ValidationCache to report on.
+        self.cache = None
+
+    def observe(self, stage: str, seconds: float):
+        """Adds a latency for a stage."""
+        self.stages[stage].observe(seconds)
+
+    def timed(self, stage: str, function):
+        """Returns function wrapped so each call's latency is observed."""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - started)
+
+        return wrapper
+
+    def instrument_stages(self, module):
+        """Times the validate_card stages of the given module (cc_core) by
+        wrapping its functions. Until this is called there is no overhead."""
+
+        for stage in STAGES:
+            original = getattr(module, stage)
+            self.patched.append((module, stage, original))
+            setattr(module, stage, self.timed(stage, original))
+        return self
+
+    def restore_stages(self):
+        """Undoes instrument_stages."""
+
+        while self.patched:
+            module, stage, original = self.patched.pop()
+            setattr(module, stage, original)
+
+    def count_reply(self, reply):
+        """Counts a reply (single or batch) and its errors by type."""
+
+        results = reply if isinstance(reply, list) else \
+            reply.get("cards", [reply]) if isinstance(reply, dict) else []
+        if not isinstance(results, list):
+            results = [reply]
+
+        self.requests += 1
+        self.throughput.add(len(results))
+        for result in results:
+            if isinstance(result, dict) and "error" in result:
+                self.errors[result["error"]] += 1
+
+    def render(self):
+        """Returns all metrics in Prometheus text format."""
+
+        lines = ["# HELP cc_stage_seconds Latency of each request stage.",
+                 "# TYPE cc_stage_seconds histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else f"{bound:.9g}"
+                lines.append(f'cc_stage_seconds_bucket{{stage="{stage}",'
+                             f'le="{le}"}} {cumulative}')
+            lines.append(f'cc_stage_seconds_sum{{stage="{stage}"}} '
+                         f'{histogram.sum:.9g}')
+            lines.append(f'cc_stage_seconds_count{{stage="{stage}"}} '
+                         f'{histogram.count}')
+
+        lines += ["# HELP cc_stage_quantile_seconds Estimated latency "
+                  "quantiles of each request stage.",
+                  "# TYPE cc_stage_quantile_seconds gauge"]
+        for stage, histogram in sorted(self.stages.items()):
+            for q in QUANTILES:
+                lines.append(f'cc_stage_quantile_seconds{{stage="{stage}",'
+                             f'quantile="{q}"}} {histogram.quantile(q):.9g}')
+
+        lines += ["# HELP cc_requests_total Requests answered.",
+                  "# TYPE cc_requests_total counter",
+                  f"cc_requests_total {self.requests}",
+                  "# HELP cc_errors_total Cards failing validation, by "
+                  "error.",
+                  "# TYPE cc_errors_total counter"]
+        for error, count in sorted(self.errors.items()):
+            error = str(error).replace("\\", "\\\\")
+            error = error.replace('"', '\\"').replace("\n", "\\n")
+            lines.append(f'cc_errors_total{{error="{error}"}} {count}')
+
+        lines += ["# HELP cc_throughput_cards_per_second Cards validated "
+                  "per second over the last 10 seconds.",
+                  "# TYPE cc_throughput_cards_per_second gauge",
+                  f"cc_throughput_cards_per_second "
+                  f"{self.throughput.rate():.9g}"]
+
+        if self.cache is not None:
+            stats = self.cache.stats()
+            for name in ("hits", "misses", "evictions", "expirations"):
+                lines += [f"# TYPE cc_cache_{name}_total counter",
+                          f"cc_cache_{name}_total {stats[name]}"]
+            for name in ("entries", "bytes"):
+                lines += [f"# TYPE cc_cache_{name} gauge",
+                          f"cc_cache_{name} {stats[name]}"]
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(metrics, port=9557, host="127.0.0.1"):
+    """Serves metrics.render() at http://host:port/metrics from a background
+    thread. Returns the HTTP server (call shutdown() to stop it)."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # No per-scrape output.
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
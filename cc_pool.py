@@ -0,0 +1,161 @@
+"""This is the process pool of the credit-card microservice.
+Written by: Michelle Mann
+
+Validates big lists of cards across several processes. The cards are split
+into shards, and each worker writes its results straight into a shared memory
+buffer as three byte columns (valid flag, CARD_TYPES code, ERRORS code), so
+only the card #s and dates get pickled and the results don't get pickled at
+all. They come back as a cc_results.BatchResult over the same columns.
+
+Used by the server for large batch requests (--pool-processes) and by
+cc_stream.py for files (--processes).
+"""
+
+import array
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import bin_table
+import cc_core
+from cc_core import ERRORS, card_codes
+from cc_results import BatchResult
+
+
+# Bytes per card in the shared result buffer: valid, card type and error.
+COLUMNS = 3
+
+UNEXPECTED_ERROR = ERRORS.index("Unexpected error")
+
+
+# ------------ All related to the worker processes ----------- #
+
+def init_worker(table, card_types, accept_long_year):
+    """Gives a new worker the same card ranges, CARD_TYPES codes and date
+    settings as the process that started the pool."""
+
+    bin_table.TABLE = table
+    bin_table.CARD_TYPES[:] = card_types
+    cc_core.CLOCK.accept_long_year = accept_long_year
+
+
+def validate_shard(name: str, total: int, start: int, cards):
+    """Validates (cc_number, exp_date) pairs into the shared buffer, starting
+    at row start. Returns the # of cards validated."""
+
+    # The workers share the pool owner's resource tracker, so attaching
+    # doesn't make the block get unlinked when a worker exits.
+    shm = shared_memory.SharedMemory(name)
+    try:
+        buf = shm.buf
+        for row, (cc_number, exp_date) in enumerate(cards, start):
+            try:
+                card_type, error = card_codes(cc_number, exp_date)
+            except Exception:
+                card_type, error = 0, UNEXPECTED_ERROR
+
+            buf[row] = not error
+            buf[total + row] = card_type
+            buf[2 * total + row] = error
+        del buf
+    finally:
+        shm.close()
+
+    return len(cards)
+
+
+# ------------ All related to the pool ----------- #
+
+class PoolResults:
+    """Results of a ValidationPool.submit call that may still be running."""
+
+    def __init__(self, shm, total, futures):
+        self.shm = shm
+        self.total = total
+        self.futures = futures
+        self.codes = None
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def result(self):
+        """Waits for every shard and returns the BatchResult. The shared
+        memory is freed on the first call."""
+
+        if self.codes is not None:
+            return self.codes
+
+        try:
+            for future in self.futures:
+                future.result()
+
+            n = self.total
+            buf = self.shm.buf
+            self.codes = BatchResult(array.array("B", buf[:n]),
+                                     array.array("B", buf[n:2 * n]),
+                                     array.array("B", buf[2 * n:3 * n]))
+            del buf
+        finally:
+            self.free()
+        return self.codes
+
+    def free(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class ValidationPool:
+    """Persistent worker processes for validating many cards at once.
+
+    processes  - # of worker processes (default: # of CPUs).
+    shard_size - cards sent to a worker in one go.
+    """
+
+    def __init__(self, processes=None, shard_size=5000):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shard_size = shard_size
+
+        # Spawned, not forked, since the servers have ZeroMQ threads running.
+        self.executor = ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(bin_table.TABLE, list(bin_table.CARD_TYPES),
+                      cc_core.CLOCK.accept_long_year))
+
+    def submit(self, cards):
+        """Starts validating a list of (cc_number, exp_date) pairs and returns
+        a PoolResults."""
+
+        total = len(cards)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(COLUMNS * total, 1))
+
+        # Smaller shards for small inputs, so every process gets some.
+        shard_size = max(1, min(self.shard_size,
+                                -(-total // self.processes)))
+        try:
+            futures = [self.executor.submit(validate_shard, shm.name, total,
+                                            start,
+                                            cards[start:start + shard_size])
+                       for start in range(0, total, shard_size)]
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        return PoolResults(shm, total, futures)
+
+    def validate(self, cards):
+        """Returns the BatchResult for a list of (cc_number, exp_date)
+        pairs."""
+        return self.submit(cards).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
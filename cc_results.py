@@ -0,0 +1,127 @@
+"""This is the columnar result type of the credit-card microservice.
+Written by: Michelle Mann
+
+validate_card returns a new dict for every card, which adds up for big
+batches: a few hundred bytes and one more object for the garbage collector
+per card. BatchResult keeps a batch's results as three byte columns instead
+(valid flag, CARD_TYPES code and ERRORS code), 3 bytes per card, and only
+builds dicts or JSON when the results leave the process. CardResult is one
+card's result in the same form.
+
+Example calls:
+    results = BatchResult.validate([("4111111111111111", "12/40"), ...])
+    results[0].valid, results.errors[0]
+    results.to_json()      # or results.to_dicts()
+"""
+
+import array
+import json
+
+from cc_core import ERRORS, card_codes, result_from_codes
+
+
+UNEXPECTED_ERROR = ERRORS.index("Unexpected error")
+
+
+class CardResult:
+    """The result of one card, as codes into CARD_TYPES and ERRORS."""
+
+    __slots__ = ("card_type", "error")
+
+    def __init__(self, card_type=0, error=0):
+        self.card_type = card_type
+        self.error = error
+
+    @property
+    def valid(self):
+        return not self.error
+
+    def to_dict(self):
+        """Returns the same dict validate_card would."""
+        return result_from_codes(self.card_type, self.error)
+
+    def __eq__(self, other):
+        if not isinstance(other, CardResult):
+            return NotImplemented
+        return (self.card_type, self.error) == (other.card_type, other.error)
+
+    def __hash__(self):
+        return hash((self.card_type, self.error))
+
+    def __repr__(self):
+        return f"CardResult(card_type={self.card_type}, error={self.error})"
+
+
+class BatchResult:
+    """Results of many cards, in order, as parallel columns with one byte per
+    card. The columns are array.array("B") by default, but any sequences of
+    small ints work (i.e. the NumPy arrays from cc_vector.validate_cards)."""
+
+    __slots__ = ("valid", "card_types", "errors")
+
+    def __init__(self, valid=None, card_types=None, errors=None):
+        self.valid = array.array("B") if valid is None else valid
+        self.card_types = array.array("B") if card_types is None \
+            else card_types
+        self.errors = array.array("B") if errors is None else errors
+
+    @classmethod
+    def validate(cls, cards):
+        """Validates (cc_number, exp_date) pairs. A card that raises only
+        fails itself, with "Unexpected error"."""
+
+        results = cls()
+        append = results.append
+        for cc_number, exp_date in cards:
+            try:
+                card_type, error = card_codes(cc_number, exp_date)
+            except Exception:
+                card_type, error = 0, UNEXPECTED_ERROR
+            append(card_type, error)
+        return results
+
+    def append(self, card_type: int, error: int):
+        self.valid.append(not error)
+        self.card_types.append(card_type)
+        self.errors.append(error)
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __getitem__(self, i):
+        return CardResult(int(self.card_types[i]), int(self.errors[i]))
+
+    def __iter__(self):
+        for card_type, error in self.codes():
+            yield CardResult(int(card_type), int(error))
+
+    def codes(self):
+        """Yields (card type code, error code) for each card."""
+        return zip(self.card_types, self.errors)
+
+    def to_dicts(self):
+        """Yields the validate_card style dict of each card, one at a
+        time."""
+
+        for card_type, error in self.codes():
+            yield result_from_codes(int(card_type), int(error))
+
+    def to_json(self):
+        """Returns the results as a JSON array (bytes). There are only a few
+        distinct results, so each is encoded once and reused."""
+
+        encoded = {}
+        parts = []
+        for codes in self.codes():
+            part = encoded.get(codes)
+            if part is None:
+                part = encoded[codes] = json.dumps(result_from_codes(
+                    int(codes[0]), int(codes[1])))
+            parts.append(part)
+        return ("[" + ", ".join(parts) + "]").encode()
+
+    @property
+    def nbytes(self):
+        """Bytes taken by the columns."""
+        return sum(memoryview(column).nbytes for column in
+                   (self.valid, self.card_types, self.errors))
@@ -5,247 +5,687 @@ This is the server side of the socket and should receive a message in the form
 "[some credit card #]".
 """
 
+import argparse
+import heapq
+import itertools
+import math
+import os
+import random
 import time
-import zmq  # For ZeroMQ
-import re
 import json
-from datetime import datetime
 
+import bin_table
+import cc_core
+import cc_wire
+from cc_dedup import PENDING, RequestDedup, request_key
+from cc_logging import log, log_request, setup_logging
+from cc_results import BatchResult
+
+# The validation core lives in cc_core.py (no networking, quick to import);
+# its names are kept here so existing imports from cc_service still work.
+from cc_core import (  # noqa: F401
+    CARD_TYPES, CLOCK, DEADLINE_ERROR, DIGIT_VALUES, ERRORS, HEADER_DIGITS,
+    HEADER_ERROR, LUHN_DOUBLE, OVERLOADED_ERROR, ExpiryClock, format_cc,
+    parse_exp_date, result_codes, result_from_codes, scan_card,
+    valid_card_length, validate_card, validate_card_type, validate_expiration,
+    validate_luhn)
+
+
+# ------------ All related to batch requests ----------- #
+
+# Optional cc_cache.ValidationCache used for requests (off by default).
+CACHE = None
+
+# Optional cc_pool.ValidationPool used for batches of at least POOL_MIN_BATCH
+# cards (off by default).
+POOL = None
+POOL_MIN_BATCH = 1000
+
+
+def validate_request(message_dict):
+    """Returns the original request dict with the validation results appended.
+    Requests without the "cc_number" and "exp_date" headers get an error."""
+
+    # Handles bad header calls.
+    if not isinstance(message_dict, dict) or \
+            "cc_number" not in message_dict or "exp_date" not in message_dict:
+        return {"valid": False, "error": HEADER_ERROR}
+
+    # Uses the result cache, if one is turned on (see cc_cache.py).
+    validate = CACHE.validate if CACHE is not None else validate_card
+    result = validate(message_dict["cc_number"], message_dict["exp_date"])
+
+    # Append results to message_dict
+    message_dict.update(result)
+    return message_dict
+
+
+def validate_batch(cards):
+    """Runs validate_request over a list of card dicts and returns the results
+    in the same order. A bad entry only fails itself, not the whole batch."""
+
+    if POOL is not None and len(cards) >= POOL_MIN_BATCH:
+        return validate_batch_pooled(cards)
+    return [safe_validate_request(card) for card in cards]
+
+
+def validate_batch_pooled(cards):
+    """Same as validate_batch, but the cards are validated in the POOL
+    processes and only their result codes come back. Cards in the CACHE are
+    answered from it (and the pool's results are added to it). Cards the pool
+    got an unexpected error on are run again here, so the error names the
+    exception the same as it does without the pool."""
+
+    # Entries with bad headers are answered here, the rest go to the pool.
+    results = [{"valid": False, "error": HEADER_ERROR} for _ in cards]
+    rows = []
+    keys = []
+    for i, card in enumerate(cards):
+        if not isinstance(card, dict) or "cc_number" not in card or \
+                "exp_date" not in card:
+            continue
+
+        key = None
+        if CACHE is not None:
+            key = CACHE.card_key(card["cc_number"], card["exp_date"])
+            cached = CACHE.get(key) if key is not None else None
+            if cached is not None:
+                card.update(cached)
+                results[i] = card
+                continue
+        rows.append(i)
+        keys.append(key)
+
+    pooled = POOL.validate([(cards[i]["cc_number"], cards[i]["exp_date"])
+                            for i in rows])
+
+    for i, key, result in zip(rows, keys, pooled.to_dicts()):
+        if result.get("error") == "Unexpected error":
+            results[i] = safe_validate_request(cards[i])
+            continue
+        if key is not None:
+            CACHE.put(key, result)
+        cards[i].update(result)
+        results[i] = cards[i]
+    return results
 
-# ------------ All functions related to cc checker ----------- #
-def format_cc(cc_number: str):
-    """Returns useable cc_number as a string, but without whitespace, dashes or
-    alpha characters (if exist)"""
 
-    # Removes all non-digits using regex notation, returns -1 if incorrect.
-    clean_cc_number = re.sub(r"[^\d]", "", cc_number)
-    return clean_cc_number if clean_cc_number else -1
+def safe_validate_request(message_dict):
+    """Same as validate_request, but returns an error message instead of
+    raising if the request can't be processed (i.e. cc_number isn't a str)."""
 
+    try:
+        return validate_request(message_dict)
+    except Exception as e:
+        return {"valid": False, "error": f"Unexpected error: {e}"}
 
-def validate_card_type(cc_number: str):
-    """Returns type of credit card (if valid). If not, returns error.
 
-    MC, Visa, or AmEx cards have the following headers / lengths:
-        Visa - 4 is first digit (16 digits)
-        MC - 51-55 or 2221 - 2720 (16 digits)
-        AmEx - 34 or 37 (15 digits)
-    """
-    patterns = {
-        "Visa": r"^4",
-        "MC": r"^(5[1-5]|2(?:2(?:[2-9]\d|3\d)|[3-6]\d{2}|7(?:[01]\d|20)))",
-        "AmEx": r"^3[47]"
-        }
+def handle_request(message_dict):
+    """Returns the reply for a decoded request. Requests can be a single card
+    dict, a JSON array of card dicts or a {"cards": [...]} dict."""
 
-    for card_type, pattern in patterns.items():
-        if re.match(pattern, cc_number):
-            return card_type
+    # Batch request sent as a JSON array.
+    if isinstance(message_dict, list):
+        return validate_batch(message_dict)
 
-    return -1
+    # Batch request sent as {"cards": [...]}, other keys are echoed back.
+    if isinstance(message_dict, dict) and "cards" in message_dict:
+        if not isinstance(message_dict["cards"], list):
+            return {"valid": False, "error": "Invalid batch format"}
+        message_dict["cards"] = validate_batch(message_dict["cards"])
+        return message_dict
 
+    return safe_validate_request(message_dict)
 
-def valid_card_length(cc_number: str, card_type: str):
-    """Returns card type if card is still valid after length check, otherwise
-    returns False"""
 
-    # Store the length of the cc #
-    cc_length = len(cc_number)
+def is_number(value):
+    """Returns True for ints and floats (but not bools)."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-    # Visa and MC cards have 16 digits, Amex has 15
-    valid_lengths = {"Visa": 16, "MC": 16, "AmEx": 15}
-    return True if cc_length == valid_lengths.get(card_type, -1) else False
 
+def expired(request, received=None):
+    """Removes the "timeout_ms" and "deadline" keys from a request dict and
+    returns True if either has already passed. The client has given up on
+    such requests, so they aren't worth validating.
 
-def validate_luhn(cc_number: str):
-    """Does checsum digit check to test validity of credit card numbers.
-     Returns True if valid card, returns False otherwise."""
+    timeout_ms is the client's time budget in milliseconds, counted from
+    received (time.monotonic() when the request came in; now if it isn't
+    given), so it works whatever the client's clock says. deadline is a unix
+    time in seconds, which needs the client's and server's clocks in sync."""
 
-    # Creation of a list of digits from the string cc_number.
-    digits = [int(d) for d in str(cc_number)]
+    if not isinstance(request, dict):
+        return False
 
-    # Stores the last digit of the string - this is the listed Luhn's #
-    last_digit = digits.pop()
+    timeout_ms = request.pop("timeout_ms", None)
+    deadline = request.pop("deadline", None)
+    if is_number(timeout_ms) and received is not None and \
+            received + timeout_ms / 1000 < time.monotonic():
+        return True
+    return is_number(deadline) and deadline < time.time()
 
-    # Loops through the rest of the list backwards, skipping every other #.
-    for i in range(len(digits) - 1, -1, -2):
 
-        # Multiples that digit by 2.
-        digits[i] *= 2
+def process_message(message: bytes, metrics=None, received=None):
+    """Returns the reply dict for a raw request message as received on the
+    socket, or None if the request's deadline has passed (see expired). JSON
+    decoding is timed if a cc_metrics.Metrics is given."""
 
-        # If the resulting doubling is greater than 9, subtract 9
-        if digits[i] > 9:
-            digits[i] -= 9
+    # Safely parse JSON
+    started = time.perf_counter()
+    try:
+        message_dict = json.loads(message)
+    except ValueError:
+        return {"valid": False, "error": "Invalid JSON format"}
 
-    # We're now looking for the highest multiple of 10 that when subtracted by
-    # our total, the result is <= 9.
-    total = sum(digits)
-    check_digit = (10 - (total % 10)) % 10
+    if metrics is not None:
+        metrics.observe("json_decode", time.perf_counter() - started)
 
-    # We return if this is equal to the last digit listed (or not)
-    return check_digit == last_digit
+    # Drops requests the client has stopped waiting for.
+    if expired(message_dict, received):
+        return None
 
+    # Validates a single card or a whole batch of cards.
+    return handle_request(message_dict)
 
-def validate_expiration(exp_date: str):
-    """Takes a user-input expiration date as a string and returns True for
-    valid or False for invalid. Valid dates are input as MM/YY"""
 
-    # Ensures MM is between 1 and 12 only -- captures either leading 0 notation
-    # or single digit, and YY is two-digits separated by a "/"
-    date_pattern = r"^(0?[1-9]|1[0-2])\/\d{2}$"
+def encode_reply(reply, metrics=None):
+    """Returns the reply as JSON bytes. The encoding is timed and the reply
+    counted if a cc_metrics.Metrics is given."""
 
-    if not re.fullmatch(date_pattern, exp_date):
-        return -1
+    started = time.perf_counter()
+    encoded = json.dumps(reply).encode()
 
-    # Parse month and year details from user-entered exp_date
-    exp_date = exp_date.split('/')            # Gives us format of ['MM', 'YY']
-    exp_month = int(exp_date[0])
-    exp_year = int(exp_date[1])
+    if metrics is not None:
+        metrics.observe("json_encode", time.perf_counter() - started)
+        metrics.count_reply(reply)
+    return encoded
 
-    # Compare properly formatted date to today, if it's not in the future,
-    # return False, otherwise, True.
 
-    # Today's date.
-    today = datetime.today()
-    current_month = today.month
-    current_year = today.year
+def compact_reply(reply):
+    """Returns a reply with "card_type" and "error" as codes instead of
+    strings (and without "valid_exp"), for binary replies."""
 
-    # Determine century
-    cutoff_year = current_year % 100 + 20       # a little in the future
-    if exp_year < cutoff_year:
-        exp_year += 2000
-    else:
-        exp_year += 1900
+    if isinstance(reply, list):
+        return [compact_reply(result) for result in reply]
 
-    return (exp_year > current_year) or \
-        (exp_year == current_year and exp_month >= current_month)
+    reply = dict(reply)
+    if isinstance(reply.get("cards"), list):
+        reply["cards"] = compact_reply(reply["cards"])
+        return reply
 
-# ------------ All functions related to cc checker ----------- #
+    reply["card_type"], reply["error"] = result_codes(reply)
+    reply.pop("valid_exp", None)
+    return reply
 
 
-def validate_card(card_number, exp_date):
-    """Returns message responses cc_validation rules"""
+def respond_struct(message: bytes, metrics=None):
+    """Returns the struct reply (see cc_wire.py) for a struct request."""
+
+    try:
+        cards = cc_wire.unpack_cards(message)
+    except ValueError:
+        results = [(0, ERRORS.index("Invalid message format"))]
+    else:
+        results = list(BatchResult.validate(cards).codes())
 
-    results = {"valid": True}  # Start with a positive assumption
+    if metrics is not None:
+        metrics.count_reply([{"error": ERRORS[error]} if error else {}
+                             for _, error in results])
+    return cc_wire.pack_results(results)
 
-    # Attempts to format card, adds error if failed.
-    formatted_cc = format_cc(card_number)
-    if formatted_cc == -1:
-        results["valid"] = False
-        results["error"] = "Invalid card format"
-        return results
 
-    # Attempts to determine card type, adds error if failed.
-    card_type = validate_card_type(formatted_cc)
-    if card_type == -1:
-        results["valid"] = False
-        results["error"] = "Unknown card header"
-        return results
+def respond_msgpack(message: bytes, metrics=None, received=None):
+    """Returns the MessagePack reply (see cc_wire.py) for a MessagePack
+    request, or None if the request's deadline has passed."""
+
+    try:
+        request = cc_wire.unpack_msgpack(message)
+    except ValueError:
+        reply = {"valid": False, "error": "Invalid message format"}
+
+        # Without msgpack the reply can't be MessagePack either.
+        if cc_wire.msgpack is None:
+            if metrics is not None:
+                metrics.count_reply(reply)
+            return error_reply(message, "Invalid message format")
     else:
-        results["card_type"] = card_type
-
-    # Attemptes to validate card length based on card type, adds error if
-    # failed.
-    if not valid_card_length(formatted_cc, card_type):
-        results["valid"] = False
-        results["error"] = "Incorrect length"
-        return results
-
-    # Attempts to validate checksum value, adds error if failed.
-    if not validate_luhn(formatted_cc):
-        results["valid"] = False
-        results["error"] = "Invalid checksum"
-        return results
-
-    # Attempts to validate expiration date, adds error if failed.
-    valid_date = validate_expiration(exp_date)
-    if valid_date == -1:
-        results["valid"] = False
-        results["error"] = "Invalid date format"
-        return results
-
-    if not valid_date:
-        results["valid"] = False
-        results["error"] = "Card Expired"
-        return results
-
-    # Returns valid card message.
-    results["valid_exp"] = "Valid"
-    return results
+        if expired(request, received):
+            if metrics is not None:
+                metrics.count_reply({"error": DEADLINE_ERROR})
+            return None
+        reply = handle_request(request)
+
+    if metrics is not None:
+        metrics.count_reply(reply)
+    return cc_wire.pack_msgpack(compact_reply(reply))
+
+
+def respond(message: bytes, metrics=None, received=None):
+    """Returns the encoded reply for a raw request message, in the same wire
+    format as the request (JSON unless it starts with a cc_wire tag). Returns
+    None if the request's deadline passed before it was processed. received
+    is the time.monotonic() the request came in, which "timeout_ms" counts
+    from."""
+
+    tag = message[:1]
+    if tag == cc_wire.STRUCT_TAG:
+        return respond_struct(message, metrics)
+    if tag == cc_wire.MSGPACK_TAG:
+        return respond_msgpack(message, metrics, received)
+
+    # Parses the JSON and validates the card(s).
+    reply = process_message(message, metrics, received)
+    if reply is None:
+        if metrics is not None:
+            metrics.count_reply({"error": DEADLINE_ERROR})
+        return None
+
+    # Only a sample of requests are logged (none by default).
+    log_request(message, reply)
+    return encode_reply(reply, metrics)
+
+
+def safe_respond(message: bytes, metrics=None, received=None):
+    """Same as respond, but an exception gives an "Unexpected error" reply
+    (in the request's wire format) instead of being raised. Used by workers
+    and nodes, which must answer every request and mustn't stop on a bad
+    one."""
+
+    try:
+        return respond(message, metrics, received)
+    except Exception as e:
+        log.exception("Unexpected error occurred: %s", e)
+        return error_reply(message, "Unexpected error")
+
+
+def respond_dedup(address, message: bytes, dedup, key, metrics=None,
+                  received=None):
+    """Same as respond, for a request that dedup.start was called on. Returns
+    (reply, addresses to send it to), which includes the copies of the
+    request that came in meanwhile. If the request's deadline has passed, the
+    newest copy is answered instead."""
+
+    reply = None
+    try:
+        reply = respond(message, metrics, received)
+        while reply is None:
+            copy = dedup.retry(key)
+            if copy is None:
+                break
+            # The copy's "timeout_ms" isn't checked, it came in later and
+            # its client is still waiting.
+            address, message = copy
+            reply = respond(message, metrics)
+    finally:
+        waiting = dedup.finish(key, reply)
+    return reply, [address] + waiting
+
+
+def error_reply(message: bytes, error: str, **extra):
+    """Returns an error reply for a request without processing it, in the
+    same wire format as the request (JSON for MessagePack requests if msgpack
+    isn't installed). Extra keys (i.e. retry_after) are added to JSON and
+    MessagePack replies."""
+
+    code = ERRORS.index(error)
+    tag = message[:1]
+
+    # Struct replies have one result per card in the request (each card
+    # takes at least 3 bytes, which caps a bad count).
+    if tag == cc_wire.STRUCT_TAG:
+        try:
+            (count,) = cc_wire.COUNT.unpack_from(message, 1)
+        except Exception:
+            count = 1
+        count = max(1, min(count, (len(message) - 5) // 3))
+        return cc_wire.pack_results([(0, code)] * count)
 
+    if tag == cc_wire.MSGPACK_TAG and cc_wire.msgpack is not None:
+        return cc_wire.pack_msgpack({"valid": False, "error": code, **extra})
+    return json.dumps({"valid": False, "error": error, **extra}).encode()
 
-# ------------ All related to Sending / Receiving message ----------- #
 
-def start_server():
-    # Step #1: Set up the context on the server side.
-    context = zmq.Context()
+# ------------ All related to simulated latency ----------- #
 
-    # Step #2: Sets up this socket as a reply socket.
-    socket = context.socket(zmq.REP)
+class LatencySimulator:
+    """Picks an artificial delay (in seconds) for each request. This is off by
+    default and is only meant for demos or testing client timeouts.
 
-    # Step #3: Sets the port # binding for the socket.
-    socket.bind("tcp://*:5557")
-    print("Server is running on port 5557...")
+    Supported distributions:
+        fixed:SECONDS         - the same delay for every request
+        uniform:LOW:HIGH      - random delay between LOW and HIGH seconds
+        exp:MEAN              - exponential delay with the given mean
+    """
 
-    # Step #4: Creation of our listener for loop - listens until it gets a
-    # request.
-    while True:
-        try:
+    def __init__(self, distribution="fixed", *params, seed=None):
+        if distribution not in ("fixed", "uniform", "exp"):
+            raise ValueError(f"Unknown delay distribution: {distribution}")
 
-            # Step #5: Stores the message as a variable.
-            message = socket.recv()
+        expected = {"fixed": 1, "uniform": 2, "exp": 1}[distribution]
+        if len(params) != expected or any(p < 0 for p in params):
+            raise ValueError(f"'{distribution}' delay needs {expected} "
+                             "non-negative value(s)")
 
-            # We will decode the message so that we don't get a 'b' before text
-            # ZeroMQ defaults to UTF-8 encoding when nothing is specified.
-            message_str = message.decode()
-            print(f"Received request: {message_str}")
+        self.distribution = distribution
+        self.params = params
+        self.random = random.Random(seed)
 
-            if len(message) > 0:
-                # Client asked server to quit
-                if message.decode() == 'Q':
-                    break
+    @classmethod
+    def from_string(cls, spec: str):
+        """Builds a simulator from a string such as "fixed:3" or
+        "uniform:0.5:2"."""
 
-                # Safely parse JSON
-                try:
-                    message_dict = json.loads(message)
-                except json.JSONDecodeError:
-                    socket.send_json({"valid": False,
-                                      "error": "Invalid JSON format"})
-                    continue
+        name, *values = spec.split(":")
+        return cls(name, *(float(v) for v in values))
 
-                print(f"Processed request: {message_dict}")
+    def next_delay(self):
+        """Returns the delay in seconds for the next request."""
 
-                # Handles bad header calls.
-                try:
-                    card_number = message_dict["cc_number"]
-                    exp_date = message_dict["exp_date"]
-                except KeyError:
-                    socket.send_json({"valid": False,
-                                      "error": "Incorrect message headers \
-                                           for service"})
-                    continue
-                card_number = message_dict.get("cc_number", "")
-                exp_date = message_dict.get("exp_date", "")
+        if self.distribution == "fixed":
+            return self.params[0]
+        if self.distribution == "uniform":
+            return self.random.uniform(*self.params)
+        return self.random.expovariate(1 / self.params[0]) \
+            if self.params[0] else 0.0
 
-                result = validate_card(card_number, exp_date)
 
-                # Append results to message_dict
-                message_dict.update(result)
+# ------------ All related to Sending / Receiving message ----------- #
+
+def start_server(bind="tcp://*:5557", latency=None, metrics=None,
+                 admission=None, dedup=None):
+    """Runs the microservice until a 'Q' message is received. If a
+    LatencySimulator is given, each reply is held back by its delay without
+    blocking other clients. If a cc_metrics.Metrics is given, every stage of
+    the request is timed. If a cc_admission.AdmissionControl is given,
+    requests are rate limited per client and queued fairly between clients,
+    with overload replies once the queue is full. If a cc_dedup.RequestDedup
+    is given, retries of a request with a "request_id" are answered from the
+    first copy instead of being validated again."""
+
+    # ZeroMQ is only needed to serve, not to validate (see cc_core.py).
+    import zmq  # For ZeroMQ
+
+    # Times the steps of validate_card in cc_core.
+    if metrics is not None:
+        metrics.instrument_stages(cc_core)
+
+    # Step #1: Set up the context on the server side.
+    context = zmq.Context()
+
+    # Step #2: Sets up this socket as a router socket. REQ clients work as
+    # before, but replies can be sent back in any order so a delayed request
+    # never holds up anyone else.
+    socket = context.socket(zmq.ROUTER)
 
-                # Make the program sleep for X seconds.
-                time.sleep(3)
+    # Step #3: Sets the port # binding for the socket.
+    socket.bind(bind)
+    log.info("Server is running on %s...", bind)
+
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+
+    # Delayed replies waiting to be sent as (send_at, seq, frames).
+    pending = []
+    sequence = itertools.count()
+
+    def send_reply(address, reply: bytes):
+        """Sends the reply right away, or queues it if latency is simulated.
+        Requests past their deadline (no reply) are dropped."""
+        if reply is None:
+            return
+        frames = address + [reply]
+        if latency is None:
+            socket.send_multipart(frames)
+        else:
+            send_at = time.monotonic() + latency.next_delay()
+            heapq.heappush(pending, (send_at, next(sequence), frames))
+
+    def answer(address, message: bytes, key=None, received=None):
+        """Validates the card(s) and sends the reply back (to any waiting
+        copies of the request too)."""
+        if key is None:
+            send_reply(address, respond(message, metrics, received))
+            return
+        reply, addresses = respond_dedup(address, message, dedup, key,
+                                         metrics, received)
+        for address in addresses:
+            send_reply(address, reply)
+
+    def receive(flags=0):
+        """Receives a request. Returns False on a 'Q' message."""
+
+        # Step #5: Stores the message as a variable. The frames before the
+        # message are the client's return address.
+        frames = socket.recv_multipart(flags)
+        address, message = frames[:-1], frames[-1]
+        received = time.monotonic()
+
+        if len(message) > 0:
+            # Client asked server to quit
+            if message == b'Q':
+                return False
+
+            # Retries are answered from the first copy of the request, without
+            # counting against the client's rate.
+            key = None
+            if dedup is not None:
+                key = request_key(message)
+                if key is not None:
+                    reply = dedup.check(key, address, message)
+                    if reply is not None:
+                        if reply is not PENDING:
+                            socket.send_multipart(address + [reply])
+                        return True
+
+            if admission is None:
+                if key is not None:
+                    dedup.start(key)
+                answer(address, message, key, received)
+                return True
+
+            # Queues the request, or tells the client to back off right away.
+            wait = admission.offer(address[0], message,
+                                   (address, message, key, received))
+            if wait:
+                reply = error_reply(message, OVERLOADED_ERROR,
+                                    retry_after=round(wait, 3))
+                if metrics is not None:
+                    metrics.count_reply({"error": OVERLOADED_ERROR})
+                socket.send_multipart(address + [reply])
+            elif key is not None:
+                dedup.start(key)
+        return True
 
-                print(f"Sending response: {message_dict}")
+    # Step #4: Creation of our listener for loop - listens until it gets a
+    # request.
+    running = True
+    while running:
+        try:
 
-                # Send message.
-                socket.send_json(message_dict)
+            # Only wait as long as the next delayed reply allows, and not at
+            # all while there are queued requests.
+            timeout = None
+            if admission is not None and len(admission):
+                timeout = 0
+            elif pending:
+                timeout = max(0, math.ceil(
+                    (pending[0][0] - time.monotonic()) * 1000))
+
+            started = time.perf_counter()
+            ready = poller.poll(timeout)
+            if metrics is not None and timeout != 0:
+                metrics.observe("socket_wait", time.perf_counter() - started)
+
+            if ready:
+                if admission is None:
+                    running = receive()
+                else:
+                    # Takes in everything waiting (up to the queue size), so
+                    # the queue order is fair and overloads are answered fast.
+                    for _ in range(admission.max_queue + 1):
+                        try:
+                            running = receive(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        if not running:
+                            break
+
+            # Processes the next queued request.
+            if running and admission is not None and len(admission):
+                answer(*admission.take())
+
+            # Send any delayed replies that are now due.
+            while pending and pending[0][0] <= time.monotonic():
+                socket.send_multipart(heapq.heappop(pending)[2])
 
         # Handle server errors.
         except Exception as e:
-            print(f"Unexpected error occurred: {e}")
+            log.exception("Unexpected error occurred: %s", e)
 
     # Make a clean exit.
-    socket.close()
+    if metrics is not None:
+        metrics.restore_stages()
+    socket.close(linger=0)
     context.term()
 
 
+def main(argv=None):
+    """Command line entry point, see README.md for the options."""
+
+    global CACHE, POOL
+
+    parser = argparse.ArgumentParser(description="Credit card microservice")
+    parser.add_argument("--bind", default="tcp://*:5557",
+                        help="address to bind (default: tcp://*:5557)")
+    parser.add_argument("--delay", type=LatencySimulator.from_string,
+                        help="simulate latency per request, e.g. fixed:3, "
+                             "uniform:1:3 or exp:0.5 (off by default)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run as a broker in front of N validation "
+                             "workers (default: single server loop)")
+    parser.add_argument("--worker-mode", choices=["process", "thread"],
+                        default="process",
+                        help="run broker workers as processes or threads")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the asyncio server with many requests in "
+                             "flight at once")
+    parser.add_argument("--max-in-flight", type=int, default=1000,
+                        help="async server: requests processed at once")
+    parser.add_argument("--hwm", type=int, default=1000,
+                        help="async server: ZeroMQ high-water mark")
+    parser.add_argument("--offload-cards", type=int, default=100,
+                        help="async server: validate requests with this "
+                             "many cards on a worker thread")
+    parser.add_argument("--cluster", metavar="ADDRESS",
+                        help="run as a cluster broker, with nodes joining "
+                             "on this address, e.g. tcp://*:5558")
+    parser.add_argument("--join", metavar="ADDRESS",
+                        help="run as a node of the cluster broker at this "
+                             "address")
+    parser.add_argument("--capacity", type=int, default=1,
+                        help="cluster node: requests taken at once")
+    parser.add_argument("--heartbeat", type=float, default=1.0,
+                        help="cluster: seconds between heartbeats")
+    parser.add_argument("--card-ranges",
+                        help="JSON file of card networks to accept (default: "
+                             "card_ranges.json)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on "
+                             "http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--cache-mb", type=float, default=0,
+                        help="cache results of repeated cards, up to this "
+                             "many MB (default: off)")
+    parser.add_argument("--cache-ttl", type=float, default=3600,
+                        help="seconds a cached result is kept")
+    parser.add_argument("--pool-processes", type=int, default=0,
+                        help="validate batches of 1000+ cards in this many "
+                             "processes (default: off)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="cards per second allowed per client "
+                             "(default: no limit)")
+    parser.add_argument("--burst", type=float,
+                        help="cards a client can send at once (default: "
+                             "--rate)")
+    parser.add_argument("--max-queue", type=int, default=0,
+                        help="requests queued before clients are told to "
+                             "retry later (default: off, or 1000 with "
+                             "--rate)")
+    parser.add_argument("--dedup-ttl", type=float, default=30,
+                        help="seconds the reply to a request with a "
+                             "request_id is kept for its retries (0: off)")
+    parser.add_argument("--dedup-entries", type=int, default=10000,
+                        help="replies kept for retries")
+    parser.add_argument("--dedup-mb", type=float, default=16,
+                        help="MB of replies kept for retries")
+    parser.add_argument("--accept-yyyy", action="store_true",
+                        help="also accept MM/YYYY expiration dates")
+    parser.add_argument("--log-level", default="INFO",
+                        help="DEBUG, INFO, WARNING or ERROR (default: INFO)")
+    parser.add_argument("--log-sample", type=float, default=0.0,
+                        help="fraction of requests to log, with card "
+                             "numbers masked (default: 0)")
+    args = parser.parse_args(argv)
+
+    listener = setup_logging(args.log_level.upper(), args.log_sample)
+    CLOCK.accept_long_year = args.accept_yyyy
+
+    if args.cache_mb > 0:
+        from cc_cache import ValidationCache
+        CACHE = ValidationCache(int(args.cache_mb * 1024 * 1024),
+                                args.cache_ttl)
+
+    # Worker processes load the same table through the environment.
+    if args.card_ranges:
+        os.environ["CC_CARD_RANGES"] = args.card_ranges
+        bin_table.load_card_ranges(args.card_ranges)
+
+    # Started after the card ranges are loaded, which the workers copy.
+    if args.pool_processes > 0:
+        from cc_pool import ValidationPool
+        POOL = ValidationPool(args.pool_processes)
+
+    admission = None
+    if args.rate > 0 or args.max_queue > 0:
+        from cc_admission import AdmissionControl
+        admission = AdmissionControl(args.rate or None, args.burst,
+                                     args.max_queue or 1000)
+
+    dedup = None
+    if args.dedup_ttl > 0:
+        dedup = RequestDedup(args.dedup_entries, args.dedup_ttl,
+                             int(args.dedup_mb * 1024 * 1024))
+
+    metrics = None
+    if args.metrics_port:
+        from cc_metrics import Metrics, start_metrics_server
+        metrics = Metrics()
+        metrics.cache = CACHE
+        start_metrics_server(metrics, args.metrics_port)
+
+    if args.cluster:
+        from cc_cluster import start_cluster_broker
+        start_cluster_broker(args.bind, args.cluster, args.heartbeat,
+                             dedup=dedup)
+    elif args.join:
+        from cc_cluster import start_node
+        start_node(args.join, args.capacity, args.heartbeat, metrics=metrics)
+    elif args.use_async:
+        from cc_async_service import start_async_server
+        start_async_server(args.bind, args.delay, args.max_in_flight,
+                           args.hwm, metrics, admission, dedup,
+                           args.offload_cards)
+    elif args.workers > 0:
+        from cc_broker import start_broker
+        start_broker(args.bind, args.workers, args.worker_mode)
+    else:
+        start_server(args.bind, args.delay, metrics, admission, dedup)
+
+    if POOL is not None:
+        POOL.close()
+    listener.stop()
+
+
 if __name__ == "__main__":
-    start_server()
+    # Runs main() from the importable cc_service module, so that the cache,
+    # clock and metrics set up there are the ones every server mode uses.
+    import cc_service
+    cc_service.main()
@@ -0,0 +1,223 @@
+"""This is the file validation command line tool for the credit-card
+microservice.
+Written by: Michelle Mann
+
+Streams a CSV or JSONL file of "cc_number" / "exp_date" records through
+validate_card and writes the results as it goes, so memory use stays the same
+no matter how big the file is. Works with stdin / stdout and gzip files.
+
+Example calls:
+    python3 cc_stream.py cards.csv -o results.csv
+    python3 cc_stream.py cards.jsonl.gz -o results.jsonl.gz --processes 8
+    zcat cards.csv.gz | python3 cc_stream.py - --format csv > results.csv
+"""
+
+import argparse
+import collections
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+
+from cc_pool import ValidationPool
+from cc_service import safe_validate_request
+
+
+# Extra CSV columns written after the input columns.
+RESULT_FIELDS = ["valid", "card_type", "valid_exp", "error"]
+
+# First two bytes of every gzip file.
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+# ------------ All related to reading / writing files ----------- #
+
+def open_input(path: str):
+    """Opens a file (or stdin for "-") as text, unzipping it if it's gzip."""
+
+    # closefd=False so that closing the file doesn't close stdin itself.
+    raw = open(sys.stdin.fileno() if path == "-" else path, "rb",
+               closefd=path != "-")
+
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+
+def open_output(path: str):
+    """Opens a file (or stdout for "-") for text, gzipped if it ends in .gz"""
+
+    raw = open(sys.stdout.fileno() if path == "-" else path, "wb",
+               closefd=path != "-")
+    if path.endswith(".gz"):
+        raw = gzip.GzipFile(fileobj=raw, mode="wb")
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+
+def guess_format(path: str):
+    """Returns "csv" or "jsonl" from the file name."""
+
+    name = path[:-3] if path.endswith(".gz") else path
+    return "csv" if name.endswith(".csv") else "jsonl"
+
+
+def read_jsonl(file):
+    """Yields one record per non-blank line. Lines that aren't valid JSON are
+    passed on as None so they still get a result."""
+
+    for line in file:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def write_jsonl(file, results):
+    """Writes one JSON result per line."""
+
+    for result in results:
+        file.write(json.dumps(result))
+        file.write("\n")
+
+
+def write_csv(file, results, fieldnames):
+    """Writes the input columns plus the result columns."""
+
+    writer = csv.DictWriter(file, fieldnames + [f for f in RESULT_FIELDS
+                                                if f not in fieldnames],
+                            extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(results)
+
+
+# ------------ All related to validating records ----------- #
+
+def validate_record(record):
+    """Returns the record with its validation result appended."""
+
+    if record is None:
+        return {"valid": False, "error": "Invalid JSON format"}
+
+    result = safe_validate_request(record)
+
+    # Keeps the other columns of records with bad headers in the output.
+    if isinstance(record, dict) and result is not record:
+        record.update(result)
+        return record
+    return result
+
+
+def submit_chunk(pool, chunk):
+    """Starts validating a list of records in the pool. Returns what
+    finish_chunk needs to put the results back into the records."""
+
+    rows = [i for i, record in enumerate(chunk) if isinstance(record, dict)
+            and "cc_number" in record and "exp_date" in record]
+    pending = pool.submit([(chunk[i]["cc_number"], chunk[i]["exp_date"])
+                           for i in rows])
+    return chunk, rows, pending
+
+
+def finish_chunk(chunk, rows, pending):
+    """Returns the validated records of a submit_chunk call, in order."""
+
+    done = set()
+    for i, result in zip(rows, pending.result().to_dicts()):
+        if result.get("error") != "Unexpected error":
+            chunk[i].update(result)
+            done.add(i)
+
+    # Records that weren't sent get their errors here, and so do records
+    # that raised in the pool, so the error names the exception the same
+    # as with one process.
+    return [record if i in done else validate_record(record)
+            for i, record in enumerate(chunk)]
+
+
+def chunked(records, chunk_size: int):
+    """Yields lists of up to chunk_size records."""
+
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def validate_records(records, processes=1, chunk_size=10000):
+    """Yields the validated records in input order. With more than one
+    process, chunks are validated in a cc_pool.ValidationPool, with only a
+    few chunks per process in memory at once."""
+
+    if processes <= 1:
+        for record in records:
+            yield validate_record(record)
+        return
+
+    with ValidationPool(processes, chunk_size) as pool:
+        pending = collections.deque()
+
+        for chunk in chunked(records, chunk_size):
+            pending.append(submit_chunk(pool, chunk))
+
+            # Wait for the oldest chunk once enough are queued up.
+            if len(pending) >= processes * 2:
+                yield from finish_chunk(*pending.popleft())
+
+        while pending:
+            yield from finish_chunk(*pending.popleft())
+
+
+def validate_file(input_path, output_path, file_format=None, processes=1,
+                  chunk_size=10000):
+    """Validates every record of the input file into the output file.
+    Returns the # of records validated."""
+
+    file_format = file_format or guess_format(
+        input_path if input_path != "-" else output_path)
+    count = 0
+
+    def counted(results):
+        nonlocal count
+        for result in results:
+            count += 1
+            yield result
+
+    with open_input(input_path) as infile, open_output(output_path) as outfile:
+        if file_format == "csv":
+            reader = csv.DictReader(infile)
+            results = validate_records(reader, processes, chunk_size)
+            write_csv(outfile, counted(results), list(reader.fieldnames or []))
+        else:
+            results = validate_records(read_jsonl(infile), processes,
+                                       chunk_size)
+            write_jsonl(outfile, counted(results))
+
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Validate a CSV or JSONL file of credit cards")
+    parser.add_argument("input", help="input file, or - for stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file, or - for stdout (default)")
+    parser.add_argument("--format", choices=["csv", "jsonl"],
+                        help="file format (default: from the file name)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="# of processes to validate chunks in")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="records per chunk sent to a process")
+    args = parser.parse_args(argv)
+
+    count = validate_file(args.input, args.output, args.format,
+                          args.processes, args.chunk_size)
+    print(f"Validated {count} records.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""This is the vectorized (NumPy) version of the credit card checks.
+Written by: Michelle Mann
+
+Validates many cards at once for offline / bulk jobs. Card numbers are turned
+into a fixed-width uint8 digit matrix (one column per card, padded with zeros)
+and the Luhn checksum, length and card type (from the bin_table.py header
+table) are computed for all cards at once.
+Results match validate_card in cc_core.py exactly, as CARD_TYPES / ERRORS
+codes.
+
+Requires NumPy.
+"""
+
+import functools
+import numpy as np
+
+import bin_table
+from cc_core import card_codes, format_cc, validate_expiration
+from cc_core import result_from_codes
+from cc_core import CARD_TYPES, ERRORS
+
+
+# Codes for the errors used below.
+BAD_FORMAT = ERRORS.index("Invalid card format")
+BAD_HEADER = ERRORS.index("Unknown card header")
+BAD_LENGTH = ERRORS.index("Incorrect length")
+BAD_CHECKSUM = ERRORS.index("Invalid checksum")
+BAD_DATE = ERRORS.index("Invalid date format")
+EXPIRED = ERRORS.index("Card Expired")
+
+# Longest card number that can be length checked, anything longer fails.
+MAX_LENGTH = 255
+
+# Rows validated at a time, keeps the temporary arrays cache-sized.
+CHUNK_SIZE = 65536
+
+
+def digit_matrix(cc_numbers):
+    """Returns (digits, lengths) for a list or array of cleaned card numbers
+    (ASCII digits only, str or bytes).
+
+    digits is a W x N uint8 matrix with one column per card: row i holds the
+    i-th digit of every card, padded with 0 past the end of shorter cards.
+    This way every step below works on long contiguous rows. lengths is the #
+    of digits of each card."""
+
+    numbers = np.asarray(cc_numbers)
+    if numbers.dtype.kind == "U":
+        numbers = np.char.encode(numbers, "ascii")
+    if numbers.dtype.kind != "S":
+        numbers = numbers.astype(bytes)
+
+    width = max(numbers.dtype.itemsize, 1)
+    raw = numbers.view(np.uint8).reshape(len(numbers), width)
+    digits = np.ascontiguousarray(raw.T)
+
+    # Padding bytes are 0, every digit is at least ord("0").
+    lengths = np.count_nonzero(digits, axis=0)
+    np.maximum(digits, ord("0"), out=digits)
+    digits -= ord("0")
+    return digits, lengths
+
+
+def luhn_valid(digits, lengths):
+    """Returns a bool array, True for cards passing the Luhn checksum."""
+
+    # Every other digit is doubled counting back from the check digit, so
+    # whether the even or odd positions are doubled depends on the length.
+    # Sums are kept for both and the right pair is picked per card.
+    count = digits.shape[1]
+    plain = [np.zeros(count, dtype=np.uint16) for _ in range(2)]
+    doubled = [np.zeros(count, dtype=np.uint16) for _ in range(2)]
+
+    for i, row in enumerate(digits):
+        plain[i % 2] += row
+
+        # Doubling, then subtracting 9 if the result is greater than 9.
+        doubled[i % 2] += row
+        doubled[i % 2] += row
+        doubled[i % 2] -= (row > 4) * np.uint16(9)
+
+    total = np.where(lengths % 2 == 0, doubled[0] + plain[1],
+                     doubled[1] + plain[0])
+    return total % 10 == 0
+
+
+@functools.lru_cache(maxsize=4)
+def prefix_index(table):
+    """Returns the card type table as NumPy arrays: {prefix length: (sorted
+    prefixes as ints, CARD_TYPES codes)} and a CARD_TYPES code x length bool
+    matrix of allowed lengths."""
+
+    index = {}
+    for length in table.prefix_lengths:
+        entries = sorted((int(prefix), CARD_TYPES.index(card_type))
+                         for prefix, (card_type, _) in table.prefixes.items()
+                         if len(prefix) == length)
+        index[length] = (np.array([p for p, _ in entries], dtype=np.int64),
+                         np.array([c for _, c in entries], dtype=np.uint8))
+
+    allowed = np.zeros((len(CARD_TYPES), MAX_LENGTH + 1), dtype=bool)
+    for card_type, lengths in table.lengths.items():
+        for length in lengths:
+            if length < MAX_LENGTH:
+                allowed[CARD_TYPES.index(card_type), length] = True
+
+    return index, allowed
+
+
+def card_types(digits, lengths, table=None):
+    """Returns an array of CARD_TYPES codes from the leading digits of each
+    card (0 for unknown headers), the same as validate_card_type."""
+
+    table = table or bin_table.TABLE
+    index, _ = prefix_index(table)
+
+    # Leading k digits of every card as an int, for each prefix length k.
+    prefixes = {}
+    prefix = np.zeros(digits.shape[1], dtype=np.int64)
+    for length in range(1, max(index, default=0) + 1):
+        if length <= len(digits):
+            prefix = prefix * 10 + digits[length - 1]
+        prefixes[length] = prefix
+
+    types = np.zeros(digits.shape[1], dtype=np.uint8)
+    found = np.zeros(digits.shape[1], dtype=bool)
+
+    # Longest matching prefix wins, the same as BinTable.lookup.
+    for length, (keys, codes) in index.items():
+        position = np.searchsorted(keys, prefixes[length])
+        position = np.minimum(position, len(keys) - 1)
+        hit = (keys[position] == prefixes[length]) & (lengths >= length) & \
+            ~found
+        types[hit] = codes[position[hit]]
+        found |= hit
+
+    return types
+
+
+def valid_lengths(types, lengths, table=None):
+    """Returns a bool array, True where the length is allowed for the card
+    type, the same as valid_card_length."""
+
+    _, allowed = prefix_index(table or bin_table.TABLE)
+    return allowed[types, np.minimum(lengths, MAX_LENGTH)]
+
+
+def validate_numbers(cc_numbers):
+    """Runs the card number checks of validate_card (header, length and
+    checksum) over cleaned card numbers. Returns (card_types, errors) code
+    arrays; rows with error 0 still need their expiration date checked."""
+
+    types = np.zeros(len(cc_numbers), dtype=np.uint8)
+    errors = np.zeros(len(cc_numbers), dtype=np.uint8)
+
+    for start in range(0, len(cc_numbers), CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        digits, lengths = digit_matrix(cc_numbers[chunk])
+
+        chunk_types = card_types(digits, lengths)
+        chunk_errors = np.zeros(len(lengths), dtype=np.uint8)
+
+        # Checks run in reverse order so the first failing check wins, the
+        # same as validate_card returning early.
+        chunk_errors[~luhn_valid(digits, lengths)] = BAD_CHECKSUM
+        chunk_errors[~valid_lengths(chunk_types, lengths)] = BAD_LENGTH
+        chunk_errors[chunk_types == 0] = BAD_HEADER
+        chunk_errors[lengths == 0] = BAD_FORMAT
+
+        types[chunk] = chunk_types
+        errors[chunk] = chunk_errors
+
+    return types, errors
+
+
+def validate_dates(exp_dates):
+    """Returns an array of ERRORS codes for a list of expiration dates (0 for
+    valid dates). Each distinct date is only checked once."""
+
+    unique_dates, inverse = np.unique(np.asarray(exp_dates, dtype=str),
+                                      return_inverse=True)
+
+    unique_errors = np.zeros(len(unique_dates), dtype=np.uint8)
+    for i, exp_date in enumerate(unique_dates):
+        valid_date = validate_expiration(exp_date)
+        if valid_date == -1:
+            unique_errors[i] = BAD_DATE
+        elif not valid_date:
+            unique_errors[i] = EXPIRED
+
+    return unique_errors[inverse.reshape(-1)]
+
+
+def validate_cards(cc_numbers, exp_dates, clean=True):
+    """Validates many cards at once, the same as calling validate_card on
+    each. Returns (valid, card_types, errors) arrays. Pass clean=False if the
+    card numbers have already been through format_cc."""
+
+    raw_numbers = cc_numbers
+    if clean:
+        cc_numbers = [format_cc(cc) if isinstance(cc, str) else "" for cc in
+                      cc_numbers]
+        cc_numbers = ["" if cc == -1 else cc for cc in cc_numbers]
+
+    # The digit matrix only takes ASCII digits. Cards with other unicode
+    # digits (which format_cc keeps) are checked one at a time instead.
+    scalar = [i for i, cc in enumerate(cc_numbers)
+              if isinstance(cc, str) and not cc.isascii()]
+    if scalar:
+        cc_numbers = list(cc_numbers)
+        for i in scalar:
+            cc_numbers[i] = ""
+
+    types, errors = validate_numbers(cc_numbers)
+
+    # The expiration date is only checked for cards that passed so far.
+    passed = np.flatnonzero(errors == 0)
+    if len(passed):
+        errors[passed] = validate_dates(np.asarray(exp_dates)[passed])
+
+    for i in scalar:
+        types[i], errors[i] = card_codes(raw_numbers[i], exp_dates[i])
+
+    return errors == 0, types, errors
+
+
+def to_results(types, errors):
+    """Converts code arrays back into validate_card style dicts."""
+    return [result_from_codes(t, e) for t, e in
+            zip(types.tolist(), errors.tolist())]
@@ -0,0 +1,135 @@
+"""This is the binary wire format of the credit-card microservice.
+Written by: Michelle Mann
+
+Plain JSON requests keep working. A request can instead start with a one byte
+tag to pick a binary encoding, and the reply comes back in the same encoding:
+
+    0x01 - compact struct. Each card is its # of digits (1 byte), the digits
+           as packed BCD (2 per byte) and the expiration month and 2-digit
+           year (1 byte each). Each result is its CARD_TYPES code and ERRORS
+           code (1 byte each, error 0 = valid).
+    0x02 - MessagePack (needs the msgpack package). Same requests as JSON,
+           but replies have "card_type" and "error" as CARD_TYPES / ERRORS
+           codes instead of strings.
+
+Struct frames are the tag, the # of records (uint32, little-endian), then the
+records.
+"""
+
+import struct
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional
+    msgpack = None
+
+
+STRUCT_TAG = b"\x01"
+MSGPACK_TAG = b"\x02"
+BINARY_TAGS = (STRUCT_TAG, MSGPACK_TAG)
+
+COUNT = struct.Struct("<I")
+RESULT = struct.Struct("<BB")
+
+# BCD byte -> its two digits. A 0xF nibble pads odd-length card numbers.
+BCD_DIGITS = [f"{high:X}{low:X}".replace("F", "") for high in range(16)
+              for low in range(16)]
+
+
+# ------------ All related to the compact struct format ----------- #
+
+def parse_exp_date(exp_date: str):
+    """Returns (month, year) for a "MM/YY" date, or (0, 0) if it's in any
+    other format (which the server reports as an invalid date format)."""
+
+    month, _, year = exp_date.partition("/")
+    if month.isdigit() and year.isdigit() and len(month) <= 2 and \
+            len(year) == 2:
+        return int(month), int(year)
+    return 0, 0
+
+
+def pack_cards(cards):
+    """Returns a struct request for a list of (cc_number, exp_date). Card
+    numbers must be digits only (see format_cc)."""
+
+    parts = [STRUCT_TAG, COUNT.pack(len(cards))]
+    for cc_number, exp_date in cards:
+        if not cc_number.isdigit() and cc_number:
+            raise ValueError("Card numbers must only contain digits")
+        digits = cc_number + "F" * (len(cc_number) % 2)
+        parts.append(bytes([len(cc_number)]))
+        parts.append(bytes.fromhex(digits))
+        parts.append(bytes(parse_exp_date(exp_date)))
+    return b"".join(parts)
+
+
+def unpack_cards(message: bytes):
+    """Returns the list of (cc_number, exp_date) strings in a struct request.
+    Raises ValueError if the message is cut short."""
+
+    if message[:1] != STRUCT_TAG or len(message) < 5:
+        raise ValueError("Not a struct request")
+
+    (count,) = COUNT.unpack_from(message, 1)
+    cards = []
+    position = 5
+    for _ in range(count):
+        # A count bigger than the records sent runs out of message here.
+        if position >= len(message):
+            raise ValueError("Struct request is cut short")
+        length = message[position]
+        end = position + 1 + (length + 1) // 2
+        if end + 2 > len(message):
+            raise ValueError("Struct request is cut short")
+
+        cc_number = "".join(BCD_DIGITS[b] for b in message[position + 1:end])
+        month, year = message[end], message[end + 1]
+        cards.append((cc_number, f"{month}/{year:02d}"))
+        position = end + 2
+
+    if position != len(message):
+        raise ValueError("Struct request has extra bytes")
+    return cards
+
+
+def pack_results(results):
+    """Returns a struct reply for a list of (card type, error) codes."""
+
+    return b"".join([STRUCT_TAG, COUNT.pack(len(results))] +
+                    [RESULT.pack(*result) for result in results])
+
+
+def unpack_results(message: bytes):
+    """Returns the list of (card type, error) codes in a struct reply."""
+
+    if message[:1] != STRUCT_TAG or len(message) < 5:
+        raise ValueError("Not a struct reply")
+
+    (count,) = COUNT.unpack_from(message, 1)
+    if len(message) != 5 + count * RESULT.size:
+        raise ValueError("Struct reply has the wrong length")
+    return [RESULT.unpack_from(message, 5 + i * RESULT.size)
+            for i in range(count)]
+
+
+# ------------ All related to MessagePack ----------- #
+
+def pack_msgpack(obj):
+    """Returns obj as a tagged MessagePack message."""
+
+    if msgpack is None:
+        raise RuntimeError("The msgpack package is not installed")
+    return MSGPACK_TAG + msgpack.packb(obj)
+
+
+def unpack_msgpack(message: bytes):
+    """Returns the object in a tagged MessagePack message. Raises ValueError
+    if it can't be decoded (or msgpack isn't installed)."""
+
+    if msgpack is None:
+        raise ValueError("The msgpack package is not installed")
+    try:
+        return msgpack.unpackb(message[1:])
+    except Exception as e:
+        raise ValueError(f"Invalid MessagePack: {e}") from e
@@ -5,34 +5,23 @@ This is the client side of the socket and should send the message
 "This is a message from CS361"
 """
 
-import zmq
 import json
-import time
-
-
-def send_reqest_test(request_data):
+import zmq
 
-    # Step #1: Set up the environment to enable socket creation.
-    context = zmq.Context()
+from cc_client import CardClient
 
-    # Step #2: Connect to the server to send a message.
-    print("Client attempting to connect to server...")
 
-    # Step #3: Creation of a request socket.
-    socket = context.socket(zmq.REQ)
+def send_reqest_test(client, request_data):
 
-    # Step #4: Specifies the host and port#
-    socket.connect("tcp://localhost:5557")
-
-    # Step #5: Prints a message to console that we are sending a request.
+    # Step #1: Sends the request on one of the client's pooled sockets. A
+    # stuck request is retried on a new socket after the client's timeout.
     print("Sending a request...")
-    socket.send_string(request_data)
+    reply = client.request(json.loads(request_data))
 
-    # Step #7: Get the reply.
-    message = socket.recv()
-    print(f"Server sent back: {message.decode()}")
+    # Step #2: Get the reply.
+    print(f"Server sent back: {json.dumps(reply)}")
 
-    return json.loads(message)
+    return reply
 
 
 # Creation of our credit card data.
@@ -47,25 +36,32 @@ test_cases = ["Valid Visa / Expired Date", "Valid MC / Bad Date Format",
               "Invalid Header"]
 
 
-# Coverts the JSON message to string.
-for i in range(len(cc_nums)):
-    credit_card_data = {
-        "cc_number": cc_nums[i],
-        "exp_date": exp_dates[i],
-        }
+if __name__ == "__main__":
+    print("Client attempting to connect to server...")
+    client = CardClient("tcp://localhost:5557")
+
+    # Coverts the JSON message to string.
+    for i in range(len(cc_nums)):
+        credit_card_data = {
+            "cc_number": cc_nums[i],
+            "exp_date": exp_dates[i],
+            }
 
-    print(test_cases[i])
+        print(test_cases[i])
 
-    json_message = json.dumps(credit_card_data)
-    send_reqest_test(json_message)
-    time.sleep(1)
+        json_message = json.dumps(credit_card_data)
+        send_reqest_test(client, json_message)
 
-# Send quit signal after all tests are done
-context = zmq.Context()
-socket = context.socket(zmq.REQ)
-socket.connect("tcp://localhost:5557")
-socket.send_string("Q")
-socket.close()
-context.term()
+    # The same cards again, as batch requests in one call.
+    print("All cards at once:")
+    for result in client.validate_many(zip(cc_nums, exp_dates)):
+        print(result)
+    client.close()
+
+    # Send quit signal after all tests are done
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect("tcp://localhost:5557")
+    socket.send_string("Q")
+    socket.close()
 
-print("All tests completed. Quit signal sent.")
+    print("All tests completed. Quit signal sent.")
@@ -0,0 +1,482 @@
+"""This is the load generator / soak test for the credit-card microservice.
+Written by: Michelle Mann
+
+Drives a server with many simulated clients (one DEALER socket each) at a
+fixed, open-loop request rate: requests go out on schedule whether or not
+earlier ones have been answered, like real traffic. Cards are drawn from the
+random_test.py generators in a configurable mix of valid, bad checksum, bad
+header and bad date cards.
+
+Latency is measured from when each request was *scheduled* to go out, so a
+stalled server (or generator) can't hide its queueing delay by slowing the
+senders down (coordinated omission). Uncorrected latencies are reported too.
+Every interval the throughput, errors and latency of that interval are added
+to a timeline, along with the server's RSS and open file descriptors for
+spotting leaks in long soak runs.
+
+Example calls:
+    python3 loadtest.py --rate 2000 --clients 50 --duration 30
+    python3 loadtest.py --rate 500,1000,2000,4000 --duration 10 \\
+        --output cap.json
+    python3 loadtest.py --soak --rate 1000 --duration 3600 --pid 1234 \\
+        --address tcp://127.0.0.1:5557
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import zmq  # For ZeroMQ
+import zmq.asyncio
+
+from benchmark import make_inputs, spawn_server, stop_server
+from cc_service import ERRORS
+
+
+# Card mix used unless --mix is given, as weights of benchmark.make_inputs
+# lists.
+DEFAULT_MIX = {"valid": 70, "bad_checksum": 10, "bad_header": 10,
+               "bad_date": 10}
+
+# Whole-request errors from the service itself (as opposed to cards that are
+# simply invalid).
+SERVICE_ERRORS = set(ERRORS[ERRORS.index("Invalid JSON format"):])
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# ------------ All related to latency histograms ----------- #
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds. Values below
+    2**SUB_BITS are exact, larger ones are kept to within 1%, so memory
+    stays small no matter how many values are recorded."""
+
+    SUB_BITS = 8
+
+    def __init__(self):
+        self.counts = collections.Counter()    # (shift, mantissa) -> count
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds: float):
+        us = max(0, int(seconds * 1e6))
+        shift = max(0, us.bit_length() - self.SUB_BITS)
+        self.counts[(shift, us >> shift)] += 1
+        self.count += 1
+        self.total += us
+        self.max = max(self.max, us)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def value_at(self, percentile: float):
+        """Returns the latency (us) that percentile % of values are at or
+        below."""
+
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(self.count * percentile / 100))
+        seen = 0
+        for shift, mantissa in sorted(self.counts):
+            seen += self.counts[(shift, mantissa)]
+            if seen >= target:
+                return min(((mantissa + 1) << shift) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        """Returns count, mean, percentiles and max in microseconds."""
+
+        result = {"count": self.count,
+                  "mean_us": self.total / self.count if self.count else 0}
+        for percentile in PERCENTILES:
+            result[f"p{percentile:g}_us"] = self.value_at(percentile)
+        result["max_us"] = self.max
+        return result
+
+
+# ------------ All related to requests ----------- #
+
+def parse_mix(spec: str):
+    """Parses "valid=70,bad_checksum=10,..." into a dict of weights."""
+
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def make_messages(mix=None, count=2000, batch=1, seed=361):
+    """Returns a list of encoded requests with cards drawn from the mix.
+    Each request has batch cards (sent as a JSON array if batch > 1)."""
+
+    mix = mix or DEFAULT_MIX
+    inputs = make_inputs(max(100, count * batch // 4), seed)
+    unknown = set(mix) - set(inputs)
+    if unknown:
+        raise ValueError(f"Unknown card kinds: {', '.join(sorted(unknown))}"
+                         f" (choose from {', '.join(inputs)})")
+
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()),
+                        k=count * batch)
+    cards = [{"cc_number": cc, "exp_date": exp} for cc, exp in
+             (rng.choice(inputs[kind]) for kind in kinds)]
+
+    if batch == 1:
+        return [json.dumps(card).encode() for card in cards]
+    return [json.dumps(cards[i:i + batch]).encode()
+            for i in range(0, len(cards), batch)]
+
+
+def classify(reply: bytes):
+    """Returns "ok" for a reply with card results, otherwise the service
+    error it carries."""
+
+    try:
+        reply = json.loads(reply)
+    except ValueError:
+        return "Bad reply"
+
+    if isinstance(reply, dict):
+        error = reply.get("error", "")
+        if error.startswith("Unexpected error"):
+            return "Unexpected error"
+        if error in SERVICE_ERRORS:
+            return error
+    return "ok"
+
+
+# ------------ All related to watching the server process ----------- #
+
+def process_resources(pid: int):
+    """Returns {"rss_kb", "fds"} for a process, or None if /proc isn't
+    there (Linux only)."""
+
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss = next(int(line.split()[1]) for line in status
+                       if line.startswith("VmRSS:"))
+        return {"rss_kb": rss, "fds": len(os.listdir(f"/proc/{pid}/fd"))}
+    except (OSError, StopIteration, ValueError):
+        return None
+
+
+def resource_trend(samples, rss_growth=0.10, fd_growth=5):
+    """Compares the first and last quarter of the resource samples (after
+    the first quarter as warm up). Returns the growth and whether it looks
+    like a leak."""
+
+    samples = [s for s in samples if s is not None]
+    if len(samples) < 8:
+        return None
+
+    quarter = len(samples) // 4
+    early, late = samples[quarter:2 * quarter], samples[-quarter:]
+    rss = [statistics.median(s["rss_kb"] for s in part)
+           for part in (early, late)]
+    fds = [statistics.median(s["fds"] for s in part) for part in (early, late)]
+    return {"rss_kb_start": rss[0], "rss_kb_end": rss[1],
+            "fds_start": fds[0], "fds_end": fds[1],
+            "leak_suspected": rss[1] > rss[0] * (1 + rss_growth) or
+            fds[1] - fds[0] >= fd_growth}
+
+
+# ------------ All related to generating load ----------- #
+
+class Window:
+    """Counts for one timeline interval."""
+
+    def __init__(self):
+        self.sent = 0
+        self.outcomes = collections.Counter()
+        self.latency = LatencyHistogram()
+
+
+class LoadRun:
+    """One open-loop run against a server.
+
+    rate     - requests per second, split evenly over the clients.
+    clients  - simulated clients, each with its own DEALER socket (and so its
+               own identity for per-client rate limits).
+    poisson  - random (exponential) gaps between requests instead of even
+               ones.
+    timeout  - seconds before a request without a reply counts as a timeout.
+    interval - seconds per timeline entry.
+    pid      - server process to watch RSS / file descriptors of.
+    """
+
+    def __init__(self, address, messages, rate=1000.0, clients=10,
+                 duration=10.0, poisson=False, timeout=5.0, interval=1.0,
+                 pid=None, seed=361):
+        self.address = address
+        self.messages = messages
+        self.rate = rate
+        self.clients = clients
+        self.duration = duration
+        self.poisson = poisson
+        self.timeout = timeout
+        self.interval = interval
+        self.pid = pid
+        self.seed = seed
+
+        self.corrected = LatencyHistogram()
+        self.uncorrected = LatencyHistogram()
+        self.outcomes = collections.Counter()
+        self.sent = 0
+        self.late_sends = 0
+        self.window = Window()
+        self.timeline = []
+        self.resources = []
+        self.waiting = {}       # tag -> (scheduled, sent)
+        self.tags = itertools.count()
+
+    def record(self, outcome: str, scheduled: float, sent: float,
+               now: float):
+        self.outcomes[outcome] += 1
+        self.window.outcomes[outcome] += 1
+        if outcome != "timeout":
+            self.corrected.record(now - scheduled)
+            self.uncorrected.record(now - sent)
+            self.window.latency.record(now - scheduled)
+
+    async def client(self, n: int, socket, start: float, end: float):
+        """Sends requests on schedule until the run ends."""
+
+        loop = asyncio.get_running_loop()
+        rng = random.Random(self.seed + n)
+        rate = self.rate / self.clients
+        messages = self.messages[n::self.clients] or self.messages
+
+        # Spreads the clients' first requests over one gap.
+        scheduled = start + rng.random() / rate
+        for i in itertools.count():
+            if scheduled >= end:
+                return
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -0.001:
+                self.late_sends += 1
+
+            tag = next(self.tags).to_bytes(8, "little")
+            self.waiting[tag] = (scheduled, loop.time())
+            await socket.send_multipart([tag, b"",
+                                         messages[i % len(messages)]])
+            self.sent += 1
+            self.window.sent += 1
+
+            scheduled += rng.expovariate(rate) if self.poisson else 1 / rate
+
+    async def reader(self, socket):
+        """Records the latency and outcome of each reply."""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            frames = await socket.recv_multipart()
+            entry = self.waiting.pop(frames[0], None)
+            if entry is not None:   # Otherwise it already timed out.
+                self.record(classify(frames[-1]), *entry, loop.time())
+
+    def expire(self, now: float):
+        """Counts requests that have waited longer than the timeout."""
+
+        for tag, (scheduled, sent) in list(self.waiting.items()):
+            if now - sent >= self.timeout:
+                del self.waiting[tag]
+                self.record("timeout", scheduled, sent, now)
+
+    def close_window(self, elapsed: float):
+        """Adds the current interval to the timeline and starts a new one."""
+
+        window, self.window = self.window, Window()
+        entry = {"t": round(elapsed, 3), "sent": window.sent,
+                 "replies_per_sec": sum(count for outcome, count in
+                                        window.outcomes.items()
+                                        if outcome != "timeout")
+                 / self.interval,
+                 "outcomes": dict(window.outcomes),
+                 "p50_us": window.latency.value_at(50),
+                 "p99_us": window.latency.value_at(99)}
+
+        if self.pid is not None:
+            resources = process_resources(self.pid)
+            self.resources.append(resources)
+            if resources is not None:
+                entry.update(resources)
+        self.timeline.append(entry)
+        return entry
+
+    async def run(self, on_interval=None):
+        """Runs the load and returns the report dict."""
+
+        loop = asyncio.get_running_loop()
+        context = zmq.asyncio.Context()
+        sockets = []
+        for _ in range(self.clients):
+            socket = context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.address)
+            sockets.append(socket)
+
+        readers = [asyncio.create_task(self.reader(s)) for s in sockets]
+        start = loop.time() + 0.05
+        end = start + self.duration
+        senders = [asyncio.create_task(self.client(n, s, start, end))
+                   for n, s in enumerate(sockets)]
+
+        # Closes a timeline window every interval until the last request is
+        # answered or times out.
+        next_window = start + self.interval
+        while loop.time() < end or self.waiting:
+            await asyncio.sleep(max(0.0, min(next_window, end + self.timeout)
+                                    - loop.time()))
+            now = loop.time()
+            self.expire(now)
+            if now >= next_window:
+                entry = self.close_window(next_window - start)
+                next_window += self.interval
+                if on_interval is not None:
+                    on_interval(entry)
+            if now >= end + self.timeout:
+                break
+        elapsed = loop.time() - start
+
+        for task in senders + readers:
+            task.cancel()
+        await asyncio.gather(*senders, *readers, return_exceptions=True)
+        for socket in sockets:
+            socket.close()
+        context.term()
+
+        replies = sum(count for outcome, count in self.outcomes.items()
+                      if outcome != "timeout")
+        return {"rate": self.rate, "clients": self.clients,
+                "duration": self.duration, "sent": self.sent,
+                "replies": replies,
+                "replies_per_sec": replies / elapsed,
+                "late_sends": self.late_sends,
+                "outcomes": dict(self.outcomes),
+                "error_rate": 1 - self.outcomes["ok"] / self.sent
+                if self.sent else 0.0,
+                "latency": self.corrected.summary(),
+                "uncorrected_latency": self.uncorrected.summary(),
+                "timeline": self.timeline,
+                "resources": resource_trend(self.resources)}
+
+
+def run_load(address, messages, **kwargs):
+    """Runs a LoadRun to completion and returns its report."""
+    on_interval = kwargs.pop("on_interval", None)
+    return asyncio.run(LoadRun(address, messages, **kwargs).run(on_interval))
+
+
+# ------------ All related to the command line ----------- #
+
+def print_interval(entry):
+    errors = {k: v for k, v in entry["outcomes"].items() if k != "ok"}
+    resources = f"  rss {entry['rss_kb']} kB  fds {entry['fds']}" \
+        if "rss_kb" in entry else ""
+    print(f"{entry['t']:8.1f}s {entry['replies_per_sec']:9.0f} replies/s  "
+          f"p50 {entry['p50_us'] / 1000:7.2f} ms  "
+          f"p99 {entry['p99_us'] / 1000:7.2f} ms  {errors or ''}{resources}",
+          file=sys.stderr)
+
+
+def print_summary(report):
+    latency = report["latency"]
+    print(f"rate {report['rate']:g}/s: {report['replies_per_sec']:.0f} "
+          f"replies/s, errors {report['error_rate']:.2%}, "
+          f"p50 {latency['p50_us'] / 1000:.2f} ms, "
+          f"p99 {latency['p99_us'] / 1000:.2f} ms, "
+          f"p99.9 {latency['p99.9_us'] / 1000:.2f} ms "
+          f"(uncorrected p99 "
+          f"{report['uncorrected_latency']['p99_us'] / 1000:.2f} ms)",
+          file=sys.stderr)
+    if report["late_sends"]:
+        print(f"  {report['late_sends']} requests went out late - the load "
+              f"generator couldn't keep up with this rate", file=sys.stderr)
+    if report["resources"] and report["resources"]["leak_suspected"]:
+        print(f"  possible leak: {report['resources']}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Open-loop load generator for cc_service")
+    parser.add_argument("--address",
+                        help="server to test (default: start cc_service.py "
+                             "on a free port)")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments for the started server")
+    parser.add_argument("--rate", default="1000",
+                        help="requests/s, or a comma separated list of rates "
+                             "to step through")
+    parser.add_argument("--clients", type=int, default=10,
+                        help="simulated clients (DEALER sockets)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds per rate")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="cards per request")
+    parser.add_argument("--mix",
+                        help="card mix, e.g. valid=70,bad_checksum=10,"
+                             "bad_header=10,bad_date=10 (the default)")
+    parser.add_argument("--poisson", action="store_true",
+                        help="random gaps between requests instead of even "
+                             "ones")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="seconds before a request counts as timed out")
+    parser.add_argument("--interval", type=float, default=1,
+                        help="seconds per timeline entry")
+    parser.add_argument("--soak", action="store_true",
+                        help="watch the server's RSS and file descriptors "
+                             "for leaks")
+    parser.add_argument("--pid", type=int,
+                        help="server process to watch with --address")
+    parser.add_argument("--output", help="write the report JSON here")
+    args = parser.parse_args(argv)
+
+    messages = make_messages(parse_mix(args.mix) if args.mix else None,
+                             batch=args.batch)
+    server = None
+    address = args.address
+    if address is None:
+        server, address = spawn_server(args.server_args.split())
+
+    pid = args.pid if args.pid else server.pid if server else None
+    reports = []
+    try:
+        for rate in args.rate.split(","):
+            report = run_load(address, messages, rate=float(rate),
+                              clients=args.clients, duration=args.duration,
+                              poisson=args.poisson, timeout=args.timeout,
+                              interval=args.interval,
+                              pid=pid if args.soak else None,
+                              on_interval=print_interval)
+            print_summary(report)
+            reports.append(report)
+    finally:
+        if server is not None:
+            stop_server(server, address)
+
+    output = json.dumps({"address": address, "batch": args.batch,
+                         "runs": reports}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,115 @@
 import unittest
 import random
 from cc_service import format_cc, validate_card_type, valid_card_length
-from cc_service import validate_luhn
+from cc_service import validate_luhn, scan_card, validate_card
+
+
+# # # Helper function #1 -- invalid headers...
+def generate_invalid_header():
+    """Generates a random card header that is NOT Visa, MasterCard,
+    or AmEx."""
+    while True:
+        # Randomly choose header length: 1, 2, 3, or 4 digits
+        header_length = random.choice([1, 2, 3, 4])
+        header = str(random.randint(10**(header_length-1),
+                                    (10**header_length)-1))
+
+        # Ensure it's NOT Visa, MasterCard, or AmEx
+        if not (header.startswith("4") or       # Visa (4)
+                51 <= int(header[:2]) <= 55 or  # MasterCard (51-55)
+                2221 <= int(header) <= 2720 or  # MasterCard: 2221-2720
+                header.startswith("34") or      # AmEx (34)
+                header.startswith("37")):       # AmEx (37)
+            return header  # Return valid "invalid" header
+
+
+# # # Helper function #2 -- generate digits.
+def generate_random_digits(length):
+    """Generates a string of random digits with the given length."""
+    return "".join(str(random.randint(0, 9)) for _ in range(length))
+
+
+# # # Helper function #3 -- generate a whole card #.
+def generate_random_card():
+    """Generates a random card # and returns (card_no, expected_type,
+    make_luhn_valid). Lengths, headers, checksums and separators are all
+    random."""
+
+    edge_cases = [12, 13, 14, 17, 18, 19]  # Edge case lengths
+
+    # Randomly determine the card length
+    odds_len = random.randint(0, 2)
+    if odds_len == 1:
+        length = random.choice(edge_cases)  # Edge case lengths
+    elif odds_len == 2:
+        length = random.randint(10, 25)  # Extreme lengths
+    else:
+        length = random.choice([15, 16])  # Normal valid length
+
+    odds_header = random.randint(0, 4)
+
+    header_types = ["Visa", "MC", "MC", "AmEx", "AmEx", "Other"]
+
+    prefixes = [[4, 4], [51, 55], [2221, 2720], [34, 34], [37, 37]]
+
+    if header_types[odds_header] == "Other":
+        header = generate_invalid_header()
+    else:
+        start, end = prefixes[odds_header]
+        header = random.randint(start, end)
+
+    header = str(header)
+
+    if header_types[odds_header] != "Other":
+        expected_type = header_types[odds_header]
+    else:
+        expected_type = -1
+
+    # Determine remaining digits needed to meet length
+    remaining_length = length - len(header) - 1  # -1 for Luhn
+
+    # Ensure remaining numbers are valid digits
+    card_no = header + generate_random_digits(remaining_length)
+
+    # **New: Coin flip for Luhn validity**
+    make_luhn_valid = random.choice([True, False])
+
+    # Compute correct Luhn check digit
+    digits = [int(d) for d in str(card_no)]
+    for i in range(len(digits) - 1, -1, -2):
+        digits[i] *= 2
+        if digits[i] > 9:
+            digits[i] -= 9
+
+    total = sum(digits)
+    check_digit = (10 - (total % 10)) % 10
+
+    if make_luhn_valid:
+        card_no += str(check_digit)
+    else:
+        wrong_check_digit = (check_digit + 1) % 10
+        card_no += str(wrong_check_digit)
+
+    # 33% chance of adding spaces or dashes
+    odds_sep = random.randint(0, 2)
+    if odds_sep == 1:
+        card_no = " ".join([card_no[i:i + 4] for i in
+                            range(0, len(card_no), 4)])
+    elif odds_sep == 2:
+        card_no = "-".join([card_no[i:i+4] for i in
+                            range(0, len(card_no), 4)])
+
+    return card_no, expected_type, make_luhn_valid
 
 
 class TestCase(unittest.TestCase):
     def test_random_cc_nums(self):
 
-        # # # Helper function #1 -- invalid headers...
-        def generate_invalid_header():
-            """Generates a random card header that is NOT Visa, MasterCard,
-            or AmEx."""
-            while True:
-                # Randomly choose header length: 1, 2, 3, or 4 digits
-                header_length = random.choice([1, 2, 3, 4])
-                header = str(random.randint(10**(header_length-1),
-                                            (10**header_length)-1))
-
-                # Ensure it's NOT Visa, MasterCard, or AmEx
-                if not (header.startswith("4") or       # Visa (4)
-                        51 <= int(header[:2]) <= 55 or  # MasterCard (51-55)
-                        2221 <= int(header) <= 2720 or  # MasterCard: 2221-2720
-                        header.startswith("34") or      # AmEx (34)
-                        header.startswith("37")):       # AmEx (37)
-                    return header  # Return valid "invalid" header
-
-        # # # Helper function #2 -- generate digits.
-        def generate_random_digits(length):
-            """Generates a string of random digits with the given length."""
-            return "".join(str(random.randint(0, 9)) for _ in range(length))
-
         # Random test Generation starts here!
         tests_to_generate = 1000  # Number of randomized test cases
 
         for i in range(tests_to_generate):
-            edge_cases = [12, 13, 14, 17, 18, 19]  # Edge case lengths
-
-            # Randomly determine the card length
-            odds_len = random.randint(0, 2)
-            if odds_len == 1:
-                length = random.choice(edge_cases)  # Edge case lengths
-            elif odds_len == 2:
-                length = random.randint(10, 25)  # Extreme lengths
-            else:
-                length = random.choice([15, 16])  # Normal valid length
-
-            odds_header = random.randint(0, 4)
-
-            header_types = ["Visa", "MC", "MC", "AmEx", "AmEx", "Other"]
-
-            prefixes = [[4, 4], [51, 55], [2221, 2720], [34, 34], [37, 37]]
-
-            if header_types[odds_header] == "Other":
-                header = generate_invalid_header()
-            else:
-                start, end = prefixes[odds_header]
-                header = random.randint(start, end)
-
-            header = str(header)
-
-            if header_types[odds_header] != "Other":
-                expected_type = header_types[odds_header]
-            else:
-                expected_type = -1
-
-            # Determine remaining digits needed to meet length
-            remaining_length = length - len(header) - 1  # -1 for Luhn
-
-            # Ensure remaining numbers are valid digits
-            card_no = header + generate_random_digits(remaining_length)
-
-            # **New: Coin flip for Luhn validity**
-            make_luhn_valid = random.choice([True, False])
-
-            # Compute correct Luhn check digit
-            digits = [int(d) for d in str(card_no)]
-            for i in range(len(digits) - 1, -1, -2):
-                digits[i] *= 2
-                if digits[i] > 9:
-                    digits[i] -= 9
-
-            total = sum(digits)
-            check_digit = (10 - (total % 10)) % 10
-
-            if make_luhn_valid:
-                card_no += str(check_digit)
-            else:
-                wrong_check_digit = (check_digit + 1) % 10
-                card_no += str(wrong_check_digit)
-
-            # 33% chance of adding spaces or dashes
-            odds_sep = random.randint(0, 2)
-            if odds_sep == 1:
-                card_no = " ".join([card_no[i:i + 4] for i in
-                                    range(0, len(card_no), 4)])
-            elif odds_sep == 2:
-                card_no = "-".join([card_no[i:i+4] for i in
-                                    range(0, len(card_no), 4)])
+            card_no, expected_type, make_luhn_valid = generate_random_card()
 
             # Run each validation function in a subtest
             with self.subTest(card_no=card_no):
@@ -126,6 +139,43 @@ class TestCase(unittest.TestCase):
                     self.assertFalse(valid_card_length(card_no, expected_type),
                                      f"valid_card_length failed for {card_no}")
 
+    def test_scan_card_matches(self):
+        """Tests scan_card gives the same answers as format_cc,
+        validate_card_type and validate_luhn on random cards."""
+
+        cards = [generate_random_card()[0] for _ in range(1000)]
+        cards += [generate_invalid_header() + generate_random_digits(12)
+                  for _ in range(200)]
+        cards += ["", "    ", "0", "7", "4-", "--4111--", "a4b1c1d1",
+                  "\u0664111111111111111", "4111111111111111\n"]
+
+        for card_no in cards:
+            with self.subTest(card_no=card_no):
+                clean = format_cc(card_no)
+                length, header, luhn_valid = scan_card(card_no)
+
+                if clean == -1:
+                    self.assertEqual(length, 0)
+                    continue
+
+                self.assertEqual(length, len(clean))
+                self.assertEqual(validate_card_type(header),
+                                 validate_card_type(clean))
+                self.assertEqual(luhn_valid, validate_luhn(clean))
+
+                # validate_card built from the separate functions.
+                card_type = validate_card_type(clean)
+                if card_type == -1:
+                    expected = "Unknown card header"
+                elif not valid_card_length(clean, card_type):
+                    expected = "Incorrect length"
+                elif not validate_luhn(clean):
+                    expected = "Invalid checksum"
+                else:
+                    expected = None
+                self.assertEqual(validate_card(card_no, "12/40").get(
+                    "error"), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+import json
+import time
+import unittest
+
+from cc_admission import AdmissionControl, TokenBucket, request_cost
+from cc_service import ERRORS, error_reply, expired
+from cc_wire import pack_cards, unpack_results
+
+
+class FakeTime:
+    """A clock that only moves when told to."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+CARD = json.dumps({"cc_number": "4111111111111111",
+                   "exp_date": "12/40"}).encode()
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_refill(self):
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        self.assertEqual(bucket.take(1, 0), 0)
+        self.assertEqual(bucket.take(1, 0), 0)
+        self.assertAlmostEqual(bucket.take(1, 0), 0.1)
+        self.assertEqual(bucket.take(1, 0.1), 0)
+
+    def test_big_batch(self):
+        """Tests a batch bigger than the burst goes through on a full bucket
+        and leaves it in debt."""
+        bucket = TokenBucket(rate=10, burst=5, now=0)
+        self.assertEqual(bucket.take(20, 0), 0)
+        self.assertAlmostEqual(bucket.take(1, 0), 1.6)
+
+    def test_cost(self):
+        self.assertEqual(request_cost(CARD), 1)
+        self.assertEqual(request_cost(b"[" + b",".join([CARD] * 3) + b"]"), 3)
+        self.assertEqual(request_cost(b"not json"), 1)
+        self.assertEqual(request_cost(pack_cards(
+            [("4111111111111111", "12/40")] * 4)), 4)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def test_rate_per_client(self):
+        """Tests one client running out of tokens doesn't limit another."""
+        clock = FakeTime()
+        admission = AdmissionControl(rate=1, burst=2, time_source=clock)
+        self.assertEqual(admission.offer(b"a", CARD, 1), 0)
+        self.assertEqual(admission.offer(b"a", CARD, 2), 0)
+        self.assertAlmostEqual(admission.offer(b"a", CARD, 3), 1)
+        self.assertEqual(admission.offer(b"b", CARD, 4), 0)
+        self.assertEqual(admission.rate_limited, 1)
+
+        clock.now += 1
+        self.assertEqual(admission.offer(b"a", CARD, 5), 0)
+
+    def test_queue_full(self):
+        """Tests requests are shed with retry_after once the queue is full."""
+        admission = AdmissionControl(max_queue=2, retry_after=0.5)
+        self.assertEqual(admission.offer(b"a", CARD, 1), 0)
+        self.assertEqual(admission.offer(b"a", CARD, 2), 0)
+        self.assertEqual(admission.offer(b"b", CARD, 3), 0.5)
+        self.assertEqual((len(admission), admission.shed), (2, 1))
+
+        admission.take()
+        self.assertEqual(admission.offer(b"b", CARD, 3), 0)
+
+    def test_round_robin(self):
+        """Tests a client with a backlog doesn't hold up the others."""
+        admission = AdmissionControl()
+        for i in range(3):
+            admission.offer(b"flood", CARD, f"flood{i}")
+        admission.offer(b"quiet", CARD, "quiet")
+
+        taken = [admission.take() for _ in range(len(admission))]
+        self.assertEqual(taken, ["flood0", "quiet", "flood1", "flood2"])
+
+    def test_max_clients(self):
+        admission = AdmissionControl(rate=1, max_clients=2)
+        for client in (b"a", b"b", b"c"):
+            admission.admit(client, CARD)
+        self.assertEqual(list(admission.buckets), [b"b", b"c"])
+
+
+class TestDeadlines(unittest.TestCase):
+    def test_expired(self):
+        request = {"cc_number": "4111111111111111", "deadline": 1.0}
+        self.assertTrue(expired(request))
+        self.assertNotIn("deadline", request)
+
+        self.assertFalse(expired({"deadline": 4102444800}))
+        self.assertFalse(expired({"deadline": "soon"}))
+        self.assertFalse(expired({"cc_number": "4111111111111111"}))
+        self.assertFalse(expired([{"deadline": 1.0}]))
+
+    def test_timeout_ms(self):
+        """Tests timeout_ms counts from when the request came in."""
+        request = {"cc_number": "4111111111111111", "timeout_ms": 500}
+        self.assertTrue(expired(request, time.monotonic() - 1))
+        self.assertNotIn("timeout_ms", request)
+
+        self.assertFalse(expired({"timeout_ms": 500}, time.monotonic()))
+        self.assertFalse(expired({"timeout_ms": 500}))
+        self.assertFalse(expired({"timeout_ms": True}, time.monotonic() - 1))
+
+        # Either limit passing is enough.
+        self.assertTrue(expired({"timeout_ms": 60000, "deadline": 1.0},
+                                time.monotonic()))
+
+    def test_error_reply(self):
+        """Tests error replies come back in the request's wire format."""
+        reply = json.loads(error_reply(CARD, "Service overloaded",
+                                       retry_after=0.2))
+        self.assertEqual(reply, {"valid": False, "error": "Service overloaded",
+                                 "retry_after": 0.2})
+
+        message = pack_cards([("4111111111111111", "12/40")] * 2)
+        code = ERRORS.index("Service overloaded")
+        self.assertEqual(unpack_results(error_reply(message,
+                                                    "Service overloaded")),
+                         [(0, code), (0, code)])
+
+
+if __name__ == '__main__':
+    unittest.main()
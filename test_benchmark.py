@@ -0,0 +1,50 @@
+import unittest
+
+import cc_service
+from benchmark import (bench_function, bench_result_memory, bench_startup,
+                       compare, make_inputs)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_inputs(self):
+        """Tests the generated inputs fail (or pass) where they should."""
+        inputs = make_inputs(50)
+        expected = {"valid": None, "bad_header": "Unknown card header",
+                    "bad_checksum": "Invalid checksum"}
+        for name, error in expected.items():
+            for cc, exp in inputs[name]:
+                self.assertEqual(cc_service.validate_card(cc, exp).get(
+                    "error"), error, cc)
+
+    def test_bench_function(self):
+        """Tests a function benchmark reports ops/s and percentiles."""
+        result = bench_function(cc_service.validate_luhn,
+                                [("4111111111111111",)], min_time=0.01)
+        self.assertGreater(result["ops_per_sec"], 0)
+        self.assertLessEqual(result["p50_us"], result["max_us"])
+
+    def test_bench_startup(self):
+        """Tests import and cold start times are reported for a module."""
+        result = bench_startup(("cc_core",), repeat=1)
+        self.assertEqual(set(result), {"import/cc_core", "cold_start/cc_core"})
+        self.assertGreater(result["cold_start/cc_core"]["median_us"], 0)
+
+    def test_result_memory(self):
+        """Tests a BatchResult takes far less memory than dicts."""
+        result = bench_result_memory(500)
+        self.assertEqual(result["dicts"]["results"], 500)
+        self.assertLess(result["batch_result"]["bytes_per_result"] * 10,
+                        result["dicts"]["bytes_per_result"])
+
+    def test_compare(self):
+        """Tests slower runs are reported as regressions."""
+        old = {"functions": {"a": {"ops_per_sec": 100, "p99_us": 10}}}
+        new = {"functions": {"a": {"ops_per_sec": 80, "p99_us": 10.5}}}
+        regressions = compare(old, new)
+        self.assertEqual([(r[0], r[1]) for r in regressions],
+                         [("a", "ops_per_sec")])
+        self.assertEqual(compare(old, old), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from bin_table import BinTable, expand_prefixes
+
+
+EXTENDED = BinTable.load("card_ranges_extended.json")
+
+
+class TestBinTable(unittest.TestCase):
+    def test_expand_range(self):
+        """Tests a prefix range is expanded with its leading zeros."""
+        self.assertEqual(expand_prefixes("051-053"), ["051", "052", "053"])
+        self.assertEqual(expand_prefixes("4"), ["4"])
+
+    def test_bad_range(self):
+        """Tests ranges with different # of digits are rejected."""
+        for entry in ["5-55", "55-51", "4a", "1234567"]:
+            with self.assertRaises(ValueError):
+                expand_prefixes(entry)
+
+    def test_duplicate_prefix(self):
+        """Tests a prefix listed by two networks is rejected."""
+        with self.assertRaises(ValueError):
+            BinTable({"A": {"prefixes": ["4"], "lengths": [16]},
+                      "B": {"prefixes": ["3-5"], "lengths": [16]}})
+
+    def test_lookup(self):
+        """Tests card type and lengths come back in one lookup."""
+        self.assertEqual(EXTENDED.lookup("6011000990139424"),
+                         ("Discover", frozenset({16, 17, 18, 19})))
+        self.assertEqual(EXTENDED.lookup("3530111333300000")[0], "JCB")
+        self.assertEqual(EXTENDED.lookup("6200000000000005")[0], "UnionPay")
+        self.assertEqual(EXTENDED.lookup("36227206271667")[0], "Diners")
+        self.assertEqual(EXTENDED.lookup("2221000000000009")[0], "MC")
+        self.assertIsNone(EXTENDED.lookup("2220000000000000"))
+        self.assertIsNone(EXTENDED.lookup("1234"))
+
+    def test_longest_prefix(self):
+        """Tests the longest matching prefix wins."""
+        table = BinTable({"A": {"prefixes": ["6"], "lengths": [16]},
+                          "B": {"prefixes": ["6011"], "lengths": [16]}})
+        self.assertEqual(table.lookup("6011000000000000")[0], "B")
+        self.assertEqual(table.lookup("6012000000000000")[0], "A")
+        self.assertEqual(table.lookup("60")[0], "A")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import random
+import tempfile
+import unittest
+
+from cc_bulk import BulkValidator, summary, validate_path, write_results
+from cc_core import ERRORS, card_codes
+from random_test import generate_random_card
+
+
+CARDS = ["4111111111111111", "4111-1111-1111-1112", "378282246310005",
+         "6011111111111117", "1234567812345678", "", "abc", "4", "37",
+         "4111 1111 1111 1111 "]
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "pans.txt")
+
+    def write(self, data: bytes):
+        with open(self.path, "wb") as file:
+            file.write(data)
+        return self.path
+
+    def expected(self, cards):
+        # The files have no dates, so any valid date gives the same codes.
+        return [card_codes(cc, "12/40") for cc in cards]
+
+    def test_matches_card_codes(self):
+        """Tests the results match card_codes for random cards."""
+        random.seed(7)
+        cards = CARDS + [generate_random_card()[0] for _ in range(2000)]
+        cards = [cc for cc in cards if cc.isascii()]
+        results = validate_path(self.write("\n".join(cards).encode()))
+        self.assertEqual(list(results.codes()), self.expected(cards))
+        self.assertEqual(list(results.valid),
+                         [int(not error) for error in results.errors])
+
+    def test_line_endings(self):
+        """Tests CRLF files and a missing last newline."""
+        for data in [b"\r\n".join(c.encode() for c in CARDS) + b"\r\n",
+                     b"\n".join(c.encode() for c in CARDS)]:
+            results = validate_path(self.write(data))
+            self.assertEqual(list(results.codes()), self.expected(CARDS))
+
+    def test_fixed_width(self):
+        """Tests fixed-width records, padded with spaces."""
+        data = b"".join(cc.encode().ljust(23) + b"\n" for cc in CARDS)
+        results = validate_path(self.write(data), width=24)
+        self.assertEqual(list(results.codes()), self.expected(CARDS))
+
+    def test_empty(self):
+        self.assertEqual(len(validate_path(self.write(b""))), 0)
+        self.assertEqual(len(BulkValidator().validate_lines(b"")), 0)
+
+    def test_write_results(self):
+        """Tests the columns are written one after the other."""
+        results = BulkValidator().validate_lines(b"4111111111111111\n4\n")
+        out = self.path + ".bin"
+        write_results(out, results)
+        with open(out, "rb") as file:
+            self.assertEqual(file.read(), bytes([1, 0, 1, 1, 0, 3]))
+
+        self.assertEqual(summary(results),
+                         {"rows": 2, "valid": 1,
+                          "errors": {ERRORS[3]: 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
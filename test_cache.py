@@ -0,0 +1,104 @@
+import unittest
+from datetime import datetime
+
+import cc_core
+import cc_service
+from cc_cache import ValidationCache
+from cc_service import ExpiryClock, validate_card
+
+
+class FakeTime:
+    """A clock that only moves when told to."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        """Tests a repeated card is answered from the cache."""
+        cache = ValidationCache()
+        first = cache.validate("4111 1111 1111 1111", "12/40")
+        second = cache.validate("4111-1111-1111-1111", "12/40")
+        self.assertEqual(first, validate_card("4111111111111111", "12/40"))
+        self.assertEqual(second, first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_no_raw_pan(self):
+        """Tests card numbers aren't kept in the cache."""
+        cache = ValidationCache()
+        cache.validate("4111111111111111", "12/40")
+        self.assertNotIn("4111111111111111", repr(cache.entries))
+        self.assertNotIn(b"4111111111111111", b"".join(cache.entries))
+
+    def test_copies(self):
+        """Tests changing a returned result doesn't change the cache."""
+        cache = ValidationCache()
+        cache.validate("4111111111111111", "12/40")["valid"] = "changed"
+        self.assertTrue(cache.validate("4111111111111111", "12/40")["valid"])
+
+    def test_lru_eviction(self):
+        """Tests the least recently used entries go when full."""
+        cache = ValidationCache()
+        cache.validate("4111111111111111", "12/40")
+        cache.max_bytes = cache.size * 2
+        cache.validate("5199111111111113", "5/40")
+        cache.validate("4111111111111111", "12/40")  # now most recent
+        cache.validate("340000000000009", "5/40")
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        cache.validate("4111111111111111", "12/40")
+        self.assertEqual(cache.hits, 2)
+
+    def test_ttl(self):
+        """Tests entries expire after the TTL."""
+        fake = FakeTime()
+        cache = ValidationCache(ttl=10, time_source=fake)
+        cache.validate("1234567891234563", "10/30")
+        fake.now += 11
+        cache.validate("1234567891234563", "10/30")
+        self.assertEqual((cache.hits, cache.expirations), (0, 1))
+
+    def test_month_rollover(self):
+        """Tests results depending on the date expire with the month."""
+        now = [datetime(2025, 3, 31, 23, 59, 50).timestamp()]
+        clock = ExpiryClock(lambda: now[0])
+        fake = FakeTime()
+        cache = ValidationCache(clock=clock, time_source=fake)
+        original = cc_core.CLOCK
+        cc_core.CLOCK = clock
+        self.addCleanup(setattr, cc_core, "CLOCK", original)
+
+        self.assertTrue(cache.validate("4111111111111111", "03/25")["valid"])
+        cache.validate("1234567891234563", "03/25")  # bad header
+
+        now[0] += 20
+        fake.now += 20
+        self.assertEqual(cache.validate("4111111111111111", "03/25")["error"],
+                         "Card Expired")
+        cache.validate("1234567891234563", "03/25")
+        self.assertEqual((cache.hits, cache.expirations), (1, 1))
+
+    def test_non_strings(self):
+        """Tests bad input types still fail like validate_card."""
+        cache = ValidationCache()
+        with self.assertRaises(TypeError):
+            cache.validate(4111111111111111, "12/40")
+
+    def test_requests_use_cache(self):
+        """Tests server requests go through the cache when it's on."""
+        cache = ValidationCache()
+        self.addCleanup(setattr, cc_service, "CACHE", cc_service.CACHE)
+        cc_service.CACHE = cache
+        for _ in range(3):
+            cc_service.handle_request({"cc_number": "4111111111111111",
+                                       "exp_date": "12/40"})
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 import unittest
 from cc_service import format_cc, validate_card_type, valid_card_length
 from cc_service import validate_luhn, validate_expiration
+from cc_service import handle_request, HEADER_ERROR
+from cc_service import ExpiryClock, parse_exp_date
+from datetime import datetime
+
+
+def frozen(*date):
+    """Returns a time source stuck at the given date."""
+    return lambda: datetime(*date).timestamp()
 
 
 class TestMyModule(unittest.TestCase):
@@ -136,6 +144,81 @@ class TestMyModule(unittest.TestCase):
         date = "2/2027"  # Incorrectly typed
         self.assertEqual(validate_expiration(date), -1)
 
+    def test_expiry_frozen_clock(self):
+        """Tests expiration dates against a frozen clock."""
+        clock = ExpiryClock(frozen(2025, 3, 15))
+        self.assertTrue(validate_expiration("03/25", clock))
+        self.assertTrue(validate_expiration("3/25", clock))
+        self.assertFalse(validate_expiration("02/25", clock))
+        self.assertTrue(validate_expiration("12/44", clock))  # 2044
+        self.assertFalse(validate_expiration("01/45", clock))  # 1945
+
+    def test_expiry_month_rollover(self):
+        """Tests the clock moves on when a new month starts."""
+        now = [datetime(2025, 3, 31, 23, 59).timestamp()]
+        clock = ExpiryClock(lambda: now[0])
+        self.assertTrue(validate_expiration("03/25", clock))
+        now[0] = datetime(2025, 4, 1).timestamp()
+        self.assertFalse(validate_expiration("03/25", clock))
+        self.assertTrue(validate_expiration("04/25", clock))
+
+    def test_expiry_december(self):
+        """Tests the rollover from December into the next year."""
+        now = [datetime(2025, 12, 31, 12).timestamp()]
+        clock = ExpiryClock(lambda: now[0])
+        self.assertTrue(validate_expiration("12/25", clock))
+        now[0] = datetime(2026, 1, 1, 12).timestamp()
+        self.assertFalse(validate_expiration("12/25", clock))
+        self.assertTrue(validate_expiration("1/26", clock))
+
+    def test_expiry_long_year(self):
+        """Tests MM/YYYY is only accepted when turned on."""
+        clock = ExpiryClock(frozen(2025, 3, 15))
+        self.assertEqual(validate_expiration("05/2025", clock), -1)
+        clock.accept_long_year = True
+        self.assertTrue(validate_expiration("05/2025", clock))
+        self.assertFalse(validate_expiration("2/2025", clock))
+        self.assertEqual(validate_expiration("05/225", clock), -1)
+
+    def test_parse_exp_date(self):
+        """Tests the MM/YY parser rejects everything else."""
+        self.assertEqual(parse_exp_date("07/27"), (7, 27, False))
+        for date in ["0/27", "00/27", "13/27", "012/27", "7-27", "7/2",
+                     "7/27 ", " 7/27", "7/27\n", "a/27", "", "/"]:
+            self.assertIsNone(parse_exp_date(date), date)
+
+    def test_batch_list(self):
+        """Tests a batch sent as a JSON array keeps results in order."""
+        cards = [{"cc_number": "4111111111111111", "exp_date": "12/40"},
+                 {"cc_number": "1234567891234563", "exp_date": "10/30"}]
+        results = handle_request(cards)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0]["valid"])
+        self.assertEqual(results[0]["card_type"], "Visa")
+        self.assertEqual(results[1]["error"], "Unknown card header")
+
+    def test_batch_cards_key(self):
+        """Tests a batch sent as {"cards": [...]} echoes the other keys."""
+        message = {"job": "settlement",
+                   "cards": [{"cc_number": "5199111111111113",
+                              "exp_date": "5/40"}]}
+        reply = handle_request(message)
+        self.assertEqual(reply["job"], "settlement")
+        self.assertEqual(reply["cards"][0]["card_type"], "MC")
+        self.assertTrue(reply["cards"][0]["valid"])
+
+    def test_batch_bad_entries(self):
+        """Tests malformed batch entries only fail themselves."""
+        cards = [{"cc_number": "4111111111111111"},
+                 "not a card",
+                 {"cc_number": 4111111111111111, "exp_date": "12/40"},
+                 {"cc_number": "4111111111111111", "exp_date": "12/40"}]
+        results = handle_request(cards)
+        self.assertEqual(results[0]["error"], HEADER_ERROR)
+        self.assertEqual(results[1]["error"], HEADER_ERROR)
+        self.assertFalse(results[2]["valid"])
+        self.assertTrue(results[3]["valid"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import unittest
+
+from cc_admission import AdmissionControl
+from cc_async_service import start_async_server
+from cc_client import AsyncCardClient, CardClient, encode
+from cc_dedup import RequestDedup
+from cc_service import LatencySimulator, start_server, validate_card
+from test_server import ServerTestCase, free_port
+
+
+CARDS = [("4111111111111111", "12/40"), ("5500000000000004", "05/2025"),
+         ("5199111111111113", "5/40"), ("5199111111111118", "12/28"),
+         ("3400-0000-0000-009", "8-25"), ("1234567891234563", "10/30")]
+
+
+def expected(cards):
+    return [dict(validate_card(cc, exp), cc_number=cc, exp_date=exp)
+            for cc, exp in cards]
+
+
+class TestEncode(unittest.TestCase):
+    def test_timeout_ms(self):
+        """Tests dict requests carry the timeout in ms, not a clock time."""
+        self.assertEqual(json.loads(encode({"cc_number": "4"}, 2.5)),
+                         {"cc_number": "4", "timeout_ms": 2500})
+        self.assertEqual(json.loads(encode([{"cc_number": "4"}], 2.5)),
+                         [{"cc_number": "4"}])
+
+
+class TestCardClient(ServerTestCase):
+    target = staticmethod(start_server)
+
+    def client(self, address, **kwargs):
+        client = CardClient(address, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_validate(self):
+        """Tests requests reuse one pooled socket."""
+        client = self.client(self.start())
+        for cc, exp in CARDS[:2]:
+            self.assertEqual(client.validate(cc, exp),
+                             expected([(cc, exp)])[0])
+        self.assertEqual(len(client.idle), 1)
+
+    def test_validate_many(self):
+        """Tests cards are batched and come back in order."""
+        client = self.client(self.start(), batch_size=4, max_in_flight=2)
+        self.assertEqual(client.validate_many(CARDS * 5), expected(CARDS * 5))
+        self.assertEqual(client.validate_many([]), [])
+
+    def test_timeout(self):
+        """Tests a request with no server gives up after its retries."""
+        client = self.client(f"tcp://127.0.0.1:{free_port()}", timeout=0.1,
+                             retries=1)
+        self.assertRaises(TimeoutError, client.validate, *CARDS[0])
+        self.assertRaises(TimeoutError, client.validate_many, CARDS)
+        self.assertEqual(client.idle, [])
+
+    def test_retry_deduplicated(self):
+        """Tests a retry reuses the request_id and gets the stored reply."""
+        dedup = RequestDedup()
+        address = self.start(latency=LatencySimulator("fixed", 0.5),
+                             dedup=dedup)
+        client = self.client(address, timeout=0.3, retries=3)
+        self.assertEqual(client.validate(*CARDS[0]), expected(CARDS[:1])[0])
+        self.assertEqual(dedup.replayed, 1)
+
+    def test_overloaded_retry(self):
+        """Tests batches turned away by a rate limit are sent again later."""
+        address = self.start(admission=AdmissionControl(rate=50, burst=1))
+        client = self.client(address, batch_size=1, max_in_flight=3,
+                             retries=20)
+        self.assertEqual(client.validate_many(CARDS[:3]), expected(CARDS[:3]))
+
+
+class TestAsyncCardClient(ServerTestCase):
+    target = staticmethod(start_async_server)
+
+    def test_out_of_order(self):
+        """Tests replies coming back in any order go to the right request."""
+        address = self.start(latency=LatencySimulator("uniform", 0, 0.2))
+
+        async def main():
+            async with AsyncCardClient(address, batch_size=2) as client:
+                single = await asyncio.gather(*[client.validate(cc, exp)
+                                                for cc, exp in CARDS])
+                many = await client.validate_many(CARDS * 3)
+            return single, many
+
+        single, many = asyncio.run(main())
+        self.assertEqual(single, expected(CARDS))
+        self.assertEqual(many, expected(CARDS * 3))
+
+    def test_timeout(self):
+        address = f"tcp://127.0.0.1:{free_port()}"
+
+        async def main():
+            async with AsyncCardClient(address, timeout=0.1,
+                                       retries=1) as client:
+                await client.validate(*CARDS[0])
+
+        self.assertRaises(TimeoutError, asyncio.run, main())
+
+
+if __name__ == '__main__':
+    unittest.main()
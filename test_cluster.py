@@ -0,0 +1,235 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+import zmq
+
+import cc_service
+from cc_cluster import READY, REPLY, REQUEST, ClusterBroker, Node, start_node
+from cc_dedup import RequestDedup
+from test_server import CARD, dealer, free_port, quit_server, request
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEARTBEAT = 0.1
+
+
+def wait_for(condition, timeout=5.0):
+    """Waits until condition() is true, or fails after timeout seconds."""
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.02)
+
+
+class TestLeastLoaded(unittest.TestCase):
+    def test_most_room(self):
+        """Tests requests go to the node with the most room."""
+        broker = ClusterBroker()
+        busy, big, full = Node(b"a", 2, 0), Node(b"b", 4, 0), Node(b"c", 1, 0)
+        busy.in_flight = {b"1"}
+        big.in_flight = {b"2", b"3"}
+        full.in_flight = {b"4"}
+        broker.nodes = {node.identity: node for node in (busy, big, full)}
+        self.assertIs(broker.least_loaded(), busy)
+
+        busy.in_flight.add(b"5")
+        self.assertIs(broker.least_loaded(), big)
+        big.in_flight |= {b"6", b"7"}
+        self.assertIsNone(broker.least_loaded())
+
+
+class TestCluster(unittest.TestCase):
+    def start_broker(self, dedup=None, max_dispatches=3):
+        """Starts a broker in a background thread. Returns (broker, client
+        address, node address)."""
+        address = f"tcp://127.0.0.1:{free_port()}"
+        nodes = f"tcp://127.0.0.1:{free_port()}"
+        broker = ClusterBroker(address, nodes, heartbeat=HEARTBEAT,
+                               dedup=dedup, max_dispatches=max_dispatches)
+        thread = threading.Thread(target=broker.serve, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(quit_server, address)
+        return broker, address, nodes
+
+    def start_thread_node(self, nodes, capacity=1):
+        thread = threading.Thread(target=start_node,
+                                  args=(nodes, capacity, HEARTBEAT),
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def start_process_node(self, nodes):
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "cc_service.py"),
+             "--join", nodes, "--heartbeat", str(HEARTBEAT),
+             "--log-level", "ERROR"])
+        self.addCleanup(process.wait, 5)
+        self.addCleanup(process.kill)
+        return process
+
+    def test_thread_nodes(self):
+        """Tests requests are answered by nodes, and the nodes stop with the
+        broker."""
+        broker, address, nodes = self.start_broker()
+        threads = [self.start_thread_node(nodes, 2) for _ in range(2)]
+        wait_for(lambda: len(broker.nodes) == 2)
+
+        self.assertTrue(request(address, CARD)["valid"])
+        batch = json.dumps([json.loads(CARD)] * 3)
+        self.assertEqual(len(request(address, batch)), 3)
+
+        quit_server(address)
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_dead_node_removed(self):
+        """Tests a killed node process is removed and the others keep
+        serving."""
+        broker, address, nodes = self.start_broker()
+        first = self.start_process_node(nodes)
+        self.start_process_node(nodes)
+        wait_for(lambda: len(broker.nodes) == 2, timeout=20)
+
+        first.kill()
+        wait_for(lambda: len(broker.nodes) == 1)
+        for _ in range(3):
+            self.assertTrue(request(address, CARD)["valid"])
+
+    def test_requeue(self):
+        """Tests requests a node never answered go to another node."""
+        broker, address, nodes = self.start_broker()
+
+        # A node that takes a request and then goes silent.
+        silent = zmq.Context.instance().socket(zmq.DEALER)
+        silent.setsockopt(zmq.LINGER, 0)
+        silent.connect(nodes)
+        self.addCleanup(silent.close)
+        silent.send_multipart([READY, b"1"])
+        wait_for(lambda: len(broker.nodes) == 1)
+
+        replies = []
+        client = threading.Thread(
+            target=lambda: replies.append(request(address, CARD)))
+        client.start()
+        wait_for(lambda: silent.poll(0))
+
+        self.start_thread_node(nodes)
+        client.join(5)
+        self.assertTrue(replies[0]["valid"])
+        self.assertEqual(len(broker.nodes), 1)
+
+    def patch_respond(self, special: bytes, action):
+        """Makes respond() call action() for one special message."""
+        original = cc_service.respond
+
+        def respond(message, metrics=None, received=None):
+            if message == special:
+                action()
+            return original(message, metrics, received)
+
+        self.addCleanup(setattr, cc_service, "respond", original)
+        cc_service.respond = respond
+
+    def test_node_survives_error(self):
+        """Tests a request that raises gets an error reply, and the node
+        keeps serving."""
+        def boom():
+            raise RuntimeError("boom")
+
+        self.patch_respond(b'"boom"', boom)
+        broker, address, nodes = self.start_broker()
+        self.start_thread_node(nodes)
+        wait_for(lambda: len(broker.nodes) == 1)
+
+        self.assertEqual(request(address, '"boom"'),
+                         {"valid": False, "error": "Unexpected error"})
+        self.assertTrue(request(address, CARD)["valid"])
+
+    def test_heartbeats_during_slow_request(self):
+        """Tests a node keeps its place while a request takes longer than
+        the broker waits for a heartbeat."""
+        self.patch_respond(b'"slow"', lambda: time.sleep(HEARTBEAT * 6))
+        broker, address, nodes = self.start_broker()
+        self.start_thread_node(nodes)
+        wait_for(lambda: len(broker.nodes) == 1)
+        identity = next(iter(broker.nodes))
+
+        self.assertEqual(request(address, '"slow"'),
+                         {"valid": False, "error": cc_service.HEADER_ERROR})
+        self.assertEqual(list(broker.nodes), [identity])
+
+    def test_gives_up(self):
+        """Tests a request whose nodes all died gets an error reply instead
+        of going to every node."""
+        broker, address, nodes = self.start_broker(max_dispatches=1)
+
+        silent = zmq.Context.instance().socket(zmq.DEALER)
+        silent.setsockopt(zmq.LINGER, 0)
+        silent.connect(nodes)
+        self.addCleanup(silent.close)
+        silent.send_multipart([READY, b"1"])
+        wait_for(lambda: len(broker.nodes) == 1)
+
+        self.assertEqual(request(address, CARD),
+                         {"valid": False, "error": "Unexpected error"})
+        self.assertEqual(broker.requests, {})
+
+    def test_dedup(self):
+        """Tests copies of a request are sent to a node once, and all get
+        its reply."""
+        broker, address, nodes = self.start_broker(RequestDedup())
+        node = dealer(self, nodes)
+        node.send_multipart([READY, b"4"])
+        wait_for(lambda: len(broker.nodes) == 1)
+
+        message = json.dumps(dict(json.loads(CARD), request_id=1)).encode()
+        clients = [dealer(self, address) for _ in range(2)]
+        for client in clients:
+            client.send_multipart([b"", message])
+        wait_for(lambda: broker.dedup.coalesced == 1)
+
+        frames = node.recv_multipart()
+        while frames[0] != REQUEST:
+            frames = node.recv_multipart()
+        node.send_multipart([REPLY, frames[1], b"reply"])
+        for client in clients:
+            self.assertEqual(client.recv_multipart()[-1], b"reply")
+
+        # Only heartbeats come after that.
+        time.sleep(0.1)
+        while node.poll(0):
+            self.assertNotEqual(node.recv_multipart()[0], REQUEST)
+
+    def test_broker_wait_counted(self):
+        """Tests nodes are told how long a request waited at the broker, and
+        that time counts against its timeout_ms."""
+        broker, address, nodes = self.start_broker()
+        message = json.dumps(dict(json.loads(CARD), timeout_ms=50)).encode()
+        client = dealer(self, address)
+        client.send_multipart([b"", message])
+        wait_for(lambda: broker.queue)
+        time.sleep(0.2)
+
+        node = dealer(self, nodes)
+        node.send_multipart([READY, b"1"])
+        frames = node.recv_multipart()
+        while frames[0] != REQUEST:
+            frames = node.recv_multipart()
+        self.assertEqual(frames[2], message)
+        self.assertGreaterEqual(int(frames[3]), 150)
+
+        received = time.monotonic() - int(frames[3]) / 1000
+        self.assertIsNone(cc_service.respond(frames[2], received=received))
+        self.assertIsNotNone(cc_service.respond(frames[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import re
+import subprocess
+import sys
+import unittest
+from datetime import datetime
+
+from cc_core import (CARD_TYPES, ERRORS, ExpiryClock, card_codes, format_cc,
+                     result_codes, valid_card_length, validate_card,
+                     validate_card_type, validate_expiration, validate_luhn)
+from random_test import generate_random_card
+
+
+class TestCore(unittest.TestCase):
+    def test_light_import(self):
+        """Tests importing cc_core doesn't pull in networking or other heavy
+        modules."""
+        script = ("import sys, cc_core; print(sorted({'zmq', 'json', "
+                  "'logging', 'datetime', 're'} & set(sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", script],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "[]")
+
+    def test_format_cc_matches_regex(self):
+        """Tests format_cc keeps the same digits a \\d regex does."""
+        for cc in ["4111 1111-1111 1111", "abc", "４１１１", "12٣x", ""]:
+            expected = re.sub(r"[^\d]", "", cc) or -1
+            self.assertEqual(format_cc(cc), expected, cc)
+
+    def test_clock_refresh_at(self):
+        """Tests the next month starts at local midnight on the 1st."""
+        for date, expected in [((2025, 3, 15), (2025, 4, 1)),
+                               ((2025, 12, 31, 23), (2026, 1, 1))]:
+            clock = ExpiryClock(lambda: datetime(*date).timestamp())
+            self.assertEqual(clock.refresh_at, datetime(*expected).timestamp())
+            self.assertEqual((clock.current_year, clock.current_month),
+                             date[:2])
+
+    def test_card_codes(self):
+        """Tests card_codes against the separate step functions, and that
+        validate_card's result has the same codes."""
+        def expected(cc, exp):
+            clean = format_cc(cc)
+            if clean == -1:
+                return 0, ERRORS.index("Invalid card format")
+            card_type = validate_card_type(clean)
+            if card_type == -1:
+                return 0, ERRORS.index("Unknown card header")
+            code = CARD_TYPES.index(card_type)
+            if not valid_card_length(clean, card_type):
+                return code, ERRORS.index("Incorrect length")
+            if not validate_luhn(clean):
+                return code, ERRORS.index("Invalid checksum")
+            valid_date = validate_expiration(exp)
+            if valid_date == -1:
+                return code, ERRORS.index("Invalid date format")
+            return code, 0 if valid_date else ERRORS.index("Card Expired")
+
+        cards = [(generate_random_card()[0], exp) for exp in
+                 ["12/40", "1/20", "13/40", "5-2040"] for _ in range(200)]
+        cards += [("", "12/40"), ("4111 1111 1111 1111", "12/40")]
+        for cc, exp in cards:
+            self.assertEqual(card_codes(cc, exp), expected(cc, exp), cc)
+            self.assertEqual(result_codes(validate_card(cc, exp)),
+                             expected(cc, exp), cc)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import time
+import unittest
+
+from cc_dedup import PENDING, RequestDedup, request_key
+from cc_service import respond_dedup
+from cc_wire import pack_cards, pack_msgpack
+from test_admission import FakeTime
+
+
+def card(request_id, deadline=None, **extra):
+    message = {"cc_number": "4111111111111111", "exp_date": "12/40",
+               "request_id": request_id, **extra}
+    if deadline is not None:
+        message["deadline"] = deadline
+    return json.dumps(message).encode()
+
+
+class TestRequestKey(unittest.TestCase):
+    def test_key(self):
+        """Tests copies match apart from their deadline, and nothing else
+        does."""
+        self.assertEqual(request_key(card("a", 1)), request_key(card("a", 2)))
+        self.assertNotEqual(request_key(card("a")), request_key(card("b")))
+        self.assertNotEqual(request_key(card("a")),
+                            request_key(card("a", cc_number="5")))
+
+    def test_msgpack_key(self):
+        """Tests MessagePack copies match apart from their deadline."""
+        def request(request_id, deadline):
+            return pack_msgpack({"cc_number": "4111111111111111",
+                                 "request_id": request_id,
+                                 "deadline": deadline})
+
+        self.assertEqual(request_key(request("a", 1.5)),
+                         request_key(request("a", 2**40)))
+        self.assertEqual(request_key(request(7, -1)),
+                         request_key(request(7, 3)))
+        self.assertNotEqual(request_key(request("a", 1.5)),
+                            request_key(request("b", 1.5)))
+
+    def test_no_key(self):
+        """Tests requests without a usable request_id aren't matched."""
+        for message in [b'{"cc_number": "4111111111111111"}', card(None),
+                        card(True), card([1]), b'{"request_id": ', b"[1]",
+                        pack_cards([("4111111111111111", "12/40")])]:
+            self.assertIsNone(request_key(message), message)
+
+
+class TestRequestDedup(unittest.TestCase):
+    def test_coalesce(self):
+        """Tests copies of an in-flight request wait for its reply."""
+        dedup = RequestDedup()
+        key = request_key(card("a"))
+        self.assertIsNone(dedup.check(key, [b"1"], card("a")))
+        dedup.start(key)
+        self.assertIs(dedup.check(key, [b"2"], card("a")), PENDING)
+        self.assertIs(dedup.check(key, [b"3"], card("a")), PENDING)
+
+        self.assertEqual(dedup.finish(key, b"reply"), [[b"2"], [b"3"]])
+        self.assertEqual(dedup.coalesced, 2)
+
+    def test_replay(self):
+        """Tests recent replies are replayed until they expire."""
+        clock = FakeTime()
+        dedup = RequestDedup(ttl=10, time_source=clock)
+        key = request_key(card("a"))
+        dedup.start(key)
+        dedup.finish(key, b"reply")
+
+        self.assertEqual(dedup.check(key, [b"2"], card("a")), b"reply")
+        self.assertEqual(dedup.replayed, 1)
+        clock.now += 10
+        self.assertIsNone(dedup.check(key, [b"2"], card("a")))
+        self.assertEqual(len(dedup), 0)
+
+    def test_max_entries(self):
+        """Tests the oldest replies go first once the table is full."""
+        dedup = RequestDedup(max_entries=2)
+        keys = [request_key(card(i)) for i in range(3)]
+        for key in keys:
+            dedup.start(key)
+            dedup.finish(key, b"reply")
+        self.assertIsNone(dedup.check(keys[0], [b"1"], b""))
+        self.assertEqual(dedup.check(keys[2], [b"1"], b""), b"reply")
+
+    def test_max_bytes(self):
+        """Tests the oldest replies go first once they take too much
+        memory."""
+        dedup = RequestDedup(max_bytes=3000)
+        keys = [request_key(card(i)) for i in range(3)]
+        for key in keys:
+            dedup.start(key)
+            dedup.finish(key, b"x" * 1000)
+        self.assertLessEqual(dedup.size, 3000)
+        self.assertIsNone(dedup.check(keys[0], [b"1"], b""))
+        self.assertEqual(dedup.check(keys[2], [b"1"], b""), b"x" * 1000)
+
+        dedup.expire()
+        dedup.max_bytes = 0
+        dedup.start(keys[0])
+        dedup.finish(keys[0], b"reply")
+        self.assertEqual((len(dedup), dedup.size), (0, 0))
+
+    def test_no_reply_kept(self):
+        """Tests a request dropped for its deadline isn't replayed."""
+        dedup = RequestDedup()
+        key = request_key(card("a"))
+        dedup.start(key)
+        self.assertEqual(dedup.finish(key, None), [])
+        self.assertIsNone(dedup.check(key, [b"1"], card("a")))
+
+    def test_late_copy_answered(self):
+        """Tests a later copy is answered when the first one's deadline has
+        passed."""
+        dedup = RequestDedup()
+        late, retry = card("a", time.time() - 1), card("a", time.time() + 60)
+        key = request_key(late)
+        dedup.start(key)
+        dedup.check(key, [b"2"], retry)
+
+        reply, addresses = respond_dedup([b"1"], late, dedup, key)
+        self.assertTrue(json.loads(reply)["valid"])
+        self.assertEqual(addresses, [[b"2"]])
+        self.assertEqual(dedup.check(key, [b"3"], retry), reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import random
+import unittest
+
+from cc_service import start_server, validate_card
+from loadtest import LatencyHistogram, classify, make_messages, parse_mix
+from loadtest import process_resources, resource_trend, run_load
+from test_server import ServerTestCase, free_port
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        """Tests percentiles are within 1% of the exact values."""
+        rng = random.Random(1)
+        values = sorted(rng.expovariate(1 / 0.002) for _ in range(10000))
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.record(value)
+
+        for percentile in (50, 90, 99):
+            exact = int(values[int(len(values) * percentile / 100) - 1] * 1e6)
+            self.assertAlmostEqual(histogram.value_at(percentile), exact,
+                                   delta=exact * 0.01 + 1)
+        self.assertEqual(histogram.value_at(100), int(values[-1] * 1e6))
+
+    def test_small_values_exact(self):
+        histogram = LatencyHistogram()
+        for us in (1, 2, 3, 200):
+            histogram.record(us / 1e6)
+        self.assertEqual(histogram.value_at(50), 2)
+        self.assertEqual(histogram.value_at(100), 200)
+
+    def test_merge(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        first.record(0.001)
+        second.record(0.003)
+        first.merge(second)
+        self.assertEqual(first.summary()["count"], 2)
+        self.assertEqual(first.max, 3000)
+
+
+class TestMessages(unittest.TestCase):
+    def test_mix(self):
+        """Tests messages follow the card mix."""
+        messages = make_messages({"bad_header": 1}, count=20)
+        self.assertEqual(len(messages), 20)
+        for message in messages:
+            card = json.loads(message)
+            self.assertEqual(validate_card(card["cc_number"],
+                                           card["exp_date"])["error"],
+                             "Unknown card header")
+        self.assertEqual(parse_mix("valid=3,bad_date=1"),
+                         {"valid": 3, "bad_date": 1})
+        self.assertRaises(ValueError, make_messages, {"stolen": 1})
+
+    def test_batch(self):
+        messages = make_messages(count=5, batch=10)
+        self.assertEqual([len(json.loads(m)) for m in messages], [10] * 5)
+
+    def test_classify(self):
+        self.assertEqual(classify(b'{"valid": false, "error": '
+                                  b'"Service overloaded"}'),
+                         "Service overloaded")
+        self.assertEqual(classify(b'[{"valid": true}]'), "ok")
+        self.assertEqual(classify(b"nope"), "Bad reply")
+
+
+class TestResources(unittest.TestCase):
+    @unittest.skipUnless(os.path.isdir("/proc/self"), "needs /proc")
+    def test_own_process(self):
+        resources = process_resources(os.getpid())
+        self.assertGreater(resources["rss_kb"], 0)
+        self.assertGreater(resources["fds"], 0)
+
+    def test_trend(self):
+        """Tests steady growth in file descriptors is flagged."""
+        steady = [{"rss_kb": 1000, "fds": 10}] * 20
+        growing = [{"rss_kb": 1000, "fds": 10 + i} for i in range(20)]
+        self.assertFalse(resource_trend(steady)["leak_suspected"])
+        self.assertTrue(resource_trend(growing)["leak_suspected"])
+        self.assertIsNone(resource_trend(steady[:3]))
+
+
+class TestLoadRun(ServerTestCase):
+    target = staticmethod(start_server)
+
+    def test_run(self):
+        """Tests a short open-loop run against a server."""
+        address = self.start()
+        report = run_load(address, make_messages(count=50), rate=200,
+                          clients=4, duration=0.5, interval=0.25,
+                          pid=os.getpid())
+
+        self.assertGreater(report["sent"], 50)
+        self.assertEqual(report["outcomes"], {"ok": report["sent"]})
+        self.assertEqual(report["error_rate"], 0)
+        self.assertEqual(len(report["timeline"]), 2)
+        self.assertGreaterEqual(report["latency"]["p99_us"],
+                                report["uncorrected_latency"]["p50_us"])
+
+    def test_timeouts(self):
+        """Tests requests to a server that never answers count as
+        timeouts."""
+        report = run_load(f"tcp://127.0.0.1:{free_port()}",
+                          make_messages(count=10), rate=40, clients=2,
+                          duration=0.25, timeout=0.2, interval=0.25)
+        self.assertEqual(report["outcomes"], {"timeout": report["sent"]})
+        self.assertEqual(report["error_rate"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
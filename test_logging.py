@@ -0,0 +1,72 @@
+import logging
+import unittest
+
+import cc_logging
+from cc_logging import mask_card, mask_request, log_request
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, cc_logging, "sample_rate",
+                        cc_logging.sample_rate)
+
+    def test_mask_plain(self):
+        """Tests only the last 4 digits of a card # are kept."""
+        self.assertEqual(mask_card("4111111111111111"), "************1111")
+
+    def test_mask_separators(self):
+        """Tests card #s are masked whatever separates their digits."""
+        for cc_number in ("4111 1111 1111 1111", "4111-1111-1111-1111",
+                          "4111.1111.1111.1111", "4111_1111_1111_1111",
+                          "4111/1111/1111/1111", "4111  1111 1111 1111",
+                          " 4111\t1111\n1111 1111 "):
+            with self.subTest(cc_number=cc_number):
+                self.assertEqual(mask_card(cc_number), "************1111")
+
+    def test_mask_not_str(self):
+        """Tests card #s sent as numbers are masked too."""
+        self.assertEqual(mask_card(340000000000009), "***********0009")
+
+    def test_mask_request(self):
+        """Tests only the cc_number fields are masked, in batches too."""
+        request = {"cards": [{"cc_number": "5199.1111.1111.1113",
+                              "exp_date": "12/40"}, {"id": 12345}],
+                   "id": 67890}
+        self.assertEqual(mask_request(request),
+                         {"cards": [{"cc_number": "************1113",
+                                     "exp_date": "12/40"}, {"id": 12345}],
+                          "id": 67890})
+        self.assertEqual(request["cards"][0]["cc_number"],
+                         "5199.1111.1111.1113")
+        self.assertEqual(mask_request([{"cc_number": "4111_1111_1111_1111"}]),
+                         [{"cc_number": "************1111"}])
+
+    def test_sampled_request(self):
+        """Tests sampled requests are logged with the card # masked."""
+        cc_logging.sample_rate = 1.0
+        with self.assertLogs("cc_service.requests", logging.INFO) as logs:
+            log_request(b'{"cc_number": "4111  1111 1111 1111"}',
+                        {"cc_number": "4111  1111 1111 1111", "valid": True})
+        self.assertEqual(len(logs.output), 1)
+        self.assertNotIn("1111 1111", logs.output[0])
+        self.assertEqual(logs.output[0].count("************1111"), 2)
+
+    def test_sampled_bad_json(self):
+        """Tests requests that aren't JSON are logged by size only."""
+        cc_logging.sample_rate = 1.0
+        with self.assertLogs("cc_service.requests", logging.INFO) as logs:
+            log_request(b'cc 4111/1111/1111/1111',
+                        {"valid": False, "error": "Invalid JSON format"})
+        self.assertNotIn("4111", logs.output[0])
+        self.assertIn("<22 bytes, not JSON>", logs.output[0])
+
+    def test_not_sampled(self):
+        """Tests nothing is logged when sampling is off."""
+        cc_logging.sample_rate = 0.0
+        with self.assertRaises(AssertionError):
+            with self.assertLogs("cc_service.requests", logging.INFO):
+                log_request(b"{}", {})
+
+
+if __name__ == '__main__':
+    unittest.main()
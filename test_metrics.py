@@ -0,0 +1,78 @@
+import unittest
+import urllib.request
+
+import cc_core
+import cc_service
+from cc_metrics import Metrics, Histogram, Throughput, STAGES
+from cc_metrics import start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+    def test_quantiles(self):
+        """Tests quantile estimates land in the right buckets."""
+        histogram = Histogram()
+        for _ in range(90):
+            histogram.observe(0.001)
+        for _ in range(10):
+            histogram.observe(0.5)
+        self.assertLessEqual(histogram.quantile(0.5), 0.002)
+        self.assertGreater(histogram.quantile(0.99), 0.25)
+        self.assertEqual(histogram.count, 100)
+
+    def test_throughput(self):
+        """Tests the throughput gauge only counts the last window."""
+        throughput = Throughput(window=10)
+        throughput.add(50, now=100)
+        throughput.add(50, now=105)
+        self.assertEqual(throughput.rate(now=105), 10)
+        self.assertEqual(throughput.rate(now=112), 5)
+
+    def test_instrument_stages(self):
+        """Tests each validate_card stage is timed, then restored."""
+        original = cc_core.scan_card
+        metrics = Metrics().instrument_stages(cc_core)
+        try:
+            cc_service.validate_card("4111111111111111", "12/40")
+        finally:
+            metrics.restore_stages()
+
+        self.assertIs(cc_core.scan_card, original)
+        for stage in STAGES:
+            self.assertEqual(metrics.stages[stage].count, 1)
+
+    def test_count_reply(self):
+        """Tests requests, cards and errors are counted for batches."""
+        metrics = Metrics()
+        metrics.count_reply([{"valid": True},
+                             {"valid": False, "error": "Card Expired"}])
+        metrics.count_reply({"cards": [{"valid": False,
+                                        "error": "Card Expired"}]})
+        metrics.count_reply({"valid": False, "error": "Invalid JSON format"})
+        self.assertEqual(metrics.requests, 3)
+        self.assertEqual(metrics.errors["Card Expired"], 2)
+        self.assertEqual(sum(c for _, c in metrics.throughput.seconds), 4)
+
+    def test_http_endpoint(self):
+        """Tests metrics are served in Prometheus text format."""
+        metrics = Metrics()
+        metrics.observe("json_decode", 0.0001)
+        metrics.count_reply({"valid": False, "error": 'Bad "quote"'})
+
+        server = start_metrics_server(metrics, port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+
+        self.assertIn('cc_stage_seconds_count{stage="json_decode"} 1', body)
+        self.assertIn('cc_stage_seconds_bucket{stage="json_decode",'
+                      'le="+Inf"} 1', body)
+        self.assertIn('quantile="0.99"', body)
+        self.assertIn('cc_errors_total{error="Bad \\"quote\\""} 1', body)
+        self.assertIn("cc_requests_total 1", body)
+
+
+if __name__ == '__main__':
+    unittest.main()
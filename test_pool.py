@@ -0,0 +1,90 @@
+import os
+import unittest
+
+import cc_service
+from cc_cache import ValidationCache
+from cc_pool import ValidationPool
+from cc_service import result_codes, validate_batch, validate_card
+
+
+CARDS = [("4111111111111111", "12/40"), ("5500000000000004", "05/2025"),
+         ("5199111111111113", "5/40"), ("5199111111111118", "12/28"),
+         ("3400-0000-0000-009", "8-25"), ("1234567891234563", "10/30"),
+         (4111111111111111, "12/40")]
+
+
+class TestPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ValidationPool(2, shard_size=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_codes_match(self):
+        """Tests the pool returns the same codes as validate_card."""
+        codes = self.pool.validate(CARDS[:-1] * 5)
+        expected = [result_codes(validate_card(cc, exp))
+                    for cc, exp in CARDS[:-1] * 5]
+        self.assertEqual(list(zip(codes.card_types, codes.errors)), expected)
+        self.assertEqual(list(codes.valid),
+                         [int(error == 0) for _, error in expected])
+
+    def test_unexpected_error(self):
+        """Tests a card that raises only fails itself."""
+        codes = self.pool.validate(CARDS[-2:])
+        self.assertEqual(list(codes.valid), [0, 0])
+        self.assertEqual(cc_service.ERRORS[codes.errors[1]],
+                         "Unexpected error")
+
+    def test_empty(self):
+        self.assertEqual(len(self.pool.validate([]).valid), 0)
+
+    def test_memory_freed(self):
+        """Tests the shared memory is unlinked once the results are read."""
+        pending = self.pool.submit(CARDS)
+        path = os.path.join("/dev/shm", pending.shm.name)
+        pending.result()
+        self.assertIsNone(pending.shm)
+        if os.path.isdir("/dev/shm"):
+            self.assertFalse(os.path.exists(path))
+
+    def test_batch(self):
+        """Tests big batch requests go through the pool with the same
+        results."""
+        cards = [{"id": i, "cc_number": cc, "exp_date": exp}
+                 for i, (cc, exp) in enumerate(CARDS)] + [{"id": 9}]
+        expected = validate_batch([dict(card) for card in cards])
+        self.assertTrue(expected[-2]["error"].startswith("Unexpected error:"))
+
+        self.use_pool()
+        self.assertEqual(validate_batch(cards), expected)
+
+    def test_batch_cached(self):
+        """Tests cached cards skip the pool, and pooled results are
+        cached."""
+        cards = [{"cc_number": cc, "exp_date": exp} for cc, exp in CARDS]
+        expected = validate_batch([dict(card) for card in cards])
+
+        self.use_pool()
+        self.addCleanup(setattr, cc_service, "CACHE", None)
+        cc_service.CACHE = ValidationCache()
+        self.assertEqual(validate_batch([dict(card) for card in cards]),
+                         expected)
+        self.assertEqual(cc_service.CACHE.hits, 0)
+
+        self.assertEqual(validate_batch(cards), expected)
+        self.assertEqual(cc_service.CACHE.hits, len(CARDS) - 1)
+
+    def use_pool(self):
+        """Sends batches of 2+ cards to the pool until the test ends."""
+        self.addCleanup(setattr, cc_service, "POOL", None)
+        self.addCleanup(setattr, cc_service, "POOL_MIN_BATCH",
+                        cc_service.POOL_MIN_BATCH)
+        cc_service.POOL = self.pool
+        cc_service.POOL_MIN_BATCH = 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import unittest
+
+try:
+    import numpy as np
+    from cc_vector import validate_cards
+except ImportError:  # NumPy is optional
+    np = None
+
+from cc_results import BatchResult, CardResult
+from cc_service import ERRORS, result_codes, validate_card
+
+
+CARDS = [("4111111111111111", "12/40"), ("5500000000000004", "05/2025"),
+         ("5199111111111113", "5/40"), ("5199111111111118", "12/28"),
+         ("3400-0000-0000-009", "8-25"), ("1234567891234563", "10/30"),
+         ("", "12/40"), ("4111111111111111", "1/20")]
+
+
+class TestResults(unittest.TestCase):
+    def test_matches_validate_card(self):
+        """Tests the columns and dicts match validate_card."""
+        results = BatchResult.validate(CARDS)
+        expected = [validate_card(cc, exp) for cc, exp in CARDS]
+
+        self.assertEqual(len(results), len(CARDS))
+        self.assertEqual(list(results.to_dicts()), expected)
+        self.assertEqual(list(results.codes()),
+                         [result_codes(result) for result in expected])
+        self.assertEqual(list(results.valid),
+                         [int(result["valid"]) for result in expected])
+        self.assertEqual([result.to_dict() for result in results], expected)
+
+    def test_to_json(self):
+        """Tests the JSON is the same as encoding the dicts."""
+        results = BatchResult.validate(CARDS * 3)
+        self.assertEqual(results.to_json(),
+                         json.dumps(list(results.to_dicts())).encode())
+        self.assertEqual(BatchResult().to_json(), b"[]")
+
+    def test_unexpected_error(self):
+        """Tests a card that raises only fails itself."""
+        results = BatchResult.validate([(4111111111111111, "12/40"),
+                                        CARDS[0]])
+        self.assertEqual(ERRORS[results.errors[0]], "Unexpected error")
+        self.assertFalse(results[0].valid)
+        self.assertTrue(results[1].valid)
+
+    def test_card_result(self):
+        result = BatchResult.validate(CARDS[:1])[0]
+        self.assertEqual(result, CardResult(1, 0))
+        self.assertEqual(len({result, CardResult(1, 0)}), 1)
+        with self.assertRaises(AttributeError):
+            result.extra = 1
+
+    def test_nbytes(self):
+        """Tests results take 3 bytes per card."""
+        self.assertEqual(BatchResult.validate(CARDS * 10).nbytes,
+                         3 * len(CARDS) * 10)
+
+    @unittest.skipIf(np is None, "NumPy isn't installed")
+    def test_numpy_columns(self):
+        """Tests cc_vector's arrays can be used as the columns."""
+        numbers, dates = zip(*CARDS)
+        results = BatchResult(*validate_cards(list(numbers), list(dates)))
+        self.assertEqual(list(results.to_dicts()),
+                         [validate_card(cc, exp) for cc, exp in CARDS])
+        self.assertEqual(results[0], CardResult(1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,342 @@
+import json
+import socket
+import threading
+import time
+import unittest
+
+import zmq
+
+from cc_admission import AdmissionControl
+from cc_async_service import start_async_server
+import cc_service
+from cc_broker import start_broker
+from cc_dedup import RequestDedup
+from cc_metrics import Metrics, STAGES
+from cc_wire import pack_cards, unpack_results
+from cc_service import start_server, LatencySimulator
+
+
+def free_port():
+    """Returns a free TCP port on localhost for a test server."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request(address, message, timeout=5000):
+    """Sends a single request with a REQ socket and returns the reply."""
+    context = zmq.Context.instance()
+    req = context.socket(zmq.REQ)
+    req.setsockopt(zmq.RCVTIMEO, timeout)
+    req.setsockopt(zmq.LINGER, 0)
+    req.connect(address)
+    try:
+        req.send_string(message)
+        return json.loads(req.recv())
+    finally:
+        req.close()
+
+
+def dealer(test, address):
+    """Returns a DEALER socket (one client identity for many requests)."""
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.setsockopt(zmq.RCVTIMEO, 5000)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    test.addCleanup(socket.close)
+    return socket
+
+
+def quit_server(address):
+    """Sends the 'Q' message that shuts the server down."""
+    req = zmq.Context.instance().socket(zmq.REQ)
+    req.setsockopt(zmq.LINGER, 1000)
+    req.connect(address)
+    req.send_string("Q")
+    req.close()
+
+
+CARD = json.dumps({"cc_number": "4111111111111111", "exp_date": "12/40"})
+
+
+class ServerTestCase(unittest.TestCase):
+    target = None
+
+    def start(self, **kwargs):
+        """Starts a server in a background thread and returns its address."""
+        address = f"tcp://127.0.0.1:{free_port()}"
+        thread = threading.Thread(target=self.target, args=(address,),
+                                  kwargs=kwargs, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(quit_server, address)
+        return address
+
+
+class TestServer(ServerTestCase):
+    target = staticmethod(start_server)
+
+    def test_single_request(self):
+        """Tests a plain REQ client still gets its result appended."""
+        address = self.start()
+        reply = request(address, json.dumps({"cc_number": "4111111111111111",
+                                             "exp_date": "12/40"}))
+        self.assertTrue(reply["valid"])
+        self.assertEqual(reply["cc_number"], "4111111111111111")
+
+    def test_struct_request(self):
+        """Tests a binary struct request gets a struct reply."""
+        address = self.start()
+        req = zmq.Context.instance().socket(zmq.REQ)
+        req.setsockopt(zmq.RCVTIMEO, 5000)
+        req.setsockopt(zmq.LINGER, 0)
+        req.connect(address)
+        self.addCleanup(req.close)
+
+        req.send(pack_cards([("4111111111111111", "12/40"),
+                             ("1234567891234563", "10/30")]))
+        self.assertEqual(unpack_results(req.recv()), [(1, 0), (0, 2)])
+
+    def test_bad_json(self):
+        """Tests the server replies to requests that aren't JSON."""
+        address = self.start()
+        reply = request(address, "not json")
+        self.assertEqual(reply["error"], "Invalid JSON format")
+
+    def test_metrics(self):
+        """Tests each stage of a request is timed."""
+        metrics = Metrics()
+        address = self.start(metrics=metrics)
+        request(address, json.dumps({"cc_number": "4111111111111111",
+                                     "exp_date": "12/40"}))
+        self.assertEqual(metrics.requests, 1)
+        for stage in STAGES + ("json_decode", "json_encode", "socket_wait"):
+            self.assertGreaterEqual(metrics.stages[stage].count, 1, stage)
+
+    def test_delay_does_not_block(self):
+        """Tests delayed requests don't hold up other clients."""
+        address = self.start(latency=LatencySimulator("fixed", 0.5))
+        message = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40"})
+        replies = []
+
+        def client():
+            replies.append(request(address, message))
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=client) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(len(replies), 6)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 2.0)
+
+    def test_rate_limited(self):
+        """Tests a client over its rate gets an overload reply right away."""
+        address = self.start(admission=AdmissionControl(rate=1, burst=2))
+        socket = dealer(self, address)
+        for _ in range(3):
+            socket.send_multipart([b"", CARD.encode()])
+        replies = [json.loads(socket.recv_multipart()[-1]) for _ in range(3)]
+
+        errors = sorted(reply.get("error", "") for reply in replies)
+        self.assertEqual(errors, ["", "", "Service overloaded"])
+        self.assertGreater(max(reply.get("retry_after", 0)
+                               for reply in replies), 0)
+
+        # Other clients still get through.
+        self.assertTrue(request(address, CARD)["valid"])
+
+    def test_timeout_dropped(self):
+        """Tests a request whose timeout_ms is up is dropped, even if the
+        client's clock is far off."""
+        address = self.start(admission=AdmissionControl())
+        socket = dealer(self, address)
+        late = json.dumps({"cc_number": "4111111111111111",
+                           "exp_date": "12/40", "timeout_ms": 0})
+        on_time = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40", "timeout_ms": 60000})
+        socket.send_multipart([b"", late.encode()])
+        socket.send_multipart([b"", on_time.encode()])
+
+        reply = json.loads(socket.recv_multipart()[-1])
+        self.assertTrue(reply["valid"])
+        self.assertNotIn("timeout_ms", reply)
+        socket.setsockopt(zmq.RCVTIMEO, 200)
+        self.assertRaises(zmq.Again, socket.recv_multipart)
+
+    def test_deadline_dropped(self):
+        """Tests a request past its deadline is dropped without a reply."""
+        address = self.start(admission=AdmissionControl())
+        socket = dealer(self, address)
+        late = json.dumps({"cc_number": "4111111111111111",
+                           "exp_date": "12/40", "deadline": time.time() - 1})
+        on_time = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40",
+                              "deadline": time.time() + 60})
+        socket.send_multipart([b"", late.encode()])
+        socket.send_multipart([b"", on_time.encode()])
+
+        reply = json.loads(socket.recv_multipart()[-1])
+        self.assertTrue(reply["valid"])
+        self.assertNotIn("deadline", reply)
+        socket.setsockopt(zmq.RCVTIMEO, 200)
+        self.assertRaises(zmq.Again, socket.recv_multipart)
+
+    def test_dedup(self):
+        """Tests retries with the same request_id are only validated once."""
+        dedup = RequestDedup()
+        address = self.start(admission=AdmissionControl(), dedup=dedup)
+        socket = dealer(self, address)
+        message = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40", "request_id": "a"})
+        for _ in range(3):
+            socket.send_multipart([b"", message.encode()])
+        replies = [socket.recv_multipart()[-1] for _ in range(3)]
+
+        self.assertEqual(len(set(replies)), 1)
+        self.assertEqual(json.loads(replies[0])["request_id"], "a")
+        self.assertEqual(dedup.coalesced + dedup.replayed, 2)
+        self.assertEqual(request(address, message), json.loads(replies[0]))
+
+
+class TestBroker(ServerTestCase):
+    target = staticmethod(start_broker)
+
+    def test_single_request(self):
+        """Tests a plain REQ client works through the thread broker."""
+        address = self.start(workers=4, mode="thread")
+        reply = request(address, json.dumps({"cc_number": "4111111111111111",
+                                             "exp_date": "12/40"}))
+        self.assertTrue(reply["valid"])
+
+    def test_bad_json(self):
+        """Tests a worker replies to requests that aren't JSON."""
+        address = self.start(workers=2, mode="thread")
+        self.assertEqual(request(address, "[")["error"],
+                         "Invalid JSON format")
+
+    def test_worker_survives_error(self):
+        """Tests a request that raises gets an error reply, and the worker
+        keeps serving."""
+        original = cc_service.respond
+
+        def respond(message, metrics=None, received=None):
+            if message == b'"boom"':
+                raise RuntimeError("boom")
+            return original(message, metrics, received)
+
+        self.addCleanup(setattr, cc_service, "respond", original)
+        cc_service.respond = respond
+        address = self.start(workers=1, mode="thread")
+        self.assertEqual(request(address, '"boom"'),
+                         {"valid": False, "error": "Unexpected error"})
+        self.assertTrue(request(address, CARD)["valid"])
+
+    def test_deadline(self):
+        """Tests a worker answers a request past its deadline unprocessed."""
+        address = self.start(workers=1, mode="thread")
+        reply = request(address, json.dumps({"cc_number": "4111111111111111",
+                                             "exp_date": "12/40",
+                                             "deadline": 1.0}))
+        self.assertEqual(reply, {"valid": False,
+                                 "error": "Deadline exceeded"})
+
+    def test_process_workers(self):
+        """Tests many clients are served by a pool of worker processes."""
+        address = self.start(workers=2, mode="process")
+        message = json.dumps([{"cc_number": "5199111111111113",
+                               "exp_date": "5/40"}] * 10)
+        replies = []
+
+        def client():
+            replies.append(request(address, message, timeout=20000))
+
+        threads = [threading.Thread(target=client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(replies), 8)
+        self.assertTrue(all(r["valid"] for reply in replies for r in reply))
+
+
+class TestAsyncServer(TestServer):
+    target = staticmethod(start_async_server)
+
+    def test_max_in_flight(self):
+        """Tests requests over the in-flight cap wait for a free slot."""
+        address = self.start(latency=LatencySimulator("fixed", 0.3),
+                             max_in_flight=2)
+        message = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40"})
+        threads = [threading.Thread(target=request, args=(address, message))
+                   for _ in range(4)]
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Two rounds of two requests each.
+        self.assertGreaterEqual(time.monotonic() - started, 0.6)
+
+    def test_quit_drains_pending(self):
+        """Tests requests in flight are still answered after 'Q'."""
+        address = self.start(latency=LatencySimulator("fixed", 0.3))
+        message = json.dumps({"cc_number": "4111111111111111",
+                              "exp_date": "12/40"})
+        replies = []
+        thread = threading.Thread(
+            target=lambda: replies.append(request(address, message)))
+        thread.start()
+        time.sleep(0.1)
+        quit_server(address)
+        thread.join()
+        self.assertTrue(replies[0]["valid"])
+
+    def test_big_batch_offloaded(self):
+        """Tests a big batch doesn't hold up a single card sent after it."""
+        address = self.start()
+        batch = json.dumps([json.loads(CARD)] * 50000).encode()
+        batch_socket = dealer(self, address)
+        batch_socket.send_multipart([b"", batch])
+        time.sleep(0.05)
+
+        started = time.monotonic()
+        self.assertTrue(request(address, CARD)["valid"])
+        self.assertLess(time.monotonic() - started, 0.25)
+        self.assertFalse(batch_socket.poll(0))
+
+        self.assertEqual(len(json.loads(batch_socket.recv_multipart()[-1])),
+                         50000)
+
+
+class TestLatencySimulator(unittest.TestCase):
+    def test_fixed(self):
+        """Tests a fixed delay parsed from a string."""
+        self.assertEqual(LatencySimulator.from_string("fixed:3").next_delay(),
+                         3)
+
+    def test_uniform(self):
+        """Tests uniform delays stay in range."""
+        latency = LatencySimulator.from_string("uniform:1:2")
+        for _ in range(100):
+            self.assertTrue(1 <= latency.next_delay() <= 2)
+
+    def test_bad_spec(self):
+        """Tests unknown distributions are rejected."""
+        with self.assertRaises(ValueError):
+            LatencySimulator.from_string("gauss:1")
+        with self.assertRaises(ValueError):
+            LatencySimulator.from_string("uniform:1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from cc_stream import validate_file, validate_records
+from cc_service import validate_card
+
+
+CARDS = [("4111111111111111", "12/40"), ("5500000000000004", "05/2025"),
+         ("5199111111111113", "5/40"), ("5199111111111118", "12/28"),
+         ("3400-0000-0000-009", "8-25"), ("1234567891234563", "10/30")]
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_csv(self):
+        """Tests a CSV file keeps its columns and gets result columns."""
+        with open(self.path("in.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["id", "cc_number", "exp_date"])
+            writer.writerows((i, cc, exp) for i, (cc, exp) in
+                             enumerate(CARDS))
+
+        count = validate_file(self.path("in.csv"), self.path("out.csv"))
+
+        with open(self.path("out.csv"), newline="") as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(count, len(CARDS))
+        self.assertEqual([row["id"] for row in rows],
+                         [str(i) for i in range(len(CARDS))])
+        self.assertEqual([row["error"] for row in rows],
+                         [validate_card(cc, exp).get("error", "")
+                          for cc, exp in CARDS])
+
+    def test_jsonl_gzip(self):
+        """Tests gzipped JSONL in and out, with a bad line in the middle."""
+        with gzip.open(self.path("in.jsonl.gz"), "wt") as file:
+            for cc, exp in CARDS[:3]:
+                file.write(json.dumps({"cc_number": cc, "exp_date": exp}))
+                file.write("\n")
+            file.write("{not json\n")
+
+        validate_file(self.path("in.jsonl.gz"), self.path("out.jsonl.gz"))
+
+        with gzip.open(self.path("out.jsonl.gz"), "rt") as file:
+            results = [json.loads(line) for line in file]
+        self.assertEqual([r["valid"] for r in results],
+                         [True, False, True, False])
+        self.assertEqual(results[3]["error"], "Invalid JSON format")
+
+    def test_processes_keep_order(self):
+        """Tests chunks validated in a process pool come back in order."""
+        records = ({"cc_number": CARDS[i % len(CARDS)][0],
+                    "exp_date": CARDS[i % len(CARDS)][1], "n": i}
+                   for i in range(500))
+        results = list(validate_records(records, processes=2, chunk_size=7))
+        self.assertEqual([r["n"] for r in results], list(range(500)))
+
+    def test_processes_same_errors(self):
+        """Tests a CSV row missing its cc_number gets the same error with
+        one process or several."""
+        with open(self.path("in.csv"), "w", newline="") as file:
+            file.write("exp_date,cc_number\n12/40,4111111111111111\n12/40\n")
+
+        outputs = []
+        for processes in (1, 2):
+            validate_file(self.path("in.csv"), self.path("out.csv"),
+                          processes=processes, chunk_size=2)
+            with open(self.path("out.csv"), newline="") as file:
+                outputs.append(list(csv.DictReader(file)))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue(outputs[0][1]["error"].startswith("Unexpected error:"))
+
+
+if __name__ == '__main__':
+    unittest.main()
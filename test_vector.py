@@ -0,0 +1,96 @@
+import random
+import unittest
+
+try:
+    import numpy as np
+    from cc_vector import validate_cards, to_results, digit_matrix, luhn_valid
+    from cc_vector import card_types
+except ImportError:  # NumPy is optional
+    np = None
+
+from bin_table import BinTable, CARD_TYPES
+from cc_service import validate_card, validate_luhn
+
+
+def random_card():
+    """Returns a random card number with a mix of headers, lengths and
+    separators."""
+    header = random.choice(["4", "51", "55", "2220", "2221", "2720", "2721",
+                            "34", "37", "35", "6011", "1", "22", ""])
+    length = random.choice([0, 1, 3, 12, 15, 16, 17, 19])
+    number = header + "".join(random.choice("0123456789")
+                              for _ in range(max(length - len(header), 0)))
+    return random.choice([number, number[:4] + " " + number[4:],
+                          number[:4] + "-" + number[4:], " " + number])
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestVector(unittest.TestCase):
+    def test_matches_validate_card(self):
+        """Tests bulk results match validate_card for random cards."""
+        random.seed(361)
+        numbers = [random_card() for _ in range(5000)]
+
+        # Other unicode digits count as digits too.
+        numbers += ["\u0664111111111111111", "4111\u0664111 1111 1111",
+                    "41111111111111\u0661\u0661",
+                    "\uff14\uff11\uff11\uff11 1111 1111 1111"]
+        dates = [random.choice(["12/40", "1/20", "13/40", "05/2025", "7/27",
+                                "", "10/30"]) for _ in numbers]
+
+        valid, types, errors = validate_cards(numbers, dates)
+
+        expected = [validate_card(cc, exp) for cc, exp in zip(numbers, dates)]
+        self.assertEqual(to_results(types, errors), expected)
+        self.assertEqual(valid.tolist(), [r["valid"] for r in expected])
+
+    def test_unicode_digits(self):
+        """Tests cards with non-ASCII digits get the same result as
+        validate_card, cleaned or not."""
+        valid, types, errors = validate_cards(["\u0664111111111111111"],
+                                              ["12/40"])
+        self.assertEqual(to_results(types, errors),
+                         [{"valid": False, "error": "Unknown card header"}])
+
+        valid, types, errors = validate_cards(
+            np.array(["41111111111111\u0661\u0661", "4111111111111111"]),
+            ["12/40", "12/40"], clean=False)
+        self.assertEqual(valid.tolist(), [True, True])
+
+    def test_luhn_matches_validate_luhn(self):
+        """Tests the vectorized checksum against validate_luhn."""
+        random.seed(5557)
+        numbers = ["".join(random.choice("0123456789")
+                           for _ in range(random.randint(1, 19)))
+                   for _ in range(5000)]
+        digits, lengths = digit_matrix(numbers)
+        self.assertEqual(luhn_valid(digits, lengths).tolist(),
+                         [validate_luhn(cc) for cc in numbers])
+
+    def test_card_types_extended(self):
+        """Tests vectorized card types against the extended header table."""
+        table = BinTable.load("card_ranges_extended.json")
+        random.seed(2025)
+        numbers = [random.choice(["6011", "65", "644", "3528", "3589", "62",
+                                  "30", "305", "3095", "36", "38", "4", "5"]) +
+                   str(random.randint(0, 10**12)) for _ in range(2000)]
+        digits, lengths = digit_matrix(numbers)
+        expected = [CARD_TYPES.index(table.lookup(cc)[0])
+                    if table.lookup(cc) else 0 for cc in numbers]
+        self.assertEqual(card_types(digits, lengths, table).tolist(),
+                         expected)
+
+    def test_digit_matrix(self):
+        """Tests the digit matrix has one padded column per card."""
+        digits, lengths = digit_matrix([b"4111", b"34"])
+        self.assertEqual(digits.tolist(), [[4, 3], [1, 4], [1, 0], [1, 0]])
+        self.assertEqual(lengths.tolist(), [4, 2])
+
+    def test_empty(self):
+        """Tests an empty list of cards."""
+        valid, types, errors = validate_cards([], [])
+        self.assertEqual(len(valid), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
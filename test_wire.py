@@ -0,0 +1,124 @@
+import json
+import unittest
+
+import cc_wire
+from cc_service import respond, validate_card, result_codes, ERRORS
+from cc_service import error_reply, safe_respond
+from cc_wire import pack_cards, unpack_cards, pack_results, unpack_results
+
+
+CARDS = [("4111111111111111", "12/40"), ("5500000000000004", "05/2025"),
+         ("5199111111111113", "5/40"), ("5199111111111118", "12/28"),
+         ("340000000000009", "8-25"), ("1234567891234563", "10/30"),
+         ("340000000000009", "13/40"), ("", "12/40")]
+
+
+class TestWire(unittest.TestCase):
+    def test_struct_round_trip(self):
+        """Tests card #s (odd and even length) survive packed BCD."""
+        cards = unpack_cards(pack_cards([("4111111111111111", "12/40"),
+                                         ("340000000000009", "7/27")]))
+        self.assertEqual(cards, [("4111111111111111", "12/40"),
+                                 ("340000000000009", "7/27")])
+
+    def test_struct_size(self):
+        """Tests a 16 digit card takes 11 bytes."""
+        self.assertEqual(len(pack_cards([("4111111111111111", "12/40")])),
+                         5 + 11)
+
+    def test_struct_bad_date(self):
+        """Tests dates that aren't MM/YY are sent as an invalid date."""
+        self.assertEqual(unpack_cards(pack_cards([("4", "05/2025")])),
+                         [("4", "0/00")])
+
+    def test_struct_cut_short(self):
+        """Tests truncated struct requests are rejected."""
+        message = pack_cards(CARDS)
+        with self.assertRaises(ValueError):
+            unpack_cards(message[:-1])
+        with self.assertRaises(ValueError):
+            unpack_cards(message + b"\x00")
+
+    def test_struct_count_too_big(self):
+        """Tests a count larger than the records sent is rejected, and gets
+        an error reply rather than an exception."""
+        for message in [cc_wire.STRUCT_TAG + cc_wire.COUNT.pack(1),
+                        pack_cards(CARDS[:2])[:1] + cc_wire.COUNT.pack(3) +
+                        pack_cards(CARDS[:2])[5:]]:
+            with self.assertRaises(ValueError):
+                unpack_cards(message)
+            self.assertEqual(unpack_results(respond(message)),
+                             [(0, ERRORS.index("Invalid message format"))])
+
+    def test_results_round_trip(self):
+        """Tests result codes survive a struct reply."""
+        results = [(1, 0), (0, 2), (3, 6)]
+        self.assertEqual(unpack_results(pack_results(results)), results)
+
+    def test_respond_struct(self):
+        """Tests struct requests get the same results as validate_card."""
+        results = unpack_results(respond(pack_cards(CARDS)))
+        self.assertEqual(results, [result_codes(validate_card(cc, exp))
+                                   for cc, exp in CARDS])
+
+    def test_respond_struct_malformed(self):
+        """Tests a malformed struct request gets an error code back."""
+        results = unpack_results(respond(cc_wire.STRUCT_TAG + b"\x05"))
+        self.assertEqual(results,
+                         [(0, ERRORS.index("Invalid message format"))])
+
+    def test_respond_json(self):
+        """Tests plain JSON requests still get JSON replies."""
+        reply = respond(b'{"cc_number": "4111111111111111", '
+                        b'"exp_date": "12/40"}')
+        self.assertTrue(reply.startswith(b'{"cc_number"'))
+
+    @unittest.skipIf(cc_wire.msgpack is None, "msgpack is not installed")
+    def test_respond_msgpack(self):
+        """Tests MessagePack batches get numeric codes back."""
+        request = [{"cc_number": cc, "exp_date": exp} for cc, exp in CARDS]
+        reply = cc_wire.unpack_msgpack(respond(cc_wire.pack_msgpack(request)))
+        self.assertEqual([(r["card_type"], r["error"]) for r in reply],
+                         [result_codes(validate_card(cc, exp))
+                          for cc, exp in CARDS])
+        self.assertEqual(reply[0]["cc_number"], CARDS[0][0])
+
+    @unittest.skipIf(cc_wire.msgpack is None, "msgpack is not installed")
+    def test_respond_msgpack_junk_keys(self):
+        """Tests requests echoing keys that aren't codes still get codes."""
+        for junk in ["x", 5, None, [1]]:
+            request = {"cc_number": "9", "exp_date": "1/30",
+                       "card_type": junk, "error": junk}
+            reply = cc_wire.unpack_msgpack(respond(
+                cc_wire.pack_msgpack(request)))
+            self.assertEqual((reply["card_type"], reply["error"]),
+                             (0, ERRORS.index("Unknown card header")))
+
+    def test_result_codes_junk(self):
+        self.assertEqual(result_codes({"card_type": "x", "error": "y"}),
+                         (0, ERRORS.index("Unexpected error")))
+
+    @unittest.skipIf(cc_wire.msgpack is None, "msgpack is not installed")
+    def test_respond_msgpack_malformed(self):
+        """Tests bad MessagePack gets an error code back."""
+        reply = cc_wire.unpack_msgpack(respond(cc_wire.MSGPACK_TAG + b"\xc1"))
+        self.assertEqual(reply["error"],
+                         ERRORS.index("Invalid message format"))
+
+    def test_respond_msgpack_not_installed(self):
+        """Tests MessagePack requests get a JSON error reply if msgpack isn't
+        installed, instead of raising."""
+        self.addCleanup(setattr, cc_wire, "msgpack", cc_wire.msgpack)
+        cc_wire.msgpack = None
+        expected = {"valid": False, "error": "Invalid message format"}
+
+        self.assertRaises(ValueError, cc_wire.unpack_msgpack, b"\x02abc")
+        self.assertEqual(json.loads(respond(b"\x02abc")), expected)
+        self.assertEqual(json.loads(safe_respond(b"\x02abc")), expected)
+        self.assertEqual(json.loads(error_reply(b"\x02abc",
+                                                "Service overloaded")),
+                         {"valid": False, "error": "Service overloaded"})
+
+
+if __name__ == '__main__':
+    unittest.main()